@@ -36,35 +36,89 @@ from __future__ import print_function
 import re
 import os
 import subprocess
-import tempfile
 import collections
-import functools
+import itertools
+import math
 import sys
-# Terminal stuff
-import fcntl
-import termios
-import struct
-import unicodedata
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+# Modules only some runs need (eg. terminal handling, sampling) are imported
+# where they're used, since git-guilt may be started thousands of times in a
+# row by scripts
 
 
 class GitError(Exception):
     pass
 
 
+class GitTimeout(GitError):
+    pass
+
+
 class GitRunner(object):
     _toplevel_args = ['rev-parse', '--show-toplevel']
     _version_args = ['--version']
     _git_executable = 'git'
     _min_binary_ver = (1, 7, 2)
-
-    def __init__(self):
-        self._git_toplevel = None
+    _min_attr_pathspec_ver = (2, 13, 0)
+    _min_shallow_query_ver = (2, 15, 0)
+    _min_changed_paths_ver = (2, 27, 0)
+    _gitlink_mode = '160000'
+    _bloom_chunk = b'BDAT'
+    # The commit ID git-blame gives lines that aren't committed yet, in SHA-1
+    # and SHA-256 repositories
+    _null_commit_ids = (b'0' * 40, b'0' * 64)
+    # Git LFS pointer files are smaller than this by definition
+    _max_lfs_pointer_size = 1024
+    _lfs_pointer_version = b'version https://git-lfs.github.com/spec/'
+    _lfs_size_regex = re.compile(br'^size (\d+)$', re.MULTILINE)
+    # How many files' line counts are read per git-diff. The first batch is
+    # small so that blames start early, and batches are capped to keep the
+    # command line short
+    _min_numstat_batch = 8
+    _max_numstat_batch = 512
+
+    def __init__(self, cwd=None):
+        # Where the repository is looked up from, if not the current directory
+        self._cwd = cwd
+        self._git_toplevel = cwd
         self._get_git_root()
-        self.version = self._get_git_version()
+        self.version = self._get_cached_git_version()
+        # The (name, email) of the author of every commit blamed so far, by
+        # commit ID, shared by every blame in this repository
+        self.commit_authors = dict()
 
     def git_supports_binary_diff(self):
         return GitRunner._min_binary_ver <= self.version
 
+    def git_supports_attr_pathspec(self):
+        return GitRunner._min_attr_pathspec_ver <= self.version
+
+    def git_supports_changed_paths(self):
+        return GitRunner._min_changed_paths_ver <= self.version
+
+    def pathspec_from_cwd(self, pathspec):
+        '''
+        Git commands are run from the top-level directory of the repository,
+        whereas paths given on the command line are relative to the current
+        working directory. This returns a pathspec that matches the same files
+        when used from the top-level directory.
+        '''
+        if pathspec.startswith(':') or not self._git_toplevel:
+            # Pathspecs with magic are left alone
+            return pathspec
+        prefix = os.path.relpath(
+            os.path.realpath(self._cwd or os.getcwd()),
+            self._git_toplevel
+        )
+        if os.curdir == prefix:
+            return pathspec
+        return os.path.normpath(os.path.join(prefix, pathspec))
+
     def _get_git_version(self):
         def version_string_to_tuple(ver_string):
             try:
@@ -82,16 +136,85 @@ class GitRunner(object):
 
         raise GitError("Couldn't determine Git version %s" % raw_version)
 
+    @staticmethod
+    def _find_git_executable():
+        '''
+        Returns the real path of the git executable we run, as found in PATH
+        '''
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            candidate = os.path.join(directory, GitRunner._git_executable)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return os.path.realpath(candidate)
+        return None
+
+    @staticmethod
+    def _version_cache_file():
+        return os.path.join(cache_dir(), 'git-versions')
+
+    def _get_cached_git_version(self):
+        '''
+        Returns the version of git, which is cached on disk so that we don't
+        have to run `git --version` every time we're started. Entries are keyed
+        on the path, modification time and size of the git executable, so that
+        upgrading git invalidates them.
+        '''
+        executable = GitRunner._find_git_executable()
+        if executable is None:
+            return self._get_git_version()
+        stat = os.stat(executable)
+        key = '{0}\t{1}\t{2}'.format(
+            executable, int(stat.st_mtime), stat.st_size
+        )
+
+        cache_file = GitRunner._version_cache_file()
+        entries = dict()
+        try:
+            with open(cache_file) as cache:
+                for line in cache:
+                    entry_key, _, version = line.rstrip('\n').rpartition('\t')
+                    entries[entry_key] = version
+        except (IOError, OSError):
+            pass
+
+        if key in entries:
+            try:
+                return tuple([int(v) for v in entries[key].split('.')])
+            except ValueError:
+                pass
+
+        version = self._get_git_version()
+        entries[key] = '.'.join([str(v) for v in version])
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            # Concurrent runs may update the cache too, so we replace it in one
+            # go rather than write it in place
+            temp_file = '{0}.{1}'.format(cache_file, os.getpid())
+            with open(temp_file, 'w') as cache:
+                for entry in sorted(entries.items()):
+                    cache.write('\t'.join(entry) + '\n')
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError):
+            # The cache is only an optimisation
+            pass
+        return version
+
     def _get_git_root(self):
         # We should probably go beyond just finding the root dir for the Git
         # repo and do some sanity-checking on git itself
         top_level_dir = self.run_git(GitRunner._toplevel_args)
         self._git_toplevel = top_level_dir[0]
 
-    def run_git(self, args, git_env=None):
+    def run_git(self, args, git_env=None, stdin_data=None, decode=True,
+                timeout=None):
         '''
         Runs the git executable with the arguments given and returns a list of
-        lines produced on its standard output.
+        lines produced on its standard output. If `stdin_data` is given, it is
+        fed to the process's standard input. If `decode` is False, the output
+        is returned as is, as a single byte string.
+
+        If `timeout` is given, git is killed after that many seconds and
+        `GitTimeout` is raised.
         '''
 
         popen_kwargs = {
@@ -99,6 +222,10 @@ class GitRunner(object):
             'stderr': subprocess.PIPE,
         }
 
+        if stdin_data is not None:
+            popen_kwargs['stdin'] = subprocess.PIPE
+            stdin_data = stdin_data.encode('utf_8')
+
         if git_env:
             popen_kwargs['env'] = git_env
 
@@ -110,8 +237,22 @@ class GitRunner(object):
             **popen_kwargs
         )
 
+        timed_out = list()
+        timer = None
+        if timeout:
+            def kill_git():
+                # git may have exited just as the timer went off
+                if git_process.poll() is None:
+                    timed_out.append(True)
+                    git_process.kill()
+            timer = threading.Timer(timeout, kill_git)
+            timer.start()
+
         try:
-            out, err = git_process.communicate()
+            if stdin_data is None:
+                out, err = git_process.communicate()
+            else:
+                out, err = git_process.communicate(stdin_data)
             git_process.wait()
         except Exception as e:
             raise GitError("Couldn't run 'git {args}':{newline}{ex}".format(
@@ -119,6 +260,15 @@ class GitRunner(object):
                 newline=os.linesep,
                 ex=str(e)
             ))
+        finally:
+            if timer:
+                timer.cancel()
+
+        if timed_out:
+            raise GitTimeout("'git {args}' took longer than {t}s".format(
+                args=' '.join(args),
+                t=timeout
+            ))
 
         if (0 != git_process.returncode) or err:
             if err:
@@ -132,8 +282,88 @@ class GitRunner(object):
         if not out:
             raise ValueError("No output")
 
+        if not decode:
+            return out
         return out.decode('utf_8').splitlines()
 
+    def iter_git(self, args, git_env=None, separator=b'\0', decode=True):
+        '''
+        Runs the git executable with the arguments given and yields the records
+        produced on its standard output, split on `separator`, as soon as they
+        are read from the pipe rather than once the process has exited. If
+        `decode` is False, records are yielded as byte strings.
+        '''
+        pending = b''
+        for chunk in self._iter_git_chunks(args, git_env):
+            records = (pending + chunk).split(separator)
+            pending = records.pop()
+            for record in records:
+                yield record.decode('utf_8') if decode else record
+        if pending:
+            yield pending.decode('utf_8') if decode else pending
+
+    def _iter_git_chunks(self, args, git_env=None):
+        '''
+        Runs the git executable with the arguments given and yields chunks of
+        raw bytes from its standard output as they are read from the pipe.
+        Standard error is read on a thread of its own meanwhile, lest git
+        block on a full stderr pipe while we wait for more output.
+        '''
+
+        popen_kwargs = {
+            'stdout': subprocess.PIPE,
+            'stderr': subprocess.PIPE,
+        }
+
+        if git_env:
+            popen_kwargs['env'] = git_env
+
+        if self._git_toplevel:
+            popen_kwargs['cwd'] = self._git_toplevel
+
+        try:
+            git_process = subprocess.Popen(
+                [GitRunner._git_executable] + args,
+                **popen_kwargs
+            )
+        except Exception as e:
+            raise GitError("Couldn't run 'git {args}':{newline}{ex}".format(
+                args=' '.join(args),
+                newline=os.linesep,
+                ex=str(e)
+            ))
+
+        errors = list()
+        stderr_reader = threading.Thread(
+            target=lambda: errors.append(git_process.stderr.read())
+        )
+        stderr_reader.daemon = True
+        stderr_reader.start()
+
+        try:
+            while True:
+                # os.read() returns whatever is available in the pipe, where
+                # file.read() would block until its buffer is full
+                chunk = os.read(git_process.stdout.fileno(), 65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            git_process.stdout.close()
+            stderr_reader.join()
+            git_process.stderr.close()
+            git_process.wait()
+
+        err = b''.join(errors)
+        if (0 != git_process.returncode) or err:
+            if err:
+                err = err.decode('utf_8')
+            raise GitError("'git {args}' failed with:{newline}{err}".format(
+                args=' '.join(args),
+                newline=os.linesep,
+                err=err
+            ))
+
     def get_delta_files(self, since_rev, until_rev):
         '''
         Returns a list of files which have been modified between since_rev and
@@ -177,635 +407,4072 @@ class GitRunner(object):
 
         return (text_files, binary_files)
 
-    def populate_tree(self, rev):
-        # We need to detect submodules/non-blobs
-        ls_tree_args = ['ls-tree', '-r', '--', rev]
-        paths = set()
-
-        lines = self.run_git(ls_tree_args)
-        for line in lines:
-            _, object_type, _ = line.split('\t')[0].split()
-            path = line.split('\t')[1]
-            if 'blob' != object_type:
-                continue
-            paths.add(path)
-
-        return paths
-
+    def iter_delta_files(self, since_rev, until_rev, pathspecs=None):
+        '''
+        Yields a `ChangedFile` for every file which has been modified between
+        since_rev and until_rev, costliest first, so that the biggest blames
+        are planned first however the bounded worker queue fills up.
 
-class VersionedFile(object):
+        The raw diff records tell us which paths are regular files in either
+        revision, which spares us from listing both trees before blaming.
+        They take no content diff, so they come back quickly. Line counts
+        and binary-ness do, so they're read in growing batches of files,
+        letting the first blames start after a handful of diffs rather than
+        after all of them.
 
-    def __init__(self, path, revision):
-        self.repo_path = path
-        self.git_revision = revision
+        :param since_rev: the old Git revision
+        :type since_rev: str
+        :param until_rev: the new Git revision, or None for the working tree
+        :type until_rev: str
+        :param pathspecs: restricts the diff to the paths matching these
+        :type pathspecs: list
+        '''
 
-    def __repr__(self):
-        return "<VersionedFile {rev}:{path}>".format(
-            rev=self.git_revision,
-            path=self.repo_path
+        diff_args = [
+            'diff', '-z', '--raw', '--no-renames', '--no-abbrev', since_rev
+        ]
+        if until_rev:
+            diff_args.append(until_rev)
+        if pathspecs:
+            diff_args.append('--')
+            diff_args.extend(pathspecs)
+
+        # Raw records take two NUL-terminated fields, the first of which
+        # starts with a colon:
+        # :OLD_MODE NEW_MODE OLD_SHA NEW_SHA STATUS\0PATH\0
+        blobs = list()
+        raw_header = None
+        for record in self.iter_git(diff_args):
+            if raw_header is not None:
+                old_mode, new_mode, old_sha, new_sha = \
+                    raw_header[1:].split(' ', 4)[:4]
+                if not until_rev and not new_sha.strip('0'):
+                    # The file differs from the index in the working tree, so
+                    # git hasn't hashed it
+                    new_sha = ''
+                blobs.append((
+                    record,
+                    old_sha if old_mode in ChangedFile.blob_modes else None,
+                    new_sha if new_mode in ChangedFile.blob_modes else None,
+                ))
+                raw_header = None
+            elif record.startswith(':'):
+                raw_header = record
+
+        # Look up the size of every blob we're going to blame in one go
+        blob_sizes = self.get_blob_sizes(
+            [sha for _, since, until in blobs for sha in (since, until) if sha]
         )
+        lfs_sizes = self.get_lfs_sizes(
+            sha for sha, size in blob_sizes.items()
+            if size < GitRunner._max_lfs_pointer_size
+        )
+        changed_files = list()
+        for file_name, since_blob, until_blob in blobs:
+            until_size = blob_sizes.get(until_blob, 0)
+            if not until_rev and '' == until_blob:
+                until_size = self.working_tree_size(file_name)
+            changed_files.append(ChangedFile(
+                file_name,
+                None,
+                since_blob,
+                until_blob,
+                blob_sizes.get(since_blob, 0),
+                until_size,
+                lfs_sizes.get(since_blob),
+                lfs_sizes.get(until_blob),
+            ))
+        # Binary-ness isn't known yet, so this ranks files by size, and each
+        # batch is ranked again once its numstat is in
+        changed_files.sort(key=lambda changed_file: -changed_file.cost())
+
+        batch_start = 0
+        batch_size = GitRunner._min_numstat_batch
+        while batch_start < len(changed_files):
+            batch = changed_files[batch_start:batch_start + batch_size]
+            self._read_numstat(since_rev, until_rev, batch)
+            batch.sort(key=lambda changed_file: -changed_file.cost())
+            for changed_file in batch:
+                yield changed_file
+            batch_start += batch_size
+            batch_size = min(2 * batch_size, GitRunner._max_numstat_batch)
+
+    def _read_numstat(self, since_rev, until_rev, changed_files):
+        '''
+        Fills in whether the given `ChangedFile` records are binary and how
+        many lines they add, from a git-diff limited to their paths.
+        '''
+        by_path = dict(
+            (changed_file.repo_path, changed_file)
+            for changed_file in changed_files
+        )
+        diff_args = ['diff', '-z', '--numstat', '--no-renames', since_rev]
+        if until_rev:
+            diff_args.append(until_rev)
+        diff_args.append('--')
+        diff_args.extend(':(top,literal)' + path for path in sorted(by_path))
 
-    def __eq__(self, rhs):
-        return (rhs.repo_path and rhs.repo_path) == self.repo_path and \
-            (rhs.git_revision and rhs.git_revision) == self.git_revision
-
-
-class BlameTicket(object):
-    '''A queued blame. This is a TODO item, really'''
-    _author_regex = re.compile(r'^[^(]*\((.*?) \d{4}-\d{2}-\d{2}')
-
-    def __init__(self, bucket, versioned_file, args):
-
-        self.bucket = bucket
-        self.versioned_file = versioned_file
-        self.args = args
-
-        self.config_pairs = dict()
-        self.config_pairs['user.name'] = 'foo'
-        self.config_pairs['user.email'] = 'bar@example.com'
-
-    def __eq__(self, blame):
-        return (self.bucket is blame.bucket) \
-            and (self.versioned_file == blame.versioned_file) \
-            and (self.bucket == blame.bucket)
+        # Numstat records fit in one field: ADDITIONS\tDELETIONS\tPATH\0
+        for record in self.iter_git(diff_args):
+            if not record:
+                continue
+            (additions, deletions, file_name) = record.split('\t', 2)
+            changed_file = by_path.get(file_name)
+            if changed_file is None:
+                continue
+            changed_file.is_binary = ('-', '-') == (additions, deletions)
+            if not changed_file.is_binary:
+                changed_file.additions = int(additions)
+
+        for changed_file in changed_files:
+            if changed_file.is_binary is None:
+                # A change git has no line diff for, such as a mode change
+                changed_file.is_binary = False
+                changed_file.additions = 0
+
+    def get_single_commit_authors(self, since_rev, until_rev, pathspecs=None,
+                                  email=False):
+        '''
+        Returns a dictionary mapping the paths that were added by a commit
+        between since_rev and until_rev, and touched by no other commit in
+        that range, to the author of that commit. Every line of those files
+        belongs to the author, so there's no need to blame them.
+
+        Only the raw records of a single git-log are read. Those don't take
+        line diffs, but detecting renames does read the content of the blobs
+        added and deleted by a commit, when their paths and IDs don't match
+        exactly.
+
+        :param pathspecs: restricts the walk to the paths matching these
+        :type pathspecs: list
+        :param email: whether to identify authors by their email addresses
+        :type email: bool
+        '''
+        author_format = '<%aE>' if email else '%aN'
+        log_args = [
+            # Renames are detected as git-blame would follow them, and merges
+            # only report the paths they changed from every parent, which are
+            # the only ones git-blame could credit them with
+            'log', '-z', '--raw', '-c', '-M', '--no-abbrev',
+            # Marks the start of every commit
+            '--format=%x01' + author_format,
+            '{0}..{1}'.format(since_rev, until_rev),
+        ]
+        if pathspecs:
+            log_args.append('--')
+            log_args.extend(pathspecs)
+
+        # Raw records are laid out as in `iter_delta_files`, except that
+        # renames are followed by both paths, and that records of merges
+        # start with a colon per parent and have a status letter per parent
+        author = None
+        touches = collections.defaultdict(int)
+        authors = dict()
+        status = None
+        path_count = 0
+        try:
+            for record in self.iter_git(log_args):
+                if path_count:
+                    path_count -= 1
+                    if path_count:
+                        # The old path of a rename
+                        touches[record] += 1
+                        continue
+                    touches[record] += 1
+                    if all('A' == letter for letter in status):
+                        authors[record] = author
+                    continue
+
+                record = record.lstrip('\n')
+                if record.startswith('\x01'):
+                    author = record[1:]
+                elif record.startswith(':'):
+                    status = record.rsplit(' ', 1)[1]
+                    path_count = 2 if status[0] in 'RC' and \
+                        not record.startswith('::') else 1
+        except GitError:
+            # eg. since_rev is the empty tree, which git-log can't walk from
+            return dict()
 
-    def _format_config(self):
-        git_config_params = list()
-        for key, value in sorted(self.config_pairs.items()):
-            git_config_params.append("'{config_key}={config_value}'".format(
-                config_key=key,
-                config_value=value
-            ))
-        return ' '.join(git_config_params)
+        return dict(
+            (path, author) for path, author in authors.items()
+            if 1 == touches[path]
+        )
 
-    def blame_args(self):
-        blame_args = [
-            'blame',
-            '--encoding=utf-8',
-            '--',
-            self.versioned_file.repo_path
+    def iter_submodule_changes(self, since_rev, until_rev, pathspecs=None):
+        '''
+        Yields a (path, since_commit, until_commit) tuple for every submodule
+        whose commit differs between since_rev and until_rev. Either commit is
+        None if the submodule doesn't exist in that revision.
+        '''
+        diff_args = [
+            'diff', '-z', '--raw', '--no-renames', '--no-abbrev',
+            '--ignore-submodules=none', since_rev, until_rev
         ]
+        if pathspecs:
+            diff_args.append('--')
+            diff_args.extend(pathspecs)
+
+        raw_header = None
+        for record in self.iter_git(diff_args):
+            if raw_header is None:
+                raw_header = record
+                continue
+            old_mode, new_mode, old_sha, new_sha = \
+                raw_header[1:].split(' ', 4)[:4]
+            raw_header = None
+            if GitRunner._gitlink_mode not in (old_mode, new_mode):
+                continue
+            yield (
+                record,
+                old_sha if GitRunner._gitlink_mode == old_mode else None,
+                new_sha if GitRunner._gitlink_mode == new_mode else None,
+            )
 
-        if self.args.email:
-            blame_args.insert(1, '--show-email')
-        if self.versioned_file.git_revision:
-            blame_args.append(self.versioned_file.git_revision)
-        return blame_args
+    def empty_tree(self):
+        '''
+        Returns the ID of the empty tree, which stands for a revision of a
+        submodule where it doesn't exist
+        '''
+        return self.run_git(
+            ['hash-object', '-t', 'tree', '--stdin'], stdin_data=''
+        )[0].strip()
 
-    def blame_env(self):
-        environment = dict()
-        if self.config_pairs:
-            environment['GIT_CONFIG_PARAMETERS'] = self._format_config()
-        environment['GIT_CONFIG_NOSYSTEM'] = 'true'
-        return environment
+    def iter_churn(self, since_rev, until_rev, pathspecs=None, email=False):
+        '''
+        Yields a `FileChurn` for every change made to a file by the
+        non-merge commits between since_rev and until_rev, walking the
+        history with a single git-log.
+
+        :param pathspecs: restricts the walk to the paths matching these
+        :type pathspecs: list
+        :param email: whether to identify authors by their email addresses
+        :type email: bool
+        '''
+        author_format = '<%aE>' if email else '%aN'
+        log_args = [
+            'log', '-z', '--raw', '--numstat', '--no-renames', '--no-abbrev',
+            # Marks the start of every commit
+            '--format=%x01' + author_format,
+            '{0}..{1}'.format(since_rev, until_rev or 'HEAD'),
+        ]
+        if pathspecs:
+            log_args.append('--')
+            log_args.extend(pathspecs)
+
+        # Every commit is made of its author, then raw records laid out as in
+        # `iter_delta_files` and numstat records laid out as in
+        # `_read_numstat`. Git separates the author from the rest with a
+        # newline.
+        author = None
+        blobs = dict()
+        raw_header = None
+        for record in self.iter_git(log_args):
+            if raw_header is not None:
+                old_mode, new_mode, old_sha, new_sha = \
+                    raw_header[1:].split(' ', 4)[:4]
+                blobs[record] = (
+                    old_sha if old_mode in ChangedFile.blob_modes else None,
+                    new_sha if new_mode in ChangedFile.blob_modes else None,
+                )
+                raw_header = None
+                continue
 
+            record = record.lstrip('\n')
+            if record.startswith('\x01'):
+                author = record[1:]
+                blobs.clear()
+            elif record.startswith(':'):
+                raw_header = record
+            elif record:
+                (additions, deletions, file_name) = record.split('\t', 2)
+                old_blob, new_blob = blobs.pop(file_name, (None, None))
+                if old_blob is None and new_blob is None:
+                    # Not a file we'd blame either
+                    continue
+                if ('-', '-') == (additions, deletions):
+                    yield FileChurn(author, file_name, True,
+                                    old_blob=old_blob, new_blob=new_blob)
+                else:
+                    yield FileChurn(author, file_name, False,
+                                    int(additions), int(deletions))
 
-class TextBlameTicket(BlameTicket):
-    def __init__(self, runner, bucket, versioned_file, args):
-        super(TextBlameTicket, self).__init__(bucket, versioned_file, args)
-        self.runner = runner
+    def get_blob_sizes(self, blob_ids):
+        '''
+        Returns a dictionary mapping each of the blob IDs given to the size of
+        the blob in bytes, as reported by a single git-cat-file process.
+        '''
+        blob_ids = set(blob_ids)
+        if not blob_ids:
+            return dict()
+
+        sizes = dict()
+        lines = self.run_git(
+            ['cat-file', '--batch-check'],
+            stdin_data=''.join(sha + '\n' for sha in blob_ids)
+        )
+        for line in lines:
+            # Objects that can't be found are reported as "SHA missing"
+            fields = line.split()
+            if 3 == len(fields):
+                sizes[fields[0]] = int(fields[2])
+        return sizes
 
-    def __repr__(self):
-        return "<TextBlame {rev}:\"{path}\">".format(
-            rev=self.versioned_file.git_revision,
-            path=self.versioned_file.repo_path,
+    def get_lfs_sizes(self, blob_ids):
+        '''
+        Returns a dictionary mapping those of the blob IDs given that are Git
+        LFS pointer files to the size of the object they point to, reading
+        every blob with a single git-cat-file process. The LFS objects
+        themselves are never fetched.
+        '''
+        blob_ids = set(blob_ids)
+        if not blob_ids:
+            return dict()
+
+        output = self.run_git(
+            ['cat-file', '--batch'],
+            stdin_data=''.join(sha + '\n' for sha in blob_ids),
+            decode=False
         )
+        sizes = dict()
+        position = 0
+        while position < len(output):
+            header_end = output.index(b'\n', position)
+            fields = output[position:header_end].split()
+            position = header_end + 1
+            if 3 != len(fields):
+                # Missing objects have no content
+                continue
+            content_end = position + int(fields[2])
+            size = GitRunner.lfs_pointer_size(output[position:content_end])
+            if size is not None:
+                sizes[fields[0].decode('ascii')] = size
+            # Contents are followed by a newline
+            position = content_end + 1
+        return sizes
 
-    def process(self):
+    @staticmethod
+    def lfs_pointer_size(content):
         '''
-        Updates the bucket with a tally of the ownership of LOCs in this file
+        Returns the size of the object a Git LFS pointer file points to, or
+        None if the content given isn't that of a pointer file
+        '''
+        if not content.startswith(GitRunner._lfs_pointer_version):
+            return None
+        matches = GitRunner._lfs_size_regex.search(content)
+        if not matches:
+            return None
+        return int(matches.group(1))
+
+    def count_lines(self, blob_id):
         '''
+        Returns the number of lines in the blob with the given ID, as git-blame
+        would count them. The blob is streamed rather than read into memory,
+        since we mostly count lines in very large files.
+        '''
+        lines = 0
+        last_byte = b'\n'
+        for chunk in self._iter_git_chunks(['cat-file', 'blob', blob_id]):
+            lines += chunk.count(b'\n')
+            last_byte = chunk[-1:]
+        if b'\n' != last_byte:
+            lines += 1
+        return lines
+
+    def working_tree_size(self, repo_path):
+        '''
+        Returns the size of the working tree's copy of a file, or of the path
+        it links to for symbolic links, as git would hash it
+        '''
+        try:
+            return os.lstat(
+                os.path.join(self._git_toplevel, repo_path)
+            ).st_size
+        except OSError:
+            return 0
 
+    def count_working_tree_lines(self, repo_path):
+        '''
+        Returns the number of lines in the working tree's copy of a file, as
+        git-blame would count them
+        '''
+        lines = 0
+        last_byte = b'\n'
         try:
-            lines = self.runner.run_git(
-                self.blame_args(),
-                git_env=self.blame_env(),
-            )
-        except GitError as ge:
-            if 'no such path ' in str(ge):
-                return None
-            else:
-                raise ge
-        # It may happen that a binary file isn't marked as such by Git.
-        # When that happens, we'll process any file content that appears in
-        # Git's output (eg. for git-blame) as if it were a text file but there
-        # is no guarantee that the file's bytes will be valid UTF8-encoded
-        # Unicode text.
-        # We should fail gracefully in that event.
-        except UnicodeError:
-            raise GitError(
-                "Invalid text encoding in blame output of {f}. "
-                "This may be caused by a mislabeled binary file.".format(
-                    f=self.versioned_file)
-                )
-        except ValueError as ve:
-            # Not having any output is actually OK if we have an empty file
-            if 'no output' in str(ve).lower():
-                return
+            with open(os.path.join(self._git_toplevel, repo_path),
+                      'rb') as working_file:
+                for chunk in iter(lambda: working_file.read(65536), b''):
+                    lines += chunk.count(b'\n')
+                    last_byte = chunk[-1:]
+        except (IOError, OSError):
+            return 0
+        if b'\n' != last_byte:
+            lines += 1
+        return lines
 
-        for line in lines:
-            matches = BlameTicket._author_regex.match(line)
-            if matches:
-                line_author = matches.group(1).strip()
-                self.bucket[line_author] += 1
+    def author_ident(self):
+        '''
+        Returns the (name, email) of whoever would author the next commit,
+        which is who uncommitted changes are credited to, or None if git
+        doesn't know. The email is in angle brackets, as git-blame shows it.
+        '''
+        try:
+            ident = self.run_git(['var', 'GIT_AUTHOR_IDENT'])[0]
+        except (GitError, ValueError):
+            return None
+        # NAME <EMAIL> TIMESTAMP TIMEZONE
+        name, _, email = ident.rsplit(' ', 2)[0].partition(' <')
+        return (name, '<' + email)
+
+    def rev_parse(self, rev):
+        '''
+        Returns the full ID of the commit rev points to
+        '''
+        return self.run_git(
+            ['rev-parse', '--verify', '--quiet', rev + '^{commit}']
+        )[0].strip()
 
+    def is_commit(self, rev):
+        '''
+        Tells whether rev names a commit
+        '''
+        try:
+            self.rev_parse(rev)
+        except (GitError, ValueError):
+            return False
+        return True
 
-class BinaryBlameTicket(BlameTicket):
-    def __init__(self, runner, bucket, versioned_file, args):
-        super(BinaryBlameTicket, self).__init__(bucket, versioned_file, args)
-        self.runner = runner
+    def get_config(self, key):
+        '''
+        Returns the value of a Git configuration variable, or None if it
+        isn't set
+        '''
+        try:
+            return self.run_git(['config', '--get', key])[0].strip()
+        except (GitError, ValueError):
+            return None
 
-        binary_git_config_dict = dict()
-        binary_git_config_dict['diff.binary_blame.textconv'] = 'xxd -p -c1'
-        binary_git_config_dict['diff.binary_blame.cachetextconv'] = 'true'
+    def is_shallow(self):
+        '''
+        Tells whether the repository is a shallow clone, whose history is cut
+        short. Git versions that can't tell are assumed to have a full clone.
+        '''
+        if self.version < GitRunner._min_shallow_query_ver:
+            return False
+        return 'true' == self.run_git(
+            ['rev-parse', '--is-shallow-repository']
+        )[0].strip()
 
-        self.config_pairs.update(binary_git_config_dict)
-        self.temp_gitattributes_file = None
+    def count_objects(self):
+        '''
+        Returns the statistics of git-count-objects about loose and packed
+        objects, eg. `count` and `packs`, as a dictionary of integers. Sizes
+        are in KiB.
+        '''
+        stats = dict()
+        for line in self.run_git(['count-objects', '-v']):
+            key, _, value = line.partition(':')
+            try:
+                stats[key.strip()] = int(value)
+            except ValueError:
+                continue
+        return stats
 
-    def __repr__(self):
-        return "<BinaryBlame {rev}:\"{path}\">".format(
-            rev=self.versioned_file.git_revision,
-            path=self.versioned_file.repo_path,
+    def commit_graph_state(self):
+        '''
+        Returns the number of commit-graph files the repository has, whether
+        as a single file or a chain of them, and how many of those hold
+        changed-path Bloom filters
+        '''
+        info_dir = os.path.join(
+            self._git_toplevel,
+            self.run_git(['rev-parse', '--git-path', 'objects/info'])[0]
         )
+        graph_files = [os.path.join(info_dir, 'commit-graph')]
+        chain_dir = os.path.join(info_dir, 'commit-graphs')
+        try:
+            with open(os.path.join(chain_dir, 'commit-graph-chain')) as chain:
+                graph_files.extend(
+                    os.path.join(chain_dir, 'graph-{0}.graph'.format(
+                        graph_id.strip()
+                    ))
+                    for graph_id in chain if graph_id.strip()
+                )
+        except (IOError, OSError):
+            pass
+
+        graphs = 0
+        bloom_graphs = 0
+        for graph_file in graph_files:
+            chunks = GitRunner._commit_graph_chunks(graph_file)
+            if chunks is None:
+                continue
+            graphs += 1
+            if GitRunner._bloom_chunk in chunks:
+                bloom_graphs += 1
+        return graphs, bloom_graphs
 
-    def process(self):
+    @staticmethod
+    def _commit_graph_chunks(graph_file):
         '''
-        Updates the bucket with a tally of the ownership of bytes in this
-        binary file
+        Returns the set of chunk IDs in the table of contents of a
+        commit-graph file, or None if there's no such file
         '''
+        import struct
 
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            try:
-                # We need to prepare the gitattributes file
-                temp_file.write(
-                    ("{binary_path} diff=binary_blame".format(
-                        binary_path=self.versioned_file.repo_path
-                    ) + os.linesep).encode('utf_8')
-                )
-                temp_file.flush()
-                self.config_pairs.update({
-                    'core.attributesfile': temp_file.name
-                })
-                lines = self.runner.run_git(
-                    self.blame_args(),
-                    git_env=self.blame_env()
-                )
-            except GitError as ge:
-                if 'no such path ' in str(ge):
+        try:
+            with open(graph_file, 'rb') as graph:
+                # Signature, version, hash version, chunk count, base count
+                header = graph.read(8)
+                if 8 != len(header) or b'CGPH' != header[:4]:
                     return None
-                else:
-                    raise ge
-            except ValueError as ve:
-                # Not having any output is actually OK if we have an empty file
-                if 'no output' in str(ve).lower():
-                    return
+                chunk_count = struct.unpack('B', header[6:7])[0]
+                # Every entry is a chunk ID and an 8-byte offset
+                table = graph.read(12 * chunk_count)
+        except (IOError, OSError):
+            return None
+        return set(
+            table[index:index + 4] for index in range(0, len(table), 12)
+        )
 
-        for line in lines:
-            matches = BlameTicket._author_regex.match(line)
-            if matches:
-                line_author = matches.group(1).strip()
-                self.bucket[line_author] += 1
+    def write_commit_graph(self):
+        '''
+        Writes a commit-graph of every reachable commit with changed-path
+        Bloom filters, which let git-blame and git-log skip commits that
+        didn't touch a path without opening their trees
+        '''
+        try:
+            self.run_git([
+                'commit-graph', 'write', '--reachable', '--changed-paths',
+                '--no-progress'
+            ])
+        except ValueError:
+            # Nothing is written on stdout
+            pass
+
+    def is_ancestor(self, ancestor, rev):
+        '''
+        Tells whether the commit `ancestor` can be reached from `rev`
+        '''
+        try:
+            self.run_git(['merge-base', '--is-ancestor', ancestor, rev])
+        except ValueError:
+            # Nothing is written on stdout either way
+            return True
+        except GitError:
+            return False
+        return True
 
+    def changed_paths(self, since_rev, until_rev, pathspecs=None):
+        '''
+        Returns the set of paths whose content differs between since_rev and
+        until_rev, without diffing the content of any file
+        '''
+        diff_args = [
+            'diff', '-z', '--name-only', '--no-renames', since_rev, until_rev
+        ]
+        if pathspecs:
+            diff_args.append('--')
+            diff_args.extend(pathspecs)
+        return set(path for path in self.iter_git(diff_args) if path)
 
-class Formatter(object):
-    _CSI = r'['
+    def renamed_paths(self, commit_ids):
+        '''
+        Returns the set of paths the given commits renamed files to, as
+        detected by a single git-diff-tree process
+        '''
+        commit_ids = set(commit_ids)
+        if not commit_ids:
+            return set()
+        try:
+            output = self.run_git(
+                [
+                    'diff-tree', '--stdin', '--no-commit-id', '-z', '-r',
+                    '-M', '--diff-filter=R', '--name-status'
+                ],
+                stdin_data=''.join(
+                    commit_id + '\n' for commit_id in commit_ids
+                ),
+                decode=False
+            )
+        except ValueError:
+            return set()
+        # Every rename takes three fields: STATUS\0OLD_PATH\0NEW_PATH\0
+        return set(
+            path.decode('utf_8') for path in output.split(b'\0')[2::3]
+        )
+
+    def is_first_parent_ancestor(self, ancestor, rev):
+        '''
+        Tells whether the commit `ancestor` can be reached from `rev` by only
+        ever following first parents, ie. whether it's on the main line of
+        rev's history.
+        '''
+        ancestor_id = self.rev_parse(ancestor)
+        try:
+            lines = self.run_git([
+                'rev-list', '--first-parent', '--parents',
+                '{0}..{1}'.format(ancestor, rev)
+            ])
+        except ValueError:
+            # rev is ancestor, or one of its ancestors
+            return self.rev_parse(rev) == ancestor_id
+        # The oldest commit on the main line since ancestor must be one of its
+        # children
+        return lines[-1].split()[1:2] == [ancestor_id]
+
+    def has_merges(self, since_rev, until_rev):
+        '''
+        Tells whether any commit on the main line of history between since_rev
+        and until_rev is a merge
+        '''
+        try:
+            self.run_git([
+                'rev-list', '--first-parent', '--merges', '-n', '1',
+                '{0}..{1}'.format(since_rev, until_rev)
+            ])
+        except ValueError:
+            return False
+        return True
+
+    def last_author(self, repo_path, rev, email=False):
+        '''
+        Returns the author of the last commit that modified repo_path as of
+        rev, the way git-blame would show them. In the working tree, where rev
+        is None, that's whoever would commit the changes.
+        '''
+        if rev is None:
+            ident = self.author_ident()
+            return ident and ident[1 if email else 0]
+        author_format = '<%aE>' if email else '%aN'
+        try:
+            lines = self.run_git([
+                'log', '-1', '--format=' + author_format, rev, '--', repo_path
+            ])
+        except ValueError:
+            return None
+        return lines[0].strip()
+
+    def populate_tree(self, rev):
+        # We need to detect submodules/non-blobs
+        ls_tree_args = ['ls-tree', '-r', '--', rev]
+        paths = set()
+
+        lines = self.run_git(ls_tree_args)
+        for line in lines:
+            _, object_type, _ = line.split('\t')[0].split()
+            path = line.split('\t')[1]
+            if 'blob' != object_type:
+                continue
+            paths.add(path)
+
+        return paths
+
+
+class Pygit2Runner(GitRunner):
+    '''
+    Reads objects and diffs trees in-process with pygit2 rather than by
+    running git, which saves creating a process for each of those.
+
+    Everything else goes through `GitRunner`: libgit2's blame knows nothing of
+    textconv filters, and pathspec magic has no libgit2 equivalent, so
+    git-blame, git-log and restricted diffs still run as subprocesses.
+    '''
+    def __init__(self, cwd=None):
+        super(Pygit2Runner, self).__init__(cwd)
+        try:
+            import pygit2
+        except ImportError:
+            raise GitError("The pygit2 backend needs pygit2 to be installed")
+        self._pygit2 = pygit2
+        self._repo = pygit2.Repository(self._git_toplevel)
+        # libgit2 objects mustn't be used by several threads at once
+        self._repo_lock = threading.Lock()
+
+    def _peel(self, rev, object_type):
+        try:
+            return self._repo.revparse_single(rev).peel(object_type)
+        except (KeyError, ValueError):
+            raise GitError("Unknown revision '{0}'".format(rev))
+
+    def rev_parse(self, rev):
+        with self._repo_lock:
+            return str(self._peel(rev, self._pygit2.Commit).id)
+
+    @staticmethod
+    def _blob_id(diff_file):
+        if '{0:o}'.format(diff_file.mode) in ChangedFile.blob_modes:
+            return str(diff_file.id)
+        return None
+
+    def iter_delta_files(self, since_rev, until_rev, pathspecs=None):
+        if pathspecs or not until_rev:
+            for changed_file in super(Pygit2Runner, self).iter_delta_files(
+                    since_rev, until_rev, pathspecs):
+                yield changed_file
+            return
+
+        with self._repo_lock:
+            diff = self._repo.diff(
+                self._peel(since_rev, self._pygit2.Tree),
+                self._peel(until_rev, self._pygit2.Tree),
+            )
+            changed_files = list()
+            # Binary files are only told apart once their patch is generated
+            for patch in diff:
+                old_file = patch.delta.old_file
+                new_file = patch.delta.new_file
+                changed_files.append(ChangedFile(
+                    new_file.path,
+                    patch.delta.is_binary,
+                    Pygit2Runner._blob_id(old_file),
+                    Pygit2Runner._blob_id(new_file),
+                    old_file.size,
+                    new_file.size,
+                    additions=None if patch.delta.is_binary
+                    else patch.line_stats[1],
+                ))
+        lfs_sizes = self.get_lfs_sizes(
+            blob_id
+            for changed_file in changed_files
+            for blob_id, size in (
+                (changed_file.since_blob, changed_file.since_size),
+                (changed_file.until_blob, changed_file.until_size),
+            )
+            if blob_id and size < GitRunner._max_lfs_pointer_size
+        )
+        for changed_file in changed_files:
+            changed_file.since_lfs_size = \
+                lfs_sizes.get(changed_file.since_blob)
+            changed_file.until_lfs_size = \
+                lfs_sizes.get(changed_file.until_blob)
+        changed_files.sort(key=lambda changed_file: -changed_file.cost())
+        for changed_file in changed_files:
+            yield changed_file
+
+    def get_blob_sizes(self, blob_ids):
+        sizes = dict()
+        with self._repo_lock:
+            for blob_id in set(blob_ids):
+                try:
+                    sizes[blob_id] = self._repo[blob_id].size
+                except (KeyError, ValueError):
+                    continue
+        return sizes
+
+    def get_lfs_sizes(self, blob_ids):
+        sizes = dict()
+        with self._repo_lock:
+            for blob_id in set(blob_ids):
+                try:
+                    size = GitRunner.lfs_pointer_size(self._repo[blob_id].data)
+                except (KeyError, ValueError):
+                    continue
+                if size is not None:
+                    sizes[blob_id] = size
+        return sizes
+
+    def count_lines(self, blob_id):
+        # Blobs expose their content through the buffer protocol, so it's
+        # counted a chunk at a time rather than copied whole by Blob.data
+        with self._repo_lock:
+            content = memoryview(self._repo[blob_id])
+        lines = 0
+        for start in range(0, len(content), 65536):
+            lines += content[start:start + 65536].tobytes().count(b'\n')
+        if len(content) and b'\n' != content[-1:].tobytes():
+            lines += 1
+        return lines
+
+
+class ChangedFile(object):
+    '''
+    A file that differs between the since and until revisions, along with the
+    ID and size of its blob in either. The blob ID is None for revisions where
+    the path isn't a regular file (ie. something we can blame), and empty for
+    changes in the working tree that git hasn't hashed yet.
+
+    For revisions where the file is a Git LFS pointer, the size of the object
+    it points to is given too, and for text files the number of lines added
+    between the revisions.
+    '''
+    __slots__ = (
+        'repo_path', 'is_binary', 'since_blob', 'until_blob', 'since_size',
+        'until_size', 'since_lfs_size', 'until_lfs_size', 'additions'
+    )
+
+    # Gitlinks (160000) and missing files (000000) aren't blobs
+    blob_modes = frozenset(['100644', '100755', '120000'])
+
+    def __init__(self, path, is_binary, since_blob, until_blob, since_size=0,
+                 until_size=0, since_lfs_size=None, until_lfs_size=None,
+                 additions=None):
+        self.repo_path = path
+        self.is_binary = is_binary
+        self.since_blob = since_blob
+        self.until_blob = until_blob
+        self.since_size = since_size
+        self.until_size = until_size
+        self.since_lfs_size = since_lfs_size
+        self.until_lfs_size = until_lfs_size
+        self.additions = additions
+
+    def __repr__(self):
+        return "<ChangedFile {path}{binary}>".format(
+            path=self.repo_path,
+            binary=' (binary)' if self.is_binary else ''
+        )
+
+    @property
+    def in_since(self):
+        return self.since_blob is not None
+
+    @property
+    def in_until(self):
+        return self.until_blob is not None
+
+    @property
+    def is_lfs(self):
+        return self.since_lfs_size is not None or \
+            self.until_lfs_size is not None
+
+    def cost(self):
+        '''
+        Returns an estimate of how long blaming the file in both revisions
+        will take, as the cost of its tickets would put it
+        '''
+        if self.is_lfs:
+            ticket_type = LfsBlameTicket
+        elif self.is_binary:
+            ticket_type = BinaryBlameTicket
+        else:
+            ticket_type = TextBlameTicket
+        return (self.since_size + self.until_size) * ticket_type._cost_per_byte
+
+
+class FileChurn(object):
+    '''
+    The change a single commit made to a file: the lines added and removed
+    for text files, and the blobs before and after for binary ones.
+    '''
+    __slots__ = (
+        'author', 'repo_path', 'is_binary', 'additions', 'deletions',
+        'old_blob', 'new_blob'
+    )
+
+    def __init__(self, author, path, is_binary, additions=0, deletions=0,
+                 old_blob=None, new_blob=None):
+        self.author = author
+        self.repo_path = path
+        self.is_binary = is_binary
+        self.additions = additions
+        self.deletions = deletions
+        self.old_blob = old_blob
+        self.new_blob = new_blob
+
+    def __repr__(self):
+        return "<FileChurn {path} by {author}: +{add} -{delete}>".format(
+            path=self.repo_path,
+            author=self.author,
+            add=self.additions,
+            delete=self.deletions,
+        )
+
+
+class FileSample(object):
+    '''
+    A changed file picked at random when sampling, with ownership buckets of
+    its own and the size of the stratum it was picked from.
+    '''
+    __slots__ = (
+        'changed_file', 'stratum', 'population', 'since_bucket', 'until_bucket'
+    )
+
+    def __init__(self, changed_file, stratum, population):
+        self.changed_file = changed_file
+        self.stratum = stratum
+        self.population = population
+        self.since_bucket = collections.defaultdict(int)
+        self.until_bucket = collections.defaultdict(int)
+
+    def __repr__(self):
+        return "<FileSample {path} ({stratum} of {population})>".format(
+            path=self.changed_file.repo_path,
+            stratum=self.stratum,
+            population=self.population,
+        )
+
+
+class VersionedFile(object):
+    __slots__ = ('repo_path', 'git_revision', 'blob_id', 'size', 'lines')
+
+    def __init__(self, path, revision, blob_id=None, size=0, lines=None):
+        self.repo_path = path
+        self.git_revision = revision
+        self.blob_id = blob_id
+        self.size = size
+        # The number of lines blamed for this file, if we know it
+        self.lines = lines
+
+    def __repr__(self):
+        return "<VersionedFile {rev}:{path}>".format(
+            rev=self.git_revision,
+            path=self.repo_path
+        )
+
+    def __eq__(self, rhs):
+        return (rhs.repo_path and rhs.repo_path) == self.repo_path and \
+            (rhs.git_revision and rhs.git_revision) == self.git_revision
+
+
+class BlameTicket(object):
+    '''A queued blame. This is a TODO item, really'''
+    __slots__ = (
+        'runner', 'bucket', 'versioned_file', 'args', 'line_range', 'degraded',
+        'tallied'
+    )
+    # Matches every entry of incremental git-blame output, which is scanned
+    # as a whole: the commit ID and number of lines, followed by the author
+    # the first time the commit is seen
+    _entry_regex = re.compile(
+        br'^([0-9a-f]{40,64}) \d+ \d+ (\d+)\n'
+        br'(?:author (.*)\nauthor-mail (.*)$)?',
+        re.MULTILINE
+    )
+    # Author names decoded from git-blame output, by their encoded form, so
+    # that every name is only decoded once a run and shared by all buckets
+    _author_names = dict()
+
+    # Git configuration passed to every blame of a given ticket type. This is
+    # shared by all instances rather than copied into each ticket, since we
+    # may queue several hundred thousand of them
+    config_pairs = (
+        ('user.name', 'foo'),
+        ('user.email', 'bar@example.com'),
+    )
+    # Git configuration blames are run with on top of those, as chosen with
+    # --git-profile. The bulk profile suits running many blames at once: it
+    # keeps more delta bases in memory, since consecutive revisions of a
+    # file are usually stored as deltas of one another, and makes sure
+    # commit-graphs are used. Text files are also blamed without textconv
+    # filters under that profile. Neither profile isolates blames from the
+    # user's global and repository configuration, which Git still reads:
+    # these only take precedence over it.
+    config_profiles = {
+        'none': (),
+        'bulk': (
+            ('core.commitGraph', 'true'),
+            ('core.deltaBaseCacheSize', '256m'),
+        ),
+    }
+    _bucket_lock = threading.Lock()
+    _cost_per_byte = 1
+    # Who gets the blame for files we couldn't find an author for
+    unattributed = u'(unattributed)'
+
+    def __init__(self, runner, bucket, versioned_file, args,
+                 line_range=None):
+
+        # The GitRunner of the repository the file is in
+        self.runner = runner
+        self.bucket = bucket
+        self.versioned_file = versioned_file
+        self.args = args
+        # An optional (first, last) tuple of 1-based line numbers, for tickets
+        # that only blame part of a file
+        self.line_range = line_range
+        # Why the ownership of the file was approximated rather than blamed,
+        # if it was
+        self.degraded = None
+        # How many lines each author was blamed for, once processed
+        self.tallied = None
+
+    def __eq__(self, blame):
+        return (self.bucket is blame.bucket) \
+            and (self.versioned_file == blame.versioned_file) \
+            and (self.bucket == blame.bucket) \
+            and (self.line_range == blame.line_range)
+
+    def describe(self):
+        description = "{rev}:\"{path}\"".format(
+            rev=self.versioned_file.git_revision or 'working tree',
+            path=self.versioned_file.repo_path,
+        )
+        if self.line_range:
+            description += " L{0},{1}".format(*self.line_range)
+        return description
+
+    def cost(self):
+        '''
+        Returns an estimate of how long this blame will take, relative to other
+        tickets, from the size of the blob being blamed.
+        '''
+        cost = self.versioned_file.size * self._cost_per_byte
+        if self.line_range and self.versioned_file.lines:
+            first, last = self.line_range
+            cost = cost * (last - first + 1) // self.versioned_file.lines
+        return cost
+
+    def _over_size_budget(self):
+        max_bytes = self.args.max_file_bytes
+        return bool(max_bytes) and self.versioned_file.size > max_bytes
+
+    def _blame_timeout(self):
+        return self.args.max_blame_seconds or None
+
+    def _count_units(self):
+        '''
+        Returns the number of lines or bytes this ticket accounts for, which
+        is the size of the file unless the ticket's units are lines
+        '''
+        return self.versioned_file.size
+
+    def degrade(self, reason):
+        '''
+        Credits everything in this ticket to the author of the last commit
+        that modified the file, instead of running git-blame. This is much
+        cheaper, but only approximates the file's ownership.
+        '''
+        self.degraded = reason
+        if self.line_range:
+            first, last = self.line_range
+            count = last - first + 1
+        else:
+            count = self._count_units()
+
+        author = self.runner.last_author(
+            self.versioned_file.repo_path,
+            self.versioned_file.git_revision,
+            self.args.email
+        ) or BlameTicket.unattributed
+        self.credit({author: count})
+
+    def tally(self, output):
+        '''
+        Counts the lines of incremental blame output attributed to each author
+        and adds the totals to the bucket. Tickets may be processed
+        concurrently, so the shared bucket is only touched once, under a lock.
+
+        Lines are counted by commit, and commits are only resolved to their
+        author once counted, through the runner's table of commit authors.
+        Authors are only parsed from the output for commits that aren't in
+        the table yet.
+        '''
+        commit_authors = self.runner.commit_authors
+        counts = collections.defaultdict(int)
+        for commit_id, line_count, name, email in \
+                BlameTicket._entry_regex.findall(output):
+            counts[commit_id] += int(line_count)
+            if name and commit_id not in commit_authors:
+                commit_authors[commit_id] = (
+                    BlameTicket._author_name(name),
+                    BlameTicket._author_name(email),
+                )
+
+        unattributed = (BlameTicket.unattributed, BlameTicket.unattributed)
+        tally = collections.defaultdict(int)
+        for commit_id, count in counts.items():
+            name, email = commit_authors.get(commit_id, unattributed)
+            tally[email if self.args.email else name] += count
+        self.credit(tally)
+
+    @staticmethod
+    def _author_name(encoded_name):
+        '''
+        Returns the decoded form of a name read from git-blame output. The
+        file's content may be in any encoding at all, so only names are
+        decoded, once a run each.
+        '''
+        name = BlameTicket._author_names.get(encoded_name)
+        if name is None:
+            name = BlameTicket._author_names.setdefault(
+                encoded_name, encoded_name.decode('utf_8', 'replace')
+            )
+        return name
+
+    def credit(self, tally):
+        '''
+        Adds the number of lines or bytes blamed on every author to the bucket
+        '''
+        with BlameTicket._bucket_lock:
+            for author, count in tally.items():
+                self.bucket[author] += count
+        self.tallied = tally
+
+    @classmethod
+    def _format_config(cls, extra_pairs=None):
+        config_pairs = dict(cls.config_pairs)
+        if extra_pairs:
+            config_pairs.update(extra_pairs)
+
+        git_config_params = list()
+        for key, value in sorted(config_pairs.items()):
+            git_config_params.append("'{config_key}={config_value}'".format(
+                config_key=key,
+                # Git unquotes these like a shell would
+                config_value=value.replace("'", "'\\''")
+            ))
+        return ' '.join(git_config_params)
+
+    def blame_args(self):
+        # Incremental output only has a line per run of lines from the same
+        # commit, and none for the content of the file. Authors' emails are
+        # always part of it.
+        blame_args = [
+            'blame',
+            '--incremental',
+            '--encoding=utf-8',
+            '--',
+            self.versioned_file.repo_path
+        ]
+
+        if self.line_range:
+            blame_args.insert(1, '-L{0},{1}'.format(*self.line_range))
+        if self.versioned_file.git_revision:
+            blame_args.append(self.versioned_file.git_revision)
+        else:
+            # The working tree's copy of the file, on top of HEAD. Lines that
+            # aren't committed yet are blamed on the null commit.
+            blame_args[1:1] = ['--contents', self.versioned_file.repo_path]
+        return blame_args
+
+    @classmethod
+    def blame_env(cls, extra_pairs=None):
+        # Only the system-wide configuration is skipped. The user's global
+        # and the repository's configuration apply, below our own pairs.
+        environment = dict()
+        if cls.config_pairs or extra_pairs:
+            environment['GIT_CONFIG_PARAMETERS'] = \
+                cls._format_config(extra_pairs)
+        environment['GIT_CONFIG_NOSYSTEM'] = 'true'
+        return environment
+
+
+class TextBlameTicket(BlameTicket):
+    __slots__ = ()
+
+    def __init__(self, runner, bucket, versioned_file, args,
+                 line_range=None):
+        super(TextBlameTicket, self).__init__(
+            runner, bucket, versioned_file, args, line_range
+        )
+
+    def __repr__(self):
+        return "<TextBlame {0}>".format(self.describe())
+
+    def blame_args(self):
+        blame_args = super(TextBlameTicket, self).blame_args()
+        if 'none' != self.args.git_profile:
+            blame_args.insert(1, '--no-textconv')
+        return blame_args
+
+    def _count_units(self):
+        if self.versioned_file.lines is None:
+            if self.versioned_file.git_revision is None:
+                self.versioned_file.lines = \
+                    self.runner.count_working_tree_lines(
+                        self.versioned_file.repo_path
+                    )
+            elif not self.versioned_file.blob_id:
+                return 0
+            else:
+                self.versioned_file.lines = self.runner.count_lines(
+                    self.versioned_file.blob_id
+                )
+        return self.versioned_file.lines
+
+    def process(self):
+        '''
+        Updates the bucket with a tally of the ownership of LOCs in this file
+        '''
+
+        if self._over_size_budget():
+            self.degrade('over {0} bytes'.format(self.args.max_file_bytes))
+            return None
+
+        try:
+            # The file's content isn't necessarily UTF-8 encoded, or even
+            # text, should git mistake a binary file for one, so the output
+            # is left undecoded
+            output = self.runner.run_git(
+                self.blame_args(),
+                git_env=self.blame_env(self.args.git_config),
+                timeout=self._blame_timeout(),
+                decode=False
+            )
+        except GitTimeout:
+            self.degrade('blame took over {0}s'.format(
+                self.args.max_blame_seconds
+            ))
+            return None
+        except GitError as ge:
+            if 'no such path ' in str(ge):
+                return None
+            else:
+                raise ge
+        except ValueError as ve:
+            # Not having any output is actually OK if we have an empty file
+            if 'no output' in str(ve).lower():
+                return
+
+        self.tally(output)
+
+
+class BinaryBlameTicket(BlameTicket):
+    __slots__ = ()
+
+    _textconv = 'xxd -p -c1'
+    config_pairs = BlameTicket.config_pairs + (
+        ('diff.binary_blame.textconv', _textconv),
+    )
+    # Looks the file up in the cache directory by blob ID, and converts it
+    # there if it's missing. Entries are written under a temporary name then
+    # renamed, so that concurrent conversions never see partial ones. Should
+    # the cache be unusable, the file is converted without it.
+    _cached_textconv = (
+        'f() {{ e=; id=$(git hash-object --no-filters -- "$1") && '
+        'e={directory}/$id && {{ cat "$e" 2>/dev/null || '
+        '{{ {textconv} "$1" >"$e.$$" && mv -f "$e.$$" "$e" && cat "$e"; }} '
+        '2>/dev/null; }} || {{ [ -z "$e" ] || rm -f "$e.$$"; '
+        '{textconv} "$1"; }}; }}; f'
+    )
+    # git only hands textconv filters a temporary copy of the blob, so the
+    # cache has to hash it with an extra process on every lookup. Below this
+    # size, converting the file again is quicker than a cache hit.
+    _min_cached_size = 128 * 1024
+    # Binary files are only ever blamed by binary tickets, so the attribute
+    # may as well apply to every path
+    _attributes = '* diff=binary_blame\n'
+    # The environment of every binary blame, by textconv cache directory
+    _prepared_envs = dict()
+    _prepared_envs_lock = threading.Lock()
+    # The textconv filter turns every byte into a line of its own, whereas a
+    # line of source code is a few dozen bytes long
+    _cost_per_byte = 32
+
+    def __init__(self, runner, bucket, versioned_file, args,
+                 line_range=None):
+        super(BinaryBlameTicket, self).__init__(
+            runner, bucket, versioned_file, args, line_range
+        )
+
+    def __repr__(self):
+        return "<BinaryBlame {0}>".format(self.describe())
+
+    @classmethod
+    def textconv_command(cls, cache_directory):
+        '''
+        Returns the textconv command that caches conversions in
+        cache_directory, rather than as notes in the repository
+        '''
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote
+        return cls._cached_textconv.format(
+            directory=quote(cache_directory),
+            textconv=cls._textconv,
+        )
+
+    @classmethod
+    def prepared_env(cls, textconv_cache=None, git_config=()):
+        '''
+        Returns the environment to run git-blame in, which is the same for
+        every binary file, so that it's only prepared once per run
+        '''
+        key = (textconv_cache, git_config)
+        with cls._prepared_envs_lock:
+            env = cls._prepared_envs.get(key)
+            if env is None:
+                config = dict(git_config)
+                config['core.attributesfile'] = cls._attributes_file()
+                if textconv_cache:
+                    config['diff.binary_blame.textconv'] = \
+                        cls.textconv_command(textconv_cache)
+                env = cls._prepared_envs[key] = cls.blame_env(config)
+            return env
+
+    @classmethod
+    def _attributes_file(cls):
+        '''
+        Returns the path to a gitattributes file that has binary files blamed
+        through our textconv filter. The file is kept in the git-guilt cache
+        directory, or in a temporary file if that can't be written to.
+        '''
+        attributes_file = os.path.join(cache_dir(), 'binary.gitattributes')
+        try:
+            with open(attributes_file) as attributes:
+                if cls._attributes == attributes.read():
+                    return attributes_file
+        except (IOError, OSError):
+            pass
+
+        try:
+            if not os.path.isdir(os.path.dirname(attributes_file)):
+                os.makedirs(os.path.dirname(attributes_file))
+            # Concurrent runs may be reading it
+            temp_file = '{0}.{1}'.format(attributes_file, os.getpid())
+            with open(temp_file, 'w') as attributes:
+                attributes.write(cls._attributes)
+            os.rename(temp_file, attributes_file)
+            return attributes_file
+        except (IOError, OSError):
+            import atexit
+            import tempfile
+
+            handle, attributes_file = tempfile.mkstemp(
+                suffix='.gitattributes'
+            )
+            os.write(handle, cls._attributes.encode('utf_8'))
+            os.close(handle)
+            atexit.register(os.unlink, attributes_file)
+            return attributes_file
+
+    def process(self):
+        '''
+        Updates the bucket with a tally of the ownership of bytes in this
+        binary file
+        '''
+
+        if self._over_size_budget():
+            self.degrade('over {0} bytes'.format(self.args.max_file_bytes))
+            return None
+
+        textconv_cache = self.args.textconv_cache
+        if self.versioned_file.size < BinaryBlameTicket._min_cached_size:
+            textconv_cache = None
+
+        try:
+            output = self.runner.run_git(
+                self.blame_args(),
+                git_env=self.prepared_env(
+                    textconv_cache, self.args.git_config
+                ),
+                timeout=self._blame_timeout(),
+                decode=False
+            )
+        except GitTimeout:
+            self.degrade('blame took over {0}s'.format(
+                self.args.max_blame_seconds
+            ))
+            return None
+        except GitError as ge:
+            if 'no such path ' in str(ge):
+                return None
+            else:
+                raise ge
+        except ValueError as ve:
+            # Not having any output is actually OK if we have an empty file
+            if 'no output' in str(ve).lower():
+                return
+
+        self.tally(output)
+
+
+class LfsBlameTicket(BlameTicket):
+    '''
+    Credits the whole of a Git LFS object to the author of the last commit
+    that changed its pointer file. There's nothing to blame byte by byte
+    without fetching the object, and objects are replaced wholesale anyway.
+    '''
+    __slots__ = ()
+
+    # Only git-log is run, however large the object
+    _cost_per_byte = 0
+
+    def __init__(self, runner, bucket, versioned_file, args,
+                 line_range=None):
+        super(LfsBlameTicket, self).__init__(
+            runner, bucket, versioned_file, args, line_range
+        )
+
+    def __repr__(self):
+        return "<LfsBlame {0}>".format(self.describe())
+
+    def process(self):
+        '''
+        Updates the bucket with the size of the LFS object
+        '''
+        author = self.runner.last_author(
+            self.versioned_file.repo_path,
+            self.versioned_file.git_revision,
+            self.args.email
+        ) or BlameTicket.unattributed
+        self.credit({author: self.versioned_file.size})
+
+
+class SingleAuthorTicket(BlameTicket):
+    '''
+    Credits every line of a file to the author of the only commit that
+    touched it, which git-blame would do too, only at great expense for large
+    generated or vendored files.
+    '''
+    __slots__ = ('author',)
+
+    _cost_per_byte = 0
+
+    def __init__(self, runner, bucket, versioned_file, args, author):
+        super(SingleAuthorTicket, self).__init__(
+            runner, bucket, versioned_file, args
+        )
+        self.author = author
+
+    def __repr__(self):
+        return "<SingleAuthor {0}>".format(self.describe())
+
+    def _count_units(self):
+        return self.versioned_file.lines
+
+    def process(self):
+        '''
+        Updates the bucket with the lines of the file
+        '''
+        self.credit({self.author: self.versioned_file.lines})
+
+
+class HistoryWalk(object):
+    '''
+    Blames many text files at once by replaying the history that leads to the
+    until revision, instead of running git-blame for every file. git-blame
+    walks the history once per file, whereas this walks it once for all of
+    them, keeping track of the author of every line of every file as it
+    goes.
+
+    Only the main line of history is followed, and lines brought in by a merge
+    would be credited to whoever made the merge, rather than to whoever wrote
+    them on the merged branch as git-blame does. Ranges with merges are
+    therefore blamed file by file instead, and files touched by a merge before
+    the since revision are blamed the usual way. So are files that were
+    renamed, since the walk doesn't detect renames and would credit all their
+    lines to whoever renamed them, whereas git-blame follows them.
+
+    The walk is queued like any other ticket, so binary files are blamed
+    alongside it.
+    '''
+    __slots__ = ('runner', 'args', 'pathspecs', 'targets', 'degraded')
+
+    _hunk_regex = re.compile(br'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+    # Restricting git-log to more files than this would make for an unwieldy
+    # command line, so we filter them ourselves instead
+    _max_pathspecs = 1000
+    _escapes = {
+        'a': b'\a', 'b': b'\b', 't': b'\t', 'n': b'\n', 'v': b'\v', 'f': b'\f',
+        'r': b'\r', '"': b'"', '\\': b'\\',
+    }
+
+    def __init__(self, runner, args, pathspecs=None):
+        self.runner = runner
+        self.args = args
+        self.pathspecs = pathspecs
+        # The ChangedFile and since/until buckets of every file, by path
+        self.targets = dict()
+        self.degraded = None
+
+    def __repr__(self):
+        return "<HistoryWalk {0}>".format(self.describe())
+
+    def add(self, changed_file, since_bucket, until_bucket):
+        self.targets[changed_file.repo_path] = \
+            (changed_file, since_bucket, until_bucket)
+
+    def describe(self):
+        return "history of {0} files".format(len(self.targets))
+
+    def cost(self):
+        return sum(
+            changed_file.since_size + changed_file.until_size
+            for changed_file, _, _ in self.targets.values()
+        )
+
+    @staticmethod
+    def unquote_path(path):
+        '''
+        Undoes the C-style quoting git applies to paths with unusual
+        characters in diff headers
+        '''
+        if not path.startswith('"'):
+            return path
+        unquoted = bytearray()
+        chars = iter(path[1:-1])
+        for char in chars:
+            if '\\' != char:
+                unquoted.extend(char.encode('utf_8'))
+                continue
+            char = next(chars)
+            if char in HistoryWalk._escapes:
+                unquoted.extend(HistoryWalk._escapes[char])
+            else:
+                # An octal escape for a byte of a UTF-8 encoded character
+                unquoted.append(int(char + next(chars) + next(chars), 8))
+        return bytes(unquoted).decode('utf_8')
+
+    @staticmethod
+    def _diff_path(header):
+        '''
+        Returns the path in a "diff --git a/PATH b/PATH" header. Both paths are
+        the same, since renames aren't detected.
+        '''
+        paths = header[len('diff --git '):]
+        path = HistoryWalk.unquote_path(paths[:(len(paths) - 1) // 2])
+        return path[2:]
+
+    @staticmethod
+    def apply_hunks(lines, hunks, author):
+        '''
+        Returns the authors of the lines of a file after a change, given those
+        before it and the hunks of a diff without context lines. Raises
+        ValueError if the hunks don't fit.
+        '''
+        changed = list()
+        position = 0
+        for old_start, old_count, new_count in hunks:
+            # Hunks that only add lines start at the line they're added after
+            start = old_start - 1 if old_count else old_start
+            if start < position or start + old_count > len(lines):
+                raise ValueError("Hunk out of range")
+            changed.extend(lines[position:start])
+            changed.extend([author] * new_count)
+            position = start + old_count
+        changed.extend(lines[position:])
+        return changed
+
+    def log_args(self, revisions):
+        author_format = '<%aE>' if self.args.email else '%aN'
+        log_args = [
+            'log', '--reverse', '--first-parent', '-m', '-p', '-U0',
+            '--no-renames', '--no-color', '--no-ext-diff', '--encoding=utf-8',
+            '--src-prefix=a/', '--dst-prefix=b/',
+            '--format=%x01' + author_format + '%x02%H %P',
+            revisions,
+        ]
+        if len(self.targets) <= HistoryWalk._max_pathspecs:
+            log_args.append('--')
+            log_args.extend(
+                ':(top,literal)' + path for path in sorted(self.targets)
+            )
+        elif self.pathspecs:
+            log_args.append('--')
+            log_args.extend(self.pathspecs)
+        return log_args
+
+    def walk(self, revisions, files, opaque, created):
+        '''
+        Replays the commits in `revisions` onto `files`, which maps the paths
+        being tracked to the authors of their lines. Paths whose content we
+        lose track of, eg. because they were binary at some point, are added
+        to `opaque`. The tracked paths each commit created are added to
+        `created`, by commit ID.
+        '''
+        author = None
+        commit_id = None
+        is_merge = False
+        path = None
+        hunks = list()
+
+        def apply_changes():
+            if path is None or path in opaque:
+                return
+            if is_merge:
+                # We can't tell which of the merged lines are whose
+                opaque.add(path)
+                return
+            try:
+                files[path] = HistoryWalk.apply_hunks(
+                    files.get(path, []), hunks, author
+                )
+            except ValueError:
+                opaque.add(path)
+
+        for line in self.runner.iter_git(
+                self.log_args(revisions),
+                git_env=TextBlameTicket.blame_env(self.args.git_config),
+                separator=b'\n',
+                decode=False):
+            if line.startswith(b'@@ -'):
+                if path is not None:
+                    match = HistoryWalk._hunk_regex.match(line)
+                    hunks.append((
+                        int(match.group(1)),
+                        int(match.group(2) or 1),
+                        int(match.group(3) or 1),
+                    ))
+            elif line.startswith(b'diff --git '):
+                apply_changes()
+                hunks = list()
+                path = HistoryWalk._diff_path(line.decode('utf_8'))
+                if path not in self.targets:
+                    path = None
+            elif line.startswith(b'\x01'):
+                apply_changes()
+                path = None
+                # The author, then the IDs of the commit and of its parents
+                author, _, commit_ids = line[1:].partition(b'\x02')
+                author = author.decode('utf_8')
+                commit_ids = commit_ids.decode('utf_8').split()
+                commit_id = commit_ids[0] if commit_ids else None
+                is_merge = 2 < len(commit_ids)
+            elif path is None:
+                continue
+            elif line.startswith(b'new file mode '):
+                files[path] = []
+                if not is_merge:
+                    opaque.discard(path)
+                    created.setdefault(commit_id, set()).add(path)
+            elif line.startswith(b'Binary files '):
+                opaque.add(path)
+        apply_changes()
+
+    def _snapshot(self, files, opaque, rev, side):
+        '''
+        Tallies the ownership of the tracked files as they are in one of the
+        revisions into their buckets. Files we lost track of are blamed the
+        usual way instead.
+        '''
+        for changed_file, since_bucket, until_bucket in self.targets.values():
+            if 'since' == side:
+                blob, size, bucket = (changed_file.since_blob,
+                                      changed_file.since_size, since_bucket)
+            else:
+                blob, size, bucket = (changed_file.until_blob,
+                                      changed_file.until_size, until_bucket)
+            if blob is None:
+                continue
+
+            if changed_file.repo_path in opaque:
+                TextBlameTicket(
+                    self.runner,
+                    bucket,
+                    VersionedFile(changed_file.repo_path, rev, blob, size),
+                    self.args
+                ).process()
+                continue
+
+            tally = collections.defaultdict(int)
+            for author in files.get(changed_file.repo_path, ()):
+                tally[author] += 1
+            with BlameTicket._bucket_lock:
+                for author, count in tally.items():
+                    bucket[author] += count
+
+    def process(self):
+        '''
+        Walks the history up to the since revision, then on to the until
+        revision, tallying the ownership of the files in either along the way
+        '''
+        files = dict()
+        opaque = set()
+        created = dict()
+        self.walk(self.args.since, files, opaque, created)
+        self._lose_renamed(created, opaque)
+        self._snapshot(files, opaque, self.args.since, 'since')
+        created.clear()
+        self.walk(
+            '{0}..{1}'.format(self.args.since, self.args.until),
+            files,
+            opaque,
+            created
+        )
+        self._lose_renamed(created, opaque)
+        self._snapshot(files, opaque, self.args.until, 'until')
+
+    def _lose_renamed(self, created, opaque):
+        '''
+        Adds the tracked paths that the commits in `created` renamed a file to
+        to `opaque`, so that they're blamed the usual way
+        '''
+        created.pop(None, None)
+        try:
+            renamed = self.runner.renamed_paths(created)
+        except GitError:
+            # Eg. git gave up on detecting renames in a huge commit, so any of
+            # the files those commits created may have been renamed
+            renamed = set().union(*created.values())
+        opaque.update(path for path in renamed if path in self.targets)
+
+
+class BlameWorkerPool(object):
+    '''
+    A fixed set of threads that process blame tickets as they are submitted.
+    Blames spend nearly all their time waiting on a git process, so threads
+    are enough to keep several of those running at once.
+
+    Workers share a single priority queue and always pick up the costliest
+    ticket available, so that a huge file doesn't end up being blamed on its
+    own after every other worker has gone idle. The queue is bounded, so
+    submitting blocks while it's full rather than letting the planner run
+    arbitrarily far ahead of the blames.
+
+    Tickets may be submitted on behalf of different shares, eg. repositories,
+    in which case the pool takes turns between shares, by estimated cost,
+    rather than running every ticket of the first share before the others'.
+    A ticket failing only fails its own share: the error is kept in
+    `share_errors` and the share's remaining tickets are skipped, while the
+    other shares carry on.
+
+    The pool also keeps track of how much of the submitted work is done, by
+    estimated cost rather than by number of tickets, for progress reports.
+    '''
+
+    # Enough queued tickets for the costliest to be picked first, without
+    # holding on to every ticket of a huge diff
+    _queued_per_worker = 16
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._tickets = queue.PriorityQueue(
+            maxsize=BlameWorkerPool._queued_per_worker * self.workers
+        )
+        # Breaks ties between tickets of the same cost in submission order,
+        # and ensures tickets never get compared to each other
+        self._sequence = itertools.count()
+        self._error = None
+        # The first exception raised by a ticket of each share
+        self.share_errors = dict()
+        self._cancelled = False
+        self._stats_lock = threading.Lock()
+        # The cost of the tickets submitted for each share so far
+        self._share_costs = collections.defaultdict(int)
+        # Whether all the tickets have been submitted
+        self.planned = False
+        self.submitted_count = 0
+        self.submitted_cost = 0
+        self.completed_cost = 0
+        self.ticket_count = 0
+        self.total_work = 0.0
+        self.longest_job = 0.0
+        self._started = time.time()
+        self.makespan = None
+        # Tickets whose ownership was approximated rather than blamed
+        self.degraded = list()
+        self._threads = list()
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def _work(self):
+        while True:
+            _, negative_cost, _, ticket, share = self._tickets.get()
+            if ticket is None:
+                return
+            if self._error is not None or self._cancelled or \
+                    share in self.share_errors:
+                # Something went wrong already - drain the queue
+                continue
+            job_start = time.time()
+            try:
+                ticket.process()
+            except Exception as ex:  # pylint: disable=broad-except
+                if share is None:
+                    self._error = ex
+                else:
+                    self.share_errors.setdefault(share, ex)
+            job_time = time.time() - job_start
+            with self._stats_lock:
+                if ticket.degraded:
+                    self.degraded.append(ticket)
+                self.ticket_count += 1
+                self.completed_cost -= negative_cost
+                self.total_work += job_time
+                self.longest_job = max(self.longest_job, job_time)
+
+    @staticmethod
+    def _cost(ticket):
+        # Even empty files take some work to blame
+        return ticket.cost() + 1
+
+    @staticmethod
+    def fair_order(shares):
+        '''
+        Yields (share, ticket) pairs for the tickets of every share, given as
+        a list of ticket iterables, in the order the pool takes turns between
+        shares. Submitting them in that order keeps the turns fair although
+        the queue only ever holds a few tickets at a time.
+
+        Tickets are only taken from a share's iterable once it's that share's
+        turn, so shares whose tickets are planned lazily get planned as the
+        pool goes, rather than all of them before the first blame.
+        '''
+        import heapq
+
+        # (cost of the share's tickets so far, share, its remaining tickets)
+        turns = [(0, share, iter(tickets)) for share, tickets in
+                 enumerate(shares)]
+        heapq.heapify(turns)
+        while turns:
+            share_cost, share, tickets = heapq.heappop(turns)
+            ticket = next(tickets, None)
+            if ticket is None:
+                continue
+            yield share, ticket
+            heapq.heappush(
+                turns,
+                (share_cost + BlameWorkerPool._cost(ticket), share, tickets)
+            )
+
+    def submit(self, ticket, share=None):
+        '''
+        Queues a ticket, waiting for room in the queue if it's full
+        '''
+        if self._error is not None:
+            raise self._error
+        cost = BlameWorkerPool._cost(ticket)
+        share_cost = 0
+        with self._stats_lock:
+            self.submitted_count += 1
+            self.submitted_cost += cost
+            if share is not None:
+                # Queued behind the work already submitted for the share, so
+                # that a share's tickets wait their turn behind other shares'
+                share_cost = self._share_costs[share]
+                self._share_costs[share] += cost
+        self._tickets.put(
+            (share_cost, -cost, next(self._sequence), ticket, share)
+        )
+
+    def join(self, cancel=False):
+        '''
+        Waits for all submitted tickets to be processed, then re-raises the
+        first exception any of them raised, unless it was submitted for a
+        share.
+
+        When cancelling, tickets that haven't been picked up yet are dropped
+        and errors are ignored. It's fine to cancel a pool that is already
+        being joined.
+        '''
+        if cancel:
+            self._cancelled = True
+        if not self.planned:
+            self.planned = True
+            # The sentinels sort after every real ticket. There's always room
+            # for them eventually, as workers keep draining the queue until
+            # they get one
+            for _ in self._threads:
+                self._tickets.put(
+                    (float('inf'), 0, next(self._sequence), None, None)
+                )
+        for worker in self._threads:
+            worker.join()
+        self.makespan = time.time() - self._started
+        if self._error is not None and not self._cancelled:
+            raise self._error
+
+    @property
+    def progress(self):
+        '''
+        The fraction of the submitted work that has been processed
+        '''
+        if not self.submitted_cost:
+            return 0.0
+        return float(self.completed_cost) / self.submitted_cost
+
+    @property
+    def eta(self):
+        '''
+        The estimated number of seconds until all the work is processed,
+        assuming it keeps being processed at the same rate. None until every
+        ticket has been submitted and some of them have been processed.
+        '''
+        progress = self.progress
+        if not (self.planned and progress):
+            return None
+        return (time.time() - self._started) * (1 - progress) / progress
+
+    @property
+    def lower_bound(self):
+        '''
+        The shortest possible makespan for the work done: no schedule can beat
+        either the longest single job or the total work spread evenly.
+        '''
+        return max(self.longest_job, self.total_work / self.workers)
+
+
+class ProgressReporter(object):
+    '''
+    Periodically reports how far along a pool of workers is, along with the
+    transfer of ownership tallied so far, so that long runs give a useful
+    picture well before they're done.
+
+    Interim results are written as NDJSON records when asked to, redrawn in
+    place on a terminal, and otherwise only the progress itself is reported
+    on stderr, to keep stdout clean for the final result.
+    '''
+
+    def __init__(self, pool, interval, snapshot, ndjson=False, stdout=None,
+                 stderr=None):
+        self.pool = pool
+        self.stdout = stdout or sys.stdout
+        self.stderr = stderr or sys.stderr
+        self.interval = interval
+        # Returns the LOC and byte deltas tallied so far
+        self.snapshot = snapshot
+        self.ndjson = ndjson
+        self._drawn_lines = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._report_periodically)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops reporting, and clears the interim result off the terminal
+        '''
+        self._stopped.set()
+        self._thread.join()
+        self._erase()
+
+    def _report_periodically(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def _erase(self):
+        if self._drawn_lines:
+            self.stdout.write(u'{0}{1}A{0}J'.format(
+                Formatter._CSI, self._drawn_lines
+            ))
+            self._drawn_lines = 0
+
+    def report(self):
+        loc_deltas, byte_deltas, lfs_deltas = self.snapshot()
+        if self.ndjson:
+            eta = self.pool.eta
+            Formatter.terminal_output(
+                Formatter.format_ndjson(
+                    loc_deltas, byte_deltas, lfs_deltas,
+                    complete=False,
+                    progress=round(self.pool.progress, 4),
+                    eta=None if eta is None else round(eta, 1),
+                ),
+                self.stdout
+            )
+            self.stdout.flush()
+            return
+
+        status = Formatter.format_progress(self.pool)
+        if not Formatter.is_tty(self.stdout):
+            Formatter.terminal_output(status, self.stderr)
+            return
+
+        formatter = Formatter(
+            loc_deltas, byte_deltas, lfs_deltas, stream=self.stdout
+        )
+        lines = list()
+        if formatter.all_deltas:
+            lines.extend(
+                formatter.guilt_table(loc_deltas, byte_deltas, lfs_deltas)
+            )
+        lines.append(status)
+
+        self._erase()
+        for line in lines:
+            Formatter.terminal_output(line, self.stdout)
+        self.stdout.flush()
+        self._drawn_lines = len(lines)
+
+
+class Formatter(object):
+    _CSI = r'['
     _green = _CSI + '32m'
     _red = _CSI + '31m'
     _normal = _CSI + '0m'
     _default_width = 80
 
-    def __init__(self, *deltas):
-        self.all_deltas = []
-        for delta_list in deltas:
-            self.all_deltas.extend(delta_list)
+    def __init__(self, *deltas, **options):
+        self.all_deltas = []
+        for delta_list in deltas:
+            self.all_deltas.extend(delta_list)
+
+        # Where the table is written, if not sys.stdout
+        self._stream = options.get('stream')
+        self._is_tty = Formatter.is_tty(self.stream)
+        self._tty_width = self._get_tty_width()
+
+    @property
+    def stream(self):
+        return self._stream or sys.stdout
+
+    @staticmethod
+    def is_tty(stream):
+        try:
+            return os.isatty(stream.fileno())
+        except (AttributeError, ValueError):
+            # In-memory streams have no file descriptor
+            return False
+
+    @staticmethod
+    def term_width(unicode_string):
+        import unicodedata
+
+        wide = 'WF'
+        return sum([2 if unicodedata.east_asian_width(c) in wide else 1
+                    for c in unicode_string])
+
+    def red(self, text):
+        if self._is_tty:
+            return ''.join((Formatter._red, str(text), Formatter._normal))
+        else:
+            return str(text)
+
+    def green(self, text):
+        if self._is_tty:
+            return ''.join((Formatter._green, str(text), Formatter._normal))
+        else:
+            return str(text)
+
+    @property
+    def longest_name(self):
+        return len(max(
+            self.all_deltas, key=lambda d: Formatter.term_width(d.author)
+        ).author)
+
+    @staticmethod
+    def count_text(delta):
+        '''
+        Returns the change in ownership for a delta, with its margin of error
+        if it's an estimate
+        '''
+        if delta.margin is None:
+            return u'{0}'.format(delta.count)
+        return u'{0} \u00b1{1}'.format(delta.count, delta.margin)
+
+    @property
+    def longest_count(self):
+        return max(
+            len(Formatter.count_text(d)) for d in self.all_deltas
+            if not isinstance(d, BinaryDelta)
+        )
+
+    @property
+    def longest_bargraph(self):
+        return abs(max(
+            [d for d in self.all_deltas if not isinstance(d, BinaryDelta)],
+            key=lambda d: abs(d.count)
+        ).count)
+
+    @property
+    def bargraph_max_width(self):
+        return self._tty_width - (5 + self.longest_name + self.longest_count)
+
+    @staticmethod
+    def terminal_output(content, stream):
+        if 2 == sys.version_info[0]:
+            # TODO We need to do The Right Thing wrt. terminal encoding. It's
+            # not necessarily going to be UTF-8!
+            print(content.encode('utf_8'), file=stream)
+        elif 3 == sys.version_info[0]:
+            assert isinstance(content, str)
+            # Python3 stdout/stderr file-like objects implement TextIOWrapper,
+            # meaning that they expect to output native unicode strings - the
+            # sys.stdout/sys.stderr objects carry their own encoding
+            # information
+            print(content, file=stream)
+
+    def _get_tty_width(self):
+        if not self._is_tty:
+            return Formatter._default_width
+
+        import fcntl
+        import struct
+        import termios
+
+        try:
+            (_, w, _, _) = struct.unpack(
+                'HHHH',
+                fcntl.ioctl(
+                    self.stream.fileno(),
+                    termios.TIOCGWINSZ,
+                    struct.pack('HHHH', 0, 0, 0, 0)
+                )
+            )
+        except IOError:
+            return Formatter._default_width
+
+        if 0 < w:
+            return w
+        else:
+            return Formatter._default_width
+
+    @staticmethod
+    def format_schedule_stats(pool):
+        return u"Ran {tickets} blames on {workers} workers in " \
+            u"{makespan:.2f}s (total work {work:.2f}s, " \
+            u"lower bound {bound:.2f}s)".format(
+                tickets=pool.ticket_count,
+                workers=pool.workers,
+                makespan=pool.makespan,
+                work=pool.total_work,
+                bound=pool.lower_bound,
+            )
+
+    @staticmethod
+    def format_progress(pool):
+        status = u"{done} of {tickets} blames done ({progress:.0%})".format(
+            done=pool.ticket_count,
+            tickets=pool.submitted_count,
+            progress=pool.progress,
+        )
+        eta = pool.eta
+        if eta is None:
+            return status + u", still planning"
+        return status + u", ETA {0:.0f}s".format(eta)
+
+    @staticmethod
+    def _delta_record(delta):
+        record = {
+            'author': delta.author,
+            'since': delta.since_locs,
+            'until': delta.until_locs,
+            'count': delta.count,
+        }
+        if delta.margin is not None:
+            record['margin'] = delta.margin
+        return record
+
+    @staticmethod
+    def format_ndjson(loc_deltas, byte_deltas, lfs_deltas=(), **fields):
+        '''
+        Returns the transfer of ownership as a single line of JSON, for
+        consumption by other programs. Any keyword arguments are added to the
+        record as they are.
+        '''
+        import json
+
+        record = dict(fields)
+        for key, deltas in (('lines', loc_deltas), ('bytes', byte_deltas),
+                            ('lfs', lfs_deltas)):
+            record[key] = [
+                Formatter._delta_record(d) for d in deltas if d.count
+            ]
+        return json.dumps(record, sort_keys=True)
+
+    def guilt_lines(self, deltas):
+        return [self.format(delta) for delta in deltas if delta.count]
+
+    def guilt_table(self, loc_deltas, *other_deltas):
+        '''
+        Returns the lines showing the LOC deltas, then any other kind of deltas
+        given, eg. bytes, with a separator between kinds
+        '''
+        lines = self.guilt_lines(loc_deltas)
+        shown = bool(loc_deltas)
+        for deltas in other_deltas:
+            if deltas:
+                if shown:
+                    lines.append(u'---')
+                lines.extend(self.guilt_lines(deltas))
+                shown = True
+        return lines
+
+    def show_guilt_stats(self, deltas):
+        for line in self.guilt_lines(deltas):
+            Formatter.terminal_output(line, self.stream)
+
+    def _scale_bargraph(self, graph_width):
+        if 0 == graph_width:
+            return 0
+
+        if self.longest_bargraph <= self.bargraph_max_width:
+            return graph_width
+
+        scaled_width = 1 + \
+            int(graph_width * (self.bargraph_max_width - 1) /
+                self.longest_bargraph)
+
+        return scaled_width
+
+    def format(self, delta):
+        if isinstance(delta, BinaryDelta):
+            return self._format_byte_delta(delta)
+        elif isinstance(delta, Delta):
+            return self._format_loc_delta(delta)
+
+    def _format_loc_delta(self, delta):
+        bargraph = str()
+
+        graph_width = self._scale_bargraph(abs(delta.count))
+
+        if delta.count > 0:
+            bargraph = self.green('+' * graph_width)
+        elif delta.count < 0:
+            bargraph = self.red('-' * graph_width)
+
+        return u" {author} | {count} {bargraph}".format(
+            author=delta.author.ljust(
+                self.longest_name - Formatter.term_width(delta.author) +
+                len(delta.author)
+            ),
+            count=Formatter.count_text(delta).rjust(self.longest_count),
+            bargraph=bargraph,
+        )
+
+    def _format_byte_delta(self, delta):
+        since_bytes = until_bytes = ''
+        if delta.since_locs < delta.until_locs:
+            since_bytes = self.red(delta.since_locs)
+            until_bytes = self.green(delta.until_locs)
+        elif delta.until_locs < delta.since_locs:
+            since_bytes = self.green(delta.since_locs)
+            until_bytes = self.red(delta.until_locs)
+
+        margin = u''
+        if delta.margin is not None:
+            margin = u' (\u00b1{0})'.format(delta.margin)
+
+        return u" {author} | {count} {since} -> {until} bytes{margin}".format(
+            author=delta.author.ljust(
+                self.longest_name - Formatter.term_width(delta.author) +
+                len(delta.author)
+            ),
+            count='LFS' if isinstance(delta, LfsDelta) else 'Bin',
+            since=since_bytes,
+            until=until_bytes,
+            margin=margin,
+        )
+
+
+class Delta(object):
+    '''
+    Keeps track of an author's share in the ownership of text file LOCs across
+    all files in the repository.
+    '''
+
+    __slots__ = ('author', 'since_locs', 'until_locs', 'margin')
+
+    def __init__(self, author, since, until, margin=None):
+        self.author = author
+        self.since_locs = since
+        self.until_locs = until
+        # The margin of error on the count, when it's an estimate
+        self.margin = margin
+
+    def __repr__(self):
+        return "<Delta \"{author}\": {count} ({since}->{until})>".format(
+            author=self.author,
+            count=self.count,
+            since=self.since_locs,
+            until=self.until_locs,
+        )
+
+    @property
+    def count(self):
+        return self.until_locs - self.since_locs
+
+    def sort_key(self):
+        '''
+        Returns a tuple that orders deltas from the guiltiest author down, with
+        ties broken on the authors' names. Lists of deltas should be sorted
+        with ``key=Delta.sort_key`` rather than through the rich comparison
+        methods below, which are kept for convenience.
+        '''
+        return (-self.count, self.author)
+
+    def __eq__(self, rhs):
+        return (self.author == rhs.author) \
+            and (self.count == rhs.count)
+
+    def __ne__(self, rhs):
+        return not (self == rhs)
+
+    def __lt__(self, rhs):
+        return self.sort_key() < rhs.sort_key()
+
+    def __le__(self, rhs):
+        return (self < rhs) or (self == rhs)
+
+    def __gt__(self, rhs):
+        return self.sort_key() > rhs.sort_key()
+
+    def __ge__(self, rhs):
+        return (self > rhs) or (self == rhs)
+
+
+class BinaryDelta(Delta):
+    '''
+    Keeps track of an author's share in the ownership of binary file bytes
+    across all files in the repository.
+    '''
+    __slots__ = ()
+
+    def __init__(self, author, since, until, margin=None):
+        super(BinaryDelta, self).__init__(author, since, until, margin)
+
+    def __repr__(self):
+        return "<BinaryDelta \"{author}\": {count} ({since}->{until})>".format(
+            author=self.author,
+            count=self.count,
+            since=self.since_locs,
+            until=self.until_locs,
+        )
+
+
+class LfsDelta(BinaryDelta):
+    '''
+    Keeps track of an author's share in the ownership of Git LFS object bytes
+    across all files in the repository.
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<LfsDelta \"{author}\": {count} ({since}->{until})>".format(
+            author=self.author,
+            count=self.count,
+            since=self.since_locs,
+            until=self.until_locs,
+        )
+
+
+class PyGuilt(object):
+    '''
+    Implements the ownership tracking logic
+    '''
+    # How many groups of files of similar sizes we sample from
+    _sample_strata = 4
+
+    # How many blames of the since revision --working-tree remembers between
+    # runs
+    _working_tree_cache_entries = 10000
+
+    # The shortest lines a text file is assumed to have on average when
+    # deciding whether it's worth counting them for --split-lines. Counting
+    # reads the whole file before any blame can start, so it's only done for
+    # files that are likely to need splitting
+    _bytes_per_line = 16
+
+    # Files that are generated, or whose diffs aren't meant for human eyes
+    _generated_excludes = [
+        ':(exclude,attr:linguist-generated)',
+        ':(exclude,attr:linguist-generated=true)',
+        ':(exclude,attr:-diff)',
+    ]
+
+    def __init__(self, runner=None, stdout=None, stderr=None):
+        # Where results and diagnostics are written, if not sys.stdout and
+        # sys.stderr, eg. a server's response to a client
+        self._stdout = stdout
+        self._stderr = stderr
+        self.parser = setup_argparser(stdout, stderr)
+        self.args = None
+        # Blames tallied by earlier runs in the same process, if any
+        self.blame_cache = None
+
+        # Set up ownership buckets for the "since" and "until" revisions
+        # Note: binary and text ownership are fundamentally different (you
+        # can't compare LOCs and individual bytes) and so should be accounted
+        # for separately
+        self.loc_ownership_since = collections.defaultdict(int)
+        self.loc_ownership_until = collections.defaultdict(int)
+
+        self.byte_ownership_since = collections.defaultdict(int)
+        self.byte_ownership_until = collections.defaultdict(int)
+
+        self.lfs_ownership_since = collections.defaultdict(int)
+        self.lfs_ownership_until = collections.defaultdict(int)
+
+        # The relative change in ownership of text file LOCs/binary file byte
+        # for every author. The objects in these lists can be sorted sensibly
+        self.loc_deltas = list()
+        self.byte_deltas = list()
+        self.lfs_deltas = list()
+
+        # When sampling, the files we actually blamed and the margin of error
+        # on the estimated change in ownership for every author
+        self.samples = list()
+        # The PyGuilt objects blaming changed submodules into our buckets,
+        # including nested ones
+        self.submodules = list()
+        self.binary_blames = 0
+        # The author of every file added by the only commit that touched it,
+        # looked up once the first added file is planned
+        self.single_commit_authors = None
+        self.loc_margins = dict()
+        self.byte_margins = dict()
+
+        # Whether the run was cut short, and how much of the blaming work was
+        # done by then
+        self.interrupted = False
+        self.completed = 0.0
+
+        # Helper objects
+        self.runner = runner
+        try:
+            if self.runner is None:
+                self.runner = GitRunner()
+        except GitError:
+            # Do something appropriate
+            Formatter.terminal_output(
+                "Could not initialise GitRunner - please run from a "
+                "Git repository.",
+                self.stderr
+            )
+            raise SystemExit(1)
+
+    @property
+    def stdout(self):
+        return self._stdout or sys.stdout
+
+    @property
+    def stderr(self):
+        return self._stderr or sys.stderr
+
+    def process_args(self, argv=None):
+        self.args = self.parser.parse_args(argv)
+        if self.args.working_tree:
+            if self.args.until is not None:
+                # There's no until revision, so this is the first path
+                self.args.paths.insert(0, self.args.until)
+                self.args.until = None
+            if self.args.since is not None and \
+                    not self.runner.is_commit(self.args.since):
+                # eg. git guilt --working-tree src/
+                self.args.paths.insert(0, self.args.since)
+                self.args.since = None
+            self.args.since = self.args.since or 'HEAD'
+        elif not (self.args.since and self.args.until):
+            raise GitError(self.parser.format_usage())
+        if self.args.skip_generated and \
+                not self.runner.git_supports_attr_pathspec():
+            raise GitError(
+                "--skip-generated needs git >= 2.13.0"
+            )
+        if 'pygit2' == self.args.backend:
+            self.runner = Pygit2Runner(self.runner._cwd)
+        if self.args.recurse_submodules and 'churn' == self.args.mode:
+            raise GitError(
+                "--recurse-submodules can't be used with --mode churn"
+            )
+        if self.args.working_tree:
+            self._setup_working_tree()
+        # Overrides go last, so that they win
+        self.args.git_config = tuple(
+            BlameTicket.config_profiles[self.args.git_profile]
+        ) + tuple(self.args.git_config)
+        if not self.args.textconv_cache_bytes:
+            self.args.textconv_cache = None
+        elif self.args.textconv_cache is None:
+            self.args.textconv_cache = os.path.join(cache_dir(), 'textconv')
+        if self.args.textconv_cache and \
+                not os.path.isdir(self.args.textconv_cache):
+            try:
+                os.makedirs(self.args.textconv_cache)
+            except OSError:
+                # Binary files will be converted without the cache
+                pass
+        if 'history-walk' == self.args.engine:
+            # The walk would credit the lines merges bring in to whoever made
+            # the merge, rather than to whoever wrote them
+            reason = None
+            if not self.runner.is_first_parent_ancestor(
+                    self.args.since, self.args.until):
+                reason = u"{since} isn't on the main line of {until}'s history"
+            elif self.runner.has_merges(self.args.since, self.args.until):
+                reason = u"{since}..{until} has merges"
+            if reason:
+                Formatter.terminal_output(
+                    (reason + u" - blaming files one by one instead").format(
+                        since=self.args.since,
+                        until=self.args.until,
+                    ),
+                    self.stderr
+                )
+                self.args.engine = 'per-file'
+
+    def _setup_working_tree(self):
+        '''
+        Sets things up for --working-tree, where the until revision is the
+        working tree, denoted by None
+        '''
+        for option, used in (
+                ('--mode churn', 'churn' == self.args.mode),
+                ('--recurse-submodules', self.args.recurse_submodules)):
+            if used:
+                raise GitError(
+                    "--working-tree can't be used with {0}".format(option)
+                )
+        self.args.until = None
+        if 'history-walk' == self.args.engine:
+            # There are no commits to walk up to the working tree
+            self.args.engine = 'per-file'
+
+        # Uncommitted lines are credited to whoever would commit them
+        author = self.runner.author_ident()
+        if author is not None:
+            for commit_id in GitRunner._null_commit_ids:
+                self.runner.commit_authors[commit_id] = author
+
+    def pathspecs(self):
+        '''
+        Returns the pathspecs that restrict the set of files we blame, as given
+        on the command line. These are passed on to git-diff, so that files
+        we aren't interested in never make it to the planner.
+        '''
+        pathspecs = [
+            self.runner.pathspec_from_cwd(path) for path in self.args.paths
+        ]
+
+        excludes = [':(top,exclude)' + glob for glob in self.args.exclude]
+        if self.args.skip_generated:
+            excludes.extend(PyGuilt._generated_excludes)
+
+        if excludes and not pathspecs:
+            # Exclusions need something to be excluded from
+            pathspecs.append(':/')
+        return pathspecs + excludes
+
+    def iter_changed_files(self):
+        '''
+        Yields the `ChangedFile` records for the files that have changed
+        between the `since` and `until` revisions and that we can blame.
+        '''
+        supports_binary = self.runner.git_supports_binary_diff()
+
+        for changed_file in self.runner.iter_delta_files(
+                self.args.since, self.args.until, self.pathspecs()):
+            if changed_file.is_binary and not supports_binary:
+                continue
+            if changed_file.in_since or changed_file.in_until:
+                yield changed_file
+
+    def iter_blame_jobs(self):
+        '''
+        Discovers the set of files that have changed between the Git revision
+        pointed to by the `since` CLI arg and the `until` Git revision
+
+        For each file, yields a blame ticket of the appropriate type (text or
+        binary) for the since and until revision. Tickets are generated lazily
+        as git-diff reports changed files, and only for files that actually
+        exist in the revision being blamed.
+        '''
+
+        # LFS objects are cheap to account for, so they're neither sampled nor
+        # blamed, and they're only planned once everything else is
+        lfs_files = list()
+
+        def iter_blameable_files():
+            for changed_file in self.iter_changed_files():
+                if changed_file.is_lfs:
+                    lfs_files.append(changed_file)
+                else:
+                    yield changed_file
+
+        if self.args.sample:
+            # Sampled files are blamed into buckets of their own, from which
+            # we'll extrapolate the ownership of the whole set of files
+            blame_targets = (
+                (sample.changed_file, sample.since_bucket, sample.until_bucket)
+                for sample in self.sample_changed_files(
+                    iter_blameable_files()
+                )
+            )
+        else:
+            blame_targets = (
+                (changed_file,) + self._ownership_buckets(changed_file)
+                for changed_file in iter_blameable_files()
+            )
+
+        walk = None
+        if 'history-walk' == self.args.engine:
+            walk = HistoryWalk(self.runner, self.args, self.pathspecs())
+
+        for changed_file, since_bucket, until_bucket in blame_targets:
+            author = self._single_commit_author(changed_file)
+            if author is not None:
+                yield SingleAuthorTicket(
+                    self.runner,
+                    until_bucket,
+                    VersionedFile(
+                        changed_file.repo_path,
+                        self.args.until,
+                        changed_file.until_blob,
+                        changed_file.until_size,
+                        changed_file.additions
+                    ),
+                    self.args,
+                    author
+                )
+                continue
+
+            if changed_file.is_binary:
+                ticket_type = BinaryBlameTicket
+                self.binary_blames += 1
+            elif walk is not None:
+                walk.add(changed_file, since_bucket, until_bucket)
+                continue
+            else:
+                ticket_type = TextBlameTicket
+
+            if changed_file.in_since:
+                for ticket in self._plan_tickets(
+                        ticket_type,
+                        since_bucket,
+                        VersionedFile(
+                            changed_file.repo_path,
+                            self.args.since,
+                            changed_file.since_blob,
+                            changed_file.since_size
+                        )):
+                    yield ticket
+            if changed_file.in_until:
+                for ticket in self._plan_tickets(
+                        ticket_type,
+                        until_bucket,
+                        VersionedFile(
+                            changed_file.repo_path,
+                            self.args.until,
+                            changed_file.until_blob,
+                            changed_file.until_size
+                        )):
+                    yield ticket
+
+        if walk is not None and walk.targets:
+            yield walk
+
+        for changed_file in lfs_files:
+            for ticket in self._plan_lfs_tickets(changed_file):
+                yield ticket
+
+        if self.args.recurse_submodules:
+            for submodule in self.iter_submodules():
+                for ticket in submodule.iter_blame_jobs():
+                    yield ticket
+
+    def iter_submodules(self):
+        '''
+        Yields a `PyGuilt` for every submodule whose commit differs between
+        the since and until revisions, set up to blame the files that changed
+        in the submodule into our own buckets, so that its authors' totals
+        are merged with ours.
+
+        Paths given on the command line select submodules, but don't apply
+        within them. Submodules that aren't checked out, or that lack one of
+        the commits, are skipped with a warning.
+        '''
+        import copy
+
+        for path, since_commit, until_commit in \
+                self.runner.iter_submodule_changes(
+                    self.args.since, self.args.until, self.pathspecs()):
+            submodule_dir = os.path.join(self.runner._git_toplevel, path)
+            try:
+                runner = type(self.runner)(submodule_dir)
+                if os.path.realpath(runner._git_toplevel) != \
+                        os.path.realpath(submodule_dir):
+                    # git found the superproject
+                    raise GitError("it isn't checked out")
+                for commit in (since_commit, until_commit):
+                    if commit is not None:
+                        runner.rev_parse(commit)
+            except (GitError, OSError) as ex:
+                Formatter.terminal_output(
+                    u"Skipping submodule {path}: {reason}".format(
+                        path=path,
+                        reason=str(ex).strip(),
+                    ),
+                    self.stderr
+                )
+                continue
+
+            submodule = PyGuilt(runner)
+            submodule.args = copy.copy(self.args)
+            submodule.args.since = since_commit or runner.empty_tree()
+            submodule.args.until = until_commit or runner.empty_tree()
+            submodule.args.paths = []
+            if 'history-walk' == submodule.args.engine and not (
+                    since_commit and until_commit and
+                    runner.is_first_parent_ancestor(
+                        since_commit, until_commit) and
+                    not runner.has_merges(since_commit, until_commit)):
+                submodule.args.engine = 'per-file'
+            for bucket in ('loc_ownership_since', 'loc_ownership_until',
+                           'byte_ownership_since', 'byte_ownership_until',
+                           'lfs_ownership_since', 'lfs_ownership_until'):
+                setattr(submodule, bucket, getattr(self, bucket))
+            submodule.submodules = self.submodules
+            self.submodules.append(submodule)
+            yield submodule
+
+    def _single_commit_author(self, changed_file):
+        '''
+        Returns the author every line of a text file added since the since
+        revision can be credited to without blaming it, if a single commit
+        touched it, or None
+        '''
+        if changed_file.is_binary or changed_file.in_since or \
+                not changed_file.in_until or changed_file.additions is None \
+                or self.args.until is None:
+            return None
+        if self.single_commit_authors is None:
+            self.single_commit_authors = \
+                self.runner.get_single_commit_authors(
+                    self.args.since,
+                    self.args.until,
+                    self.pathspecs(),
+                    self.args.email
+                )
+        return self.single_commit_authors.get(changed_file.repo_path)
+
+    def _plan_lfs_tickets(self, changed_file):
+        '''
+        Yields the tickets crediting the LFS objects of a file. Should the file
+        be a pointer in only one of the revisions, its content in the other is
+        credited as a whole too, so that it can be compared.
+        '''
+        for in_revision, revision, blob_id, lfs_size, size, bucket in (
+                (changed_file.in_since, self.args.since,
+                 changed_file.since_blob, changed_file.since_lfs_size,
+                 changed_file.since_size, self.lfs_ownership_since),
+                (changed_file.in_until, self.args.until,
+                 changed_file.until_blob, changed_file.until_lfs_size,
+                 changed_file.until_size, self.lfs_ownership_until)):
+            if in_revision:
+                yield LfsBlameTicket(
+                    self.runner,
+                    bucket,
+                    VersionedFile(
+                        changed_file.repo_path,
+                        revision,
+                        blob_id,
+                        size if lfs_size is None else lfs_size
+                    ),
+                    self.args
+                )
+
+    def _ownership_buckets(self, changed_file):
+        if changed_file.is_binary:
+            return (self.byte_ownership_since, self.byte_ownership_until)
+        return (self.loc_ownership_since, self.loc_ownership_until)
 
-        self._is_tty = os.isatty(sys.stdout.fileno())
-        self._tty_width = self._get_tty_width()
+    def sample_changed_files(self, changed_files):
+        '''
+        Returns a `FileSample` for each of a random sample of the changed files
+        given, as per the --sample CLI arg.
 
-    @staticmethod
-    def term_width(unicode_string):
-        wide = 'WF'
-        return sum([2 if unicodedata.east_asian_width(c) in wide else 1
-                    for c in unicode_string])
+        The files are split into strata of similar sizes, text and binary files
+        apart, and each stratum is sampled in proportion to its size. This
+        keeps a handful of huge files from skewing the estimates.
+        '''
+        changed_files = list(changed_files)
+        if not changed_files:
+            return list()
 
-    def red(self, text):
-        if self._is_tty:
-            return ''.join((Formatter._red, str(text), Formatter._normal))
+        if isinstance(self.args.sample, float):
+            fraction = self.args.sample
         else:
-            return str(text)
+            fraction = float(self.args.sample) / len(changed_files)
+        fraction = min(fraction, 1.0)
 
-    def green(self, text):
-        if self._is_tty:
-            return ''.join((Formatter._green, str(text), Formatter._normal))
-        else:
-            return str(text)
+        import random
 
-    @property
-    def longest_name(self):
-        return len(max(
-            self.all_deltas, key=lambda d: Formatter.term_width(d.author)
-        ).author)
+        rng = random.Random(self.args.sample_seed)
+        samples = list()
+        for is_binary in (False, True):
+            population = sorted(
+                [cf for cf in changed_files if is_binary == cf.is_binary],
+                key=lambda cf: max(cf.since_size, cf.until_size)
+            )
+            # Up to four strata of equal counts, from the smallest files up
+            stratum_count = min(PyGuilt._sample_strata, len(population))
+            for stratum in range(stratum_count):
+                members = population[
+                    stratum * len(population) // stratum_count:
+                    (stratum + 1) * len(population) // stratum_count
+                ]
+                # We need at least two files in a stratum to estimate its
+                # variance
+                sample_size = max(
+                    min(2, len(members)),
+                    int(round(fraction * len(members)))
+                )
+                for changed_file in rng.sample(members, sample_size):
+                    samples.append(FileSample(
+                        changed_file,
+                        (is_binary, stratum),
+                        len(members),
+                    ))
 
-    @property
-    def longest_count(self):
-        return len(str(max(
-            [d for d in self.all_deltas if not isinstance(d, BinaryDelta)],
-            key=lambda d: len(str(d.count))
-        ).count))
+        self.samples = samples
+        return samples
 
-    @property
-    def longest_bargraph(self):
-        return abs(max(
-            [d for d in self.all_deltas if not isinstance(d, BinaryDelta)],
-            key=lambda d: abs(d.count)
-        ).count)
+    def extrapolate_samples(self):
+        '''
+        Estimates the ownership buckets for all the changed files from those of
+        the sampled files, along with the margin of error of the estimated
+        change in ownership of every author, at a 95% confidence level.
 
-    @property
-    def bargraph_max_width(self):
-        return self._tty_width - (5 + self.longest_name + self.longest_count)
+        Submodules are sampled separately, and their estimates are added up
+        with ours.
+        '''
+        for is_binary, since_total, until_total, margins in (
+                (False, self.loc_ownership_since, self.loc_ownership_until,
+                 self.loc_margins),
+                (True, self.byte_ownership_since, self.byte_ownership_until,
+                 self.byte_margins)):
+            for guilt in [self] + self.submodules:
+                since_estimate, until_estimate, margin = \
+                    guilt._extrapolate(is_binary)
+                for author, count in since_estimate.items():
+                    since_total[author] += count
+                for author, count in until_estimate.items():
+                    until_total[author] += count
+                for author, error in margin.items():
+                    # The estimates are independent, so their variances add up
+                    margins[author] = int(math.ceil(math.sqrt(
+                        margins.get(author, 0) ** 2 + error ** 2
+                    )))
+
+    def _extrapolate(self, is_binary):
+        '''
+        Returns the estimated since and until buckets, and the margins of
+        error, for either the text or the binary files
+        '''
+        strata = collections.defaultdict(list)
+        authors = set()
+        for sample in self.samples:
+            if is_binary == sample.changed_file.is_binary:
+                strata[sample.stratum].append(sample)
+                authors.update(sample.since_bucket)
+                authors.update(sample.until_bucket)
+
+        since_total = dict()
+        until_total = dict()
+        margins = dict()
+        for author in authors:
+            since_estimate = until_estimate = variance = 0.0
+            for samples in strata.values():
+                population = samples[0].population
+                weight = float(population) / len(samples)
+                since_counts = [s.since_bucket.get(author, 0)
+                                for s in samples]
+                until_counts = [s.until_bucket.get(author, 0)
+                                for s in samples]
+                since_estimate += weight * sum(since_counts)
+                until_estimate += weight * sum(until_counts)
+                variance += PyGuilt._stratum_variance(
+                    [u - s for s, u in zip(since_counts, until_counts)],
+                    population
+                )
+            since_total[author] = int(round(since_estimate))
+            until_total[author] = int(round(until_estimate))
+            margins[author] = int(math.ceil(1.96 * math.sqrt(variance)))
+        return since_total, until_total, margins
 
     @staticmethod
-    def terminal_output(content, stream):
-        if 2 == sys.version_info[0]:
-            # TODO We need to do The Right Thing wrt. terminal encoding. It's
-            # not necessarily going to be UTF-8!
-            print(content.encode('utf_8'), file=stream)
-        elif 3 == sys.version_info[0]:
-            assert isinstance(content, str)
-            # Python3 stdout/stderr file-like objects implement TextIOWrapper,
-            # meaning that they expect to output native unicode strings - the
-            # sys.stdout/sys.stderr objects carry their own encoding
-            # information
-            print(content, file=stream)
-
-    def _get_tty_width(self):
-        if not self._is_tty:
-            return Formatter._default_width
-
-        try:
-            (_, w, _, _) = struct.unpack(
-                'HHHH',
-                fcntl.ioctl(
-                    sys.stdout.fileno(),
-                    termios.TIOCGWINSZ,
-                    struct.pack('HHHH', 0, 0, 0, 0)
-                )
+    def _stratum_variance(values, population):
+        '''
+        Returns the variance of the estimated total of a stratum from the
+        values of its sampled members, with the finite population correction.
+        '''
+        sample_size = len(values)
+        if sample_size < 2:
+            return 0.0
+        mean = float(sum(values)) / sample_size
+        sample_variance = sum((v - mean) ** 2 for v in values) / \
+            (sample_size - 1)
+        return population * population * \
+            (1.0 - float(sample_size) / population) * \
+            sample_variance / sample_size
+
+    def _plan_tickets(self, ticket_type, bucket, versioned_file):
+        '''
+        Yields the tickets needed to blame a versioned file. Files longer than
+        the split threshold are blamed in several ranges of lines, which can
+        be processed concurrently and all add up in the same bucket.
+        '''
+        for line_range in self._split_ranges(ticket_type, versioned_file):
+            yield ticket_type(
+                self.runner,
+                bucket,
+                versioned_file,
+                self.args,
+                line_range
             )
-        except IOError:
-            return Formatter._default_width
 
-        if 0 < w:
-            return w
+    def _split_ranges(self, ticket_type, versioned_file):
+        threshold = self.args.split_lines
+        if not threshold or self.args.jobs < 2 or not versioned_file.blob_id:
+            return [None]
+
+        if ticket_type is BinaryBlameTicket:
+            # The textconv filter outputs one line for each byte
+            lines = versioned_file.size
+        elif versioned_file.size <= threshold * PyGuilt._bytes_per_line:
+            return [None]
         else:
-            return Formatter._default_width
+            lines = self.runner.count_lines(versioned_file.blob_id)
 
-    def show_guilt_stats(self, deltas):
-        for delta in deltas:
-            if delta.count:
-                Formatter.terminal_output(self.format(delta), sys.stdout)
+        if lines <= threshold:
+            return [None]
 
-    def _scale_bargraph(self, graph_width):
-        if 0 == graph_width:
-            return 0
+        versioned_file.lines = lines
+        return [
+            (first, min(first + threshold - 1, lines))
+            for first in range(1, lines + 1, threshold)
+        ]
 
-        if self.longest_bargraph <= self.bargraph_max_width:
-            return graph_width
+    def map_blames(self):
+        '''
+        Processes every blame ticket produced by `iter_blame_jobs`, tallying
+        the ownership of LOCs and bytes in the since and until buckets.
 
-        scaled_width = 1 + \
-            int(graph_width * (self.bargraph_max_width - 1) /
-                self.longest_bargraph)
+        Tickets are handed over to a pool of workers as soon as they're
+        planned, so that blames start while git-diff is still running.
 
-        return scaled_width
+        On a keyboard interrupt, blames that haven't started are dropped and
+        whatever was tallied so far is kept, so that a partial result can be
+        shown.
+        '''
 
-    def format(self, delta):
-        if isinstance(delta, BinaryDelta):
-            return self._format_byte_delta(delta)
-        elif isinstance(delta, Delta):
-            return self._format_loc_delta(delta)
+        pool = BlameWorkerPool(self.args.jobs)
+        reporter = None
+        if self.args.progress:
+            reporter = ProgressReporter(
+                pool, self.args.progress, self.partial_deltas,
+                ndjson='ndjson' == self.args.format,
+                stdout=self.stdout, stderr=self.stderr
+            )
+            reporter.start()
+
+        cached_blames = list()
+        if self.blame_cache is not None:
+            commit_ids = dict(
+                (rev, self.runner.rev_parse(rev))
+                for rev in (self.args.since, self.args.until)
+                if rev is not None
+            )
 
-    def _format_loc_delta(self, delta):
-        bargraph = str()
+        try:
+            try:
+                for blame in self.iter_blame_jobs():
+                    # The working tree may change between runs
+                    if self.blame_cache is not None and \
+                            isinstance(blame, BlameTicket) and \
+                            blame.versioned_file.git_revision is not None:
+                        # Submodules are blamed at commit IDs already
+                        revision = blame.versioned_file.git_revision
+                        key = BlameCache.key(
+                            blame, commit_ids.get(revision, revision)
+                        )
+                        tally = self.blame_cache.get(key)
+                        if tally is not None:
+                            blame.credit(tally)
+                            continue
+                        cached_blames.append((key, blame))
+                    pool.submit(blame)
+            except BaseException:
+                pool.join(cancel=True)
+                raise
+            pool.join()
+        except KeyboardInterrupt:
+            pool.join(cancel=True)
+            self.interrupted = True
+        finally:
+            if reporter is not None:
+                reporter.stop()
+        self.completed = pool.progress
+
+        for key, blame in cached_blames:
+            # Approximated and missing files aren't worth remembering
+            if blame.tallied is not None and not blame.degraded:
+                self.blame_cache.put(key, blame.tallied)
+
+        if self.binary_blames or \
+                any(submodule.binary_blames for submodule in self.submodules):
+            self.prune_textconv_cache()
+
+        if self.args.sample:
+            self.extrapolate_samples()
+
+        for blame in sorted(pool.degraded, key=BlameTicket.describe):
+            Formatter.terminal_output(
+                u"Approximated {blame}: {reason}".format(
+                    blame=blame.describe(),
+                    reason=blame.degraded,
+                ),
+                self.stderr
+            )
 
-        graph_width = self._scale_bargraph(abs(delta.count))
+        if self.args.stats:
+            Formatter.terminal_output(
+                Formatter.format_schedule_stats(pool),
+                self.stderr
+            )
 
-        if delta.count > 0:
-            bargraph = self.green('+' * graph_width)
-        elif delta.count < 0:
-            bargraph = self.red('-' * graph_width)
+    def prune_textconv_cache(self):
+        '''
+        Deletes the least recently used conversions of binary files from the
+        textconv cache until it fits in --textconv-cache-bytes. Files are
+        deemed used when they were last read or written, as far as the file
+        system keeps track of it.
+        '''
+        directory = self.args.textconv_cache
+        if not directory:
+            return
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+
+        entries = list()
+        total_size = 0
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Pruned by a concurrent run
+                continue
+            entries.append(
+                (max(stat.st_atime, stat.st_mtime), stat.st_size, path)
+            )
+            total_size += stat.st_size
 
-        return u" {author} | {count} {bargraph}".format(
-            author=delta.author.ljust(
-                self.longest_name - Formatter.term_width(delta.author) +
-                len(delta.author)
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.args.textconv_cache_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def map_churn(self):
+        '''
+        Approximates the transfer of ownership from the churn of every author
+        between the since and until revisions, in a single pass over the
+        history rather than by blaming.
+
+        The lines an author removed are tallied in the since bucket and those
+        they added in the until bucket, so that their delta is the net number
+        of lines they contributed. Binary files are tallied the same way with
+        the size of their blobs before and after every change.
+        '''
+        binary_churn = list()
+        for churn in self.runner.iter_churn(
+                self.args.since, self.args.until, self.pathspecs(),
+                self.args.email):
+            if churn.is_binary:
+                binary_churn.append(churn)
+            else:
+                self.loc_ownership_since[churn.author] += churn.deletions
+                self.loc_ownership_until[churn.author] += churn.additions
+
+        if binary_churn:
+            blob_sizes = self.runner.get_blob_sizes(list(set(
+                blob for churn in binary_churn
+                for blob in (churn.old_blob, churn.new_blob) if blob
+            )))
+            for churn in binary_churn:
+                self.byte_ownership_since[churn.author] += \
+                    blob_sizes.get(churn.old_blob, 0)
+                self.byte_ownership_until[churn.author] += \
+                    blob_sizes.get(churn.new_blob, 0)
+
+    def partial_deltas(self):
+        '''
+        Returns the LOC, byte and LFS deltas for the blames processed so far,
+        while the workers are still busy
+        '''
+        with BlameTicket._bucket_lock:
+            lfs_since = dict(self.lfs_ownership_since)
+            lfs_until = dict(self.lfs_ownership_until)
+            if self.args.sample:
+                loc_since, loc_until, loc_margins = self._extrapolate(False)
+                byte_since, byte_until, byte_margins = self._extrapolate(True)
+            else:
+                loc_since = dict(self.loc_ownership_since)
+                loc_until = dict(self.loc_ownership_until)
+                byte_since = dict(self.byte_ownership_since)
+                byte_until = dict(self.byte_ownership_until)
+                loc_margins = byte_margins = dict()
+        return (
+            PyGuilt._reduce_deltas(Delta, loc_since, loc_until, loc_margins),
+            PyGuilt._reduce_deltas(
+                BinaryDelta, byte_since, byte_until, byte_margins
             ),
-            count=str(delta.count).rjust(self.longest_count),
-            bargraph=bargraph,
+            PyGuilt._reduce_deltas(LfsDelta, lfs_since, lfs_until, dict()),
         )
 
-    def _format_byte_delta(self, delta):
-        since_bytes = until_bytes = ''
-        if delta.since_locs < delta.until_locs:
-            since_bytes = self.red(delta.since_locs)
-            until_bytes = self.green(delta.until_locs)
-        elif delta.until_locs < delta.since_locs:
-            since_bytes = self.green(delta.since_locs)
-            until_bytes = self.red(delta.until_locs)
+    @staticmethod
+    def _reduce_deltas(delta_type, since_bucket, until_bucket, margins):
+        deltas = [
+            delta_type(author, count, until_bucket.get(author, 0),
+                       margins.get(author))
+            for author, count in since_bucket.items()
+        ]
+        # New authors
+        deltas.extend(
+            delta_type(author, 0, count, margins.get(author))
+            for author, count in until_bucket.items()
+            if author not in since_bucket
+        )
+        deltas.sort(key=Delta.sort_key)
+        return deltas
 
-        return u" {author} | {count} {since} -> {until} bytes".format(
-            author=delta.author.ljust(
-                self.longest_name - Formatter.term_width(delta.author) +
-                len(delta.author)
-            ),
-            count='Bin',
-            since=since_bytes,
-            until=until_bytes,
+    def reduce_blames(self):
+        self.loc_deltas = PyGuilt._reduce_deltas(
+            Delta,
+            self.loc_ownership_since,
+            self.loc_ownership_until,
+            self.loc_margins,
+        )
+        self.byte_deltas = PyGuilt._reduce_deltas(
+            BinaryDelta,
+            self.byte_ownership_since,
+            self.byte_ownership_until,
+            self.byte_margins,
         )
+        self.lfs_deltas = PyGuilt._reduce_deltas(
+            LfsDelta,
+            self.lfs_ownership_since,
+            self.lfs_ownership_until,
+            dict(),
+        )
+
+    def run(self, argv=None):
+        try:
+            self.process_args(argv)
+        except GitError as ex:
+            Formatter.terminal_output(str(ex), self.stderr)
+            return 1
+        else:
+            if 'churn' == self.args.mode:
+                self.map_churn()
+            elif self.args.until is None and self.blame_cache is None:
+                # Blames of the since revision are kept between runs, so that
+                # only the changed files in the working tree are blamed again
+                # until the next commit, eg. from a pre-commit hook
+                cache_path = os.path.join(cache_dir(), 'blames.json')
+                self.blame_cache = BlameCache.load(
+                    cache_path, PyGuilt._working_tree_cache_entries
+                )
+                self.map_blames()
+                self.blame_cache.save(cache_path)
+            else:
+                self.map_blames()
+            self.reduce_blames()
 
+            if self.interrupted:
+                Formatter.terminal_output(
+                    u"Interrupted - showing partial results "
+                    u"({0:.0%} of blames done)".format(self.completed),
+                    self.stderr
+                )
 
-class Delta(object):
+            if 'ndjson' == self.args.format:
+                Formatter.terminal_output(
+                    Formatter.format_ndjson(
+                        self.loc_deltas, self.byte_deltas, self.lfs_deltas,
+                        complete=not self.interrupted,
+                        progress=round(self.completed, 4),
+                    ),
+                    self.stdout
+                )
+            else:
+                formatter = Formatter(
+                    self.loc_deltas, self.byte_deltas, self.lfs_deltas,
+                    stream=self.stdout
+                )
+                for line in formatter.guilt_table(
+                        self.loc_deltas, self.byte_deltas, self.lfs_deltas):
+                    Formatter.terminal_output(line, self.stdout)
+            # Like a shell would after SIGINT
+            return 130 if self.interrupted else 0
+
+
+class BlameCache(object):
     '''
-    Keeps track of an author's share in the ownership of text file LOCs across
-    all files in the repository.
+    Remembers the ownership tallied by blame tickets, so that a long-running
+    process doesn't blame a file at a given commit more than once. Entries
+    are keyed on commit IDs rather than revisions, since branches move. The
+    least recently used entries are dropped past `max_entries`.
     '''
 
-    def __init__(self, author, since, until):
-        self.author = author
-        self.since_locs = since
-        self.until_locs = until
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    def __repr__(self):
-        return "<Delta \"{author}\": {count} ({since}->{until})>".format(
-            author=self.author,
-            count=self.count,
-            since=self.since_locs,
-            until=self.until_locs,
+    @staticmethod
+    def key(ticket, commit_id):
+        # The blame configuration changes what a blame finds, so queries run
+        # with different profiles or overrides mustn't share entries
+        return (
+            type(ticket).__name__,
+            commit_id,
+            ticket.versioned_file.repo_path,
+            ticket.line_range,
+            bool(ticket.args.email),
+            ticket.args.git_profile,
+            tuple(tuple(pair) for pair in ticket.args.git_config),
         )
 
-    @property
-    def count(self):
-        return self.until_locs - self.since_locs
+    def get(self, key):
+        with self._lock:
+            tally = self._entries.pop(key, None)
+            if tally is None:
+                self.misses += 1
+                return None
+            # Now the most recently used
+            self._entries[key] = tally
+            self.hits += 1
+            return tally
+
+    def put(self, key, tally):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = tally
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @classmethod
+    def load(cls, path, max_entries):
+        '''
+        Returns a cache holding the entries saved in the file at path by
+        `save`, or an empty cache if there's no such file or it can't be read
+        '''
+        import json
 
-    def __eq__(self, rhs):
-        return (self.author == rhs.author) \
-            and (self.count == rhs.count)
+        cache = cls(max_entries)
+        try:
+            with open(path) as cache_file:
+                saved = json.load(cache_file)
+            for key, tally in saved[-max_entries:]:
+                (
+                    ticket_type, commit_id, repo_path, line_range, email,
+                    git_profile, git_config
+                ) = key
+                cache._entries[(
+                    ticket_type,
+                    commit_id,
+                    repo_path,
+                    tuple(line_range) if line_range else None,
+                    email,
+                    git_profile,
+                    tuple(tuple(pair) for pair in git_config),
+                )] = tally
+        except (IOError, OSError, ValueError, TypeError):
+            cache._entries.clear()
+        return cache
+
+    def save(self, path):
+        '''
+        Writes the entries to the file at path as JSON, least recently used
+        first. The file is replaced as a whole, so that concurrent runs never
+        read part of it.
+        '''
+        import json
 
-    def __ne__(self, rhs):
-        return not (self == rhs)
+        with self._lock:
+            saved = [
+                [list(key), tally] for key, tally in self._entries.items()
+            ]
+        temp_path = '{0}.{1}'.format(path, os.getpid())
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, 'w') as cache_file:
+                json.dump(saved, cache_file)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            # The blames will be run again next time
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
 
-    def __lt__(self, rhs):
-        if self.count > rhs.count:
-            return True
-        elif self.count == rhs.count:
-            # Compare the authors' names
-            return self.author < rhs.author
-        else:
-            return False
 
-    def __le__(self, rhs):
-        return (self < rhs) or (self == rhs)
+class GuiltServer(object):
+    '''
+    Answers git-guilt queries sent by clients over a Unix domain socket, from
+    a single long-running process. The Git runner for every directory queries
+    come from and the blames of earlier queries are kept in memory, so that
+    repeated queries are answered without blaming anything again.
+
+    Queries are answered concurrently. Each is run in the client's working
+    directory with its own command line, and the response carries what would
+    have been written to stdout and stderr, along with the exit status.
+    '''
 
-    def __gt__(self, delta):
-        if self.count < delta.count:
-            return True
-        elif self.count == delta.count:
-            # Compare the authors' names
-            return self.author > delta.author
+    def __init__(self, socket_path, max_cache_entries):
+        self.socket_path = socket_path
+        self.blame_cache = BlameCache(max_cache_entries)
+        self._runners = dict()
+        self._lock = threading.Lock()
+
+    def answer(self, request):
+        '''
+        Runs git-guilt for a request, ie. a dictionary holding the client's
+        working directory and command-line arguments, and returns the
+        response as a dictionary
+        '''
+        import io
+
+        if 2 == sys.version_info[0]:
+            stdout, stderr = io.BytesIO(), io.BytesIO()
         else:
-            return False
+            stdout, stderr = io.StringIO(), io.StringIO()
 
-    def __ge__(self, rhs):
-        return (self > rhs) or (self == rhs)
+        try:
+            cwd = request['cwd']
+            with self._lock:
+                runner = self._runners.get(cwd)
+            if runner is None:
+                runner = GitRunner(cwd)
+                with self._lock:
+                    runner = self._runners.setdefault(cwd, runner)
+            guilt = PyGuilt(runner, stdout=stdout, stderr=stderr)
+            guilt.blame_cache = self.blame_cache
+            status = guilt.run(request['argv'])
+        except SystemExit as ex:
+            # eg. invalid arguments
+            status = ex.code if isinstance(ex.code, int) else 1
+        except (GitError, OSError) as ex:
+            Formatter.terminal_output(str(ex), stderr)
+            status = 1
+        except Exception as ex:  # pylint: disable=broad-except
+            # A bug, or a malformed request, mustn't leave the client without
+            # an answer
+            Formatter.terminal_output(
+                u"{0}: {1}".format(type(ex).__name__, ex), stderr
+            )
+            status = 1
 
+        stdout, stderr = stdout.getvalue(), stderr.getvalue()
+        if 2 == sys.version_info[0]:
+            stdout, stderr = stdout.decode('utf_8'), stderr.decode('utf_8')
+        return {'status': status, 'stdout': stdout, 'stderr': stderr}
 
-class BinaryDelta(Delta):
+    def serve_forever(self):
+        import json
+        try:
+            import socketserver
+        except ImportError:
+            import SocketServer as socketserver
+
+        guilt_server = self
+
+        class QueryHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline().decode('utf_8'))
+                response = guilt_server.answer(request)
+                self.wfile.write(
+                    (json.dumps(response) + '\n').encode('utf_8')
+                )
+
+        socket_dir = os.path.dirname(self.socket_path)
+        if os.path.exists(self.socket_path):
+            # Left behind by a server that didn't shut down cleanly
+            os.unlink(self.socket_path)
+        elif socket_dir and not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+
+        # Only our user may connect, since queries run git in any directory
+        old_umask = os.umask(0o177)
+        try:
+            unix_server = socketserver.ThreadingUnixStreamServer(
+                self.socket_path, QueryHandler
+            )
+        finally:
+            os.umask(old_umask)
+        unix_server.daemon_threads = True
+
+        try:
+            unix_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            unix_server.server_close()
+            os.unlink(self.socket_path)
+
+
+class GuiltBatch(object):
     '''
-    Keeps track of an author's share in the ownership of binary file bytes
-    across all files in the repository.
+    Runs git-guilt over many repositories at once, with a single pool of
+    workers blaming files of every repository, so that the machine is kept
+    busy throughout rather than repository by repository. Each repository
+    gets its fair share of the workers.
+
+    Repositories are planned lazily, as it comes to their turn to have a
+    ticket submitted, so that the pool starts blaming the first repository's
+    files while the others are still being planned.
+
+    The transfer of ownership in each repository is written as an NDJSON
+    record, in the order the repositories were given.
     '''
 
-    def __init__(self, author, since, until):
-        super(BinaryDelta, self).__init__(author, since, until)
+    def __init__(self, jobs, common_args):
+        self.pool = BlameWorkerPool(jobs)
+        # Arguments given to git-guilt for every repository
+        self.common_args = common_args
+        # (repository, PyGuilt, tickets, error message) for every repository,
+        # whose position is the repository's share of the pool
+        self.repositories = list()
+        self.interrupted = False
 
-    def __repr__(self):
-        return "<BinaryDelta \"{author}\": {count} ({since}->{until})>".format(
-            author=self.author,
-            count=self.count,
-            since=self.since_locs,
-            until=self.until_locs,
+    def plan(self, repository, argv):
+        '''
+        Returns an iterator over the blame tickets for a repository, given the
+        arguments git-guilt should be run with in that repository. Nothing is
+        run until the first ticket is asked for.
+        '''
+        self.repositories.append(
+            (repository, None, None, 'Interrupted before it was planned')
         )
+        return self._iter_tickets(len(self.repositories) - 1, repository, argv)
+
+    def _iter_tickets(self, share, repository, argv):
+        '''
+        Yields the blame tickets for a repository as they're planned. If
+        planning fails, the repository gets an error record instead and its
+        tickets that are still queued are dropped.
+        '''
+        try:
+            guilt = PyGuilt(GitRunner(repository))
+            guilt.process_args(argv + self.common_args)
+            tickets = list()
+            self.repositories[share] = (repository, guilt, tickets, None)
+            if 'churn' == guilt.args.mode:
+                guilt.map_churn()
+            else:
+                for ticket in guilt.iter_blame_jobs():
+                    tickets.append(ticket)
+                    yield ticket
+        except (GitError, OSError, ValueError) as ex:
+            error = str(ex).strip()
+        except SystemExit:
+            # argparse has already explained what's wrong on stderr
+            error = 'Invalid arguments: ' + ' '.join(argv)
+        else:
+            return
+        self.repositories[share] = (repository, None, None, error)
+        # The tickets already queued for the repository are skipped
+        self.pool.share_errors.setdefault(share, error)
+
+    def run(self, lines):
+        '''
+        Plans every repository listed, waits for all the blames and writes
+        the records. Returns the exit status.
+        '''
+        import shlex
+
+        try:
+            try:
+                plans = list()
+                for line in lines:
+                    words = shlex.split(line, comments=True)
+                    if words:
+                        plans.append(self.plan(words[0], words[1:]))
+                for share, ticket in BlameWorkerPool.fair_order(plans):
+                    self.pool.submit(ticket, share=share)
+            except BaseException:
+                self.pool.join(cancel=True)
+                raise
+            self.pool.join()
+        except KeyboardInterrupt:
+            self.pool.join(cancel=True)
+            self.interrupted = True
+
+        # A repository some of whose blames failed gets an error record
+        for share, (repository, _, _, error) in enumerate(self.repositories):
+            if error is None and share in self.pool.share_errors:
+                self.repositories[share] = (
+                    repository, None, None,
+                    str(self.pool.share_errors[share]).strip()
+                )
+
+        pruned = set()
+        for _, guilt, _, error in self.repositories:
+            if error is None and guilt.binary_blames and \
+                    guilt.args.textconv_cache not in pruned:
+                guilt.prune_textconv_cache()
+                pruned.add(guilt.args.textconv_cache)
+
+        status = 130 if self.interrupted else 0
+        for repository, guilt, tickets, error in self.repositories:
+            if error is not None:
+                Formatter.terminal_output(
+                    Formatter.format_ndjson(
+                        [], [], repository=repository, error=error
+                    ),
+                    sys.stdout
+                )
+                status = status or 1
+                continue
+
+            if guilt.args.sample:
+                guilt.extrapolate_samples()
+            guilt.reduce_blames()
+            fields = dict(
+                repository=repository,
+                since=guilt.args.since,
+                until=guilt.args.until,
+                complete=not self.interrupted,
+            )
+            approximated = [
+                ticket.describe() for ticket in tickets if ticket.degraded
+            ]
+            if approximated:
+                fields['approximated'] = sorted(approximated)
+            Formatter.terminal_output(
+                Formatter.format_ndjson(
+                    guilt.loc_deltas, guilt.byte_deltas, guilt.lfs_deltas,
+                    **fields
+                ),
+                sys.stdout
+            )
+        return status
 
 
-class PyGuilt(object):
+class GuiltPrepare(object):
     '''
-    Implements the ownership tracking logic
+    Reports on how well suited a repository is to blaming many files, and
+    optionally makes it better suited by writing a commit-graph with
+    changed-path Bloom filters, which fresh clones lack. A sample blame is
+    timed before and after, to show what difference it made.
     '''
 
-    def __init__(self):
-        self.parser = setup_argparser()
-        self.args = None
+    # The configuration git-blame's speed depends on, and git's defaults
+    _reported_config = (
+        ('core.commitGraph', 'true'),
+        ('core.deltaBaseCacheSize', '96m'),
+        ('pack.threads', '0'),
+        ('fetch.writeCommitGraph', 'false'),
+    )
+    # As many loose objects or packs as make git-gc --auto step in
+    _max_loose_objects = 6700
+    _max_packs = 50
+    # How many recent commits we look at to pick the sample file
+    _sample_commits = 100
+    _blame_runs = 3
+
+    def __init__(self, runner):
+        self.runner = runner
 
-        # Job queue for the 'git blame' executions
-        self.blame_jobs = list()
+    def sample_path(self):
+        '''
+        Returns the path of the file changed most often recently that's still
+        there at HEAD, whose blame walks the longest history, or None
+        '''
+        try:
+            records = list(self.runner.iter_git([
+                'log', '-z', '--format=', '--name-only', '--no-renames',
+                '-n', str(GuiltPrepare._sample_commits), 'HEAD'
+            ]))
+        except GitError:
+            # eg. no commits yet
+            return None
+        counts = collections.Counter(
+            record.strip('\n') for record in records if record.strip('\n')
+        )
+        for path, _ in counts.most_common():
+            try:
+                self.runner.run_git(['cat-file', '-s', 'HEAD:' + path])
+            except (GitError, ValueError):
+                continue
+            return path
+        return None
 
-        # Set up ownership buckets for the "since" and "until" revisions
-        # Note: binary and text ownership are fundamentally different (you
-        # can't compare LOCs and individual bytes) and so should be accounted
-        # for separately
-        self.loc_ownership_since = collections.defaultdict(int)
-        self.loc_ownership_until = collections.defaultdict(int)
+    def time_blame(self, path):
+        '''
+        Returns how many seconds the best of a few blames of path at HEAD
+        took, as git-guilt would run them
+        '''
+        timings = list()
+        for _ in range(GuiltPrepare._blame_runs):
+            start = time.time()
+            try:
+                self.runner.run_git(
+                    ['blame', '--incremental', '--', path, 'HEAD'],
+                    git_env=BlameTicket.blame_env(
+                        BlameTicket.config_profiles['bulk']
+                    ),
+                    decode=False
+                )
+            except ValueError:
+                # The file is empty
+                pass
+            timings.append(time.time() - start)
+        return min(timings)
 
-        self.byte_ownership_since = collections.defaultdict(int)
-        self.byte_ownership_until = collections.defaultdict(int)
+    def run(self, write=False, path=None):
+        '''
+        Writes the report on stdout, writing a commit-graph first if `write`
+        is set and the repository lacks one. Returns the exit status.
+        '''
+        def report(label, value):
+            Formatter.terminal_output(
+                u"{0}: {1}".format(label, value), sys.stdout
+            )
 
-        # The relative change in ownership of text file LOCs/binary file byte
-        # for every author. The objects in these lists can be sorted sensibly
-        self.loc_deltas = list()
-        self.byte_deltas = list()
+        def size(kib):
+            return u"{0:.1f} MiB".format(kib / 1024.0)
 
-        # Dictionary
-        # - keys are the "since" and "until" Git revision pointers
-        # given on the CLI
-        # - values are sets of relative paths (as unicode strings) for all
-        # regular files present in the repo for that revision
-        self.trees = dict()
+        hints = list()
+        shallow = self.runner.is_shallow()
+        if shallow:
+            report('Shallow clone', 'yes')
+            hints.append(
+                'Blames stop at the shallow boundary, and commit-graphs are '
+                'ignored: fetch the full history with git fetch --unshallow'
+            )
 
-        # Helper objects
-        try:
-            self.runner = GitRunner()
-        except GitError:
-            # Do something appropriate
+        graphs, bloom_graphs = self.runner.commit_graph_state()
+        report('Commit-graph', '{0} file(s)'.format(graphs) if graphs
+               else 'none')
+        report('Changed-path Bloom filters',
+               'in {0} of {1} file(s)'.format(bloom_graphs, graphs)
+               if bloom_graphs else 'none')
+
+        stats = self.runner.count_objects()
+        report('Loose objects', '{0} ({1})'.format(
+            stats.get('count', 0), size(stats.get('size', 0))
+        ))
+        report('Packs', '{0} ({1})'.format(
+            stats.get('packs', 0), size(stats.get('size-pack', 0))
+        ))
+        if stats.get('count', 0) > GuiltPrepare._max_loose_objects or \
+                stats.get('packs', 0) > GuiltPrepare._max_packs:
+            hints.append('Objects are scattered: pack them with git gc')
+
+        for key, default in GuiltPrepare._reported_config:
+            value = self.runner.get_config(key)
+            report(key, value if value is not None
+                   else '{0} (default)'.format(default))
+        if 'false' == (self.runner.get_config('core.commitGraph') or
+                       '').lower():
+            hints.append('Commit-graphs are disabled by core.commitGraph')
+
+        if path is None:
+            path = self.sample_path()
+        before = None
+        if path is not None:
+            before = self.time_blame(path)
+            report(u'Blaming ' + path, '{0:.2f}s'.format(before))
+
+        up_to_date = graphs and bloom_graphs == graphs
+        if write and not up_to_date and not shallow:
+            if not self.runner.git_supports_changed_paths():
+                Formatter.terminal_output(
+                    'Writing changed-path Bloom filters needs git >= '
+                    '{0}'.format('.'.join(
+                        str(part) for part in GitRunner._min_changed_paths_ver
+                    )),
+                    sys.stderr
+                )
+                return 1
             Formatter.terminal_output(
-                "Could not initialise GitRunner - please run from a "
-                "Git repository.",
-                sys.stderr
+                'Writing a commit-graph with changed-path Bloom filters...',
+                sys.stdout
+            )
+            self.runner.write_commit_graph()
+            if path is not None:
+                after = self.time_blame(path)
+                report(u'Blaming ' + path, '{0:.2f}s ({1:.1f}x as fast)'
+                       .format(after, before / max(after, 0.001)))
+        elif not up_to_date and not shallow:
+            hints.append(
+                'Write a commit-graph with changed-path Bloom filters with '
+                'git guilt prepare --write'
             )
-            raise SystemExit(1)
 
-    def process_args(self):
-        self.args = self.parser.parse_args()
-        if not (self.args.since and self.args.until):
-            raise GitError(self.parser.format_usage())
+        for hint in hints:
+            Formatter.terminal_output(u'Hint: ' + hint, sys.stdout)
+        return 0
 
-    def populate_trees(self):
-        '''
-        Populates self.tree with the set of regular files present in the
-        version of the repo described by self.args.since and self.args.until
-        '''
 
-        self.trees[self.args.since] = self.runner.populate_tree(
-            self.args.since
-        )
-        self.trees[self.args.until] = self.runner.populate_tree(
-            self.args.until
+class GuiltWatch(object):
+    '''
+    Keeps the transfer of ownership between a fixed since revision and a ref
+    that moves, eg. a branch, up to date as commits land on the ref, and
+    writes it as a line of JSON every time it changes.
+
+    Only the files that differ between the commit we last blamed and the
+    one the ref points to now are blamed again. The tallies of the tickets
+    of every changed file are kept, so that the file's old ownership can be
+    taken out of the buckets before its new ownership is added in. Its since
+    revision is only blamed again if the way it's blamed changed.
+
+    Should the ref be rewritten rather than move forward, everything is
+    blamed from scratch, since the history of unchanged files may differ. So
+    is it after an update fails, since some of its tickets may have been
+    tallied and others not.
+    '''
+
+    # Above this many changed paths, the diff isn't restricted to them
+    # literally, lest we run into the limit on command-line length
+    _max_literal_paths = 1000
+
+    def __init__(self, guilt):
+        self.guilt = guilt
+        args = guilt.args
+        for option, used in (
+                ('--mode churn', 'churn' == args.mode),
+                ('--recurse-submodules', args.recurse_submodules),
+                ('--sample', args.sample),
+                ('--working-tree', args.working_tree)):
+            if used:
+                raise GitError(
+                    "git guilt watch can't be used with {0}".format(option)
+                )
+        # Ownership is tallied file by file
+        args.engine = 'per-file'
+
+        self.since = args.since
+        self.until_ref = args.until
+        self.paths = list(args.paths)
+        # The since revision stays where it was when we started
+        args.since = self._resolve(args.since)
+        # The commit the buckets are up to date with
+        self.commit = None
+        # The (since tickets, until tickets) tallied for every changed file
+        self.files = dict()
+        # Set to check the ref before the interval is up
+        self.wakeup = threading.Event()
+
+    def _resolve(self, rev):
+        try:
+            return self.guilt.runner.rev_parse(rev)
+        except (GitError, ValueError):
+            raise GitError(u"{0} isn't a commit".format(rev))
+
+    def _buckets(self):
+        guilt = self.guilt
+        return (
+            (guilt.loc_ownership_since, guilt.byte_ownership_since,
+             guilt.lfs_ownership_since),
+            (guilt.loc_ownership_until, guilt.byte_ownership_until,
+             guilt.lfs_ownership_until),
         )
 
-    def map_blames(self):
+    def _reset(self):
         '''
-        Discovers the set of files that have changed between the Git revision
-        pointed to by the `since` CLI arg and the `until` Git revision
-
-        For each file, adds a blame ticket to self.blame_jobs of the
-        appropriate type (text or binary) for the since and until revision.
+        Forgets everything tallied, so that the next update blames every
+        file again
         '''
+        self.commit = None
+        self.files.clear()
+        for buckets in self._buckets():
+            for bucket in buckets:
+                bucket.clear()
 
-        text_files, binary_files = self.runner.get_delta_files(
-            self.args.since, self.args.until
-        )
+    @staticmethod
+    def _discredit(tickets):
+        '''
+        Takes what the tickets were credited with out of their buckets
+        '''
+        for ticket in tickets:
+            for author, count in (ticket.tallied or {}).items():
+                ticket.bucket[author] -= count
 
-        for repo_path in sorted(text_files):
-            self.blame_jobs.append(
-                TextBlameTicket(
-                    self.runner,
-                    self.loc_ownership_since,
-                    VersionedFile(repo_path, self.args.since),
-                    self.args
-                )
+    def update(self):
+        '''
+        Brings the buckets up to date with the commit the until ref points
+        to. Returns the tickets processed, or None if the ref hasn't moved.
+        '''
+        runner = self.guilt.runner
+        commit = self._resolve(self.until_ref)
+        if commit == self.commit:
+            return None
+
+        if self.commit is not None and runner.is_ancestor(self.commit, commit):
+            self.guilt.args.paths = self.paths
+            paths = runner.changed_paths(
+                self.commit, commit, self.guilt.pathspecs()
             )
+        else:
+            paths = None
+            self._reset()
 
-            self.blame_jobs.append(
-                TextBlameTicket(
-                    self.runner,
-                    self.loc_ownership_until,
-                    VersionedFile(repo_path, self.args.until),
-                    self.args
+        try:
+            tickets = self._blame(commit, paths)
+        except BaseException:
+            # The buckets and files are half updated
+            self._reset()
+            raise
+        self.commit = commit
+        return tickets
+
+    def _blame(self, commit, paths):
+        '''
+        Blames the files among paths that differ between the since revision
+        and commit, or every such file if paths is None, and replaces what
+        their tickets were credited with in the buckets. Returns the tickets
+        processed.
+        '''
+        guilt = self.guilt
+        guilt.args.until = commit
+        guilt.single_commit_authors = None
+        guilt.binary_blames = 0
+        if paths is None or len(paths) > GuiltWatch._max_literal_paths:
+            guilt.args.paths = self.paths
+        else:
+            guilt.args.paths = [':(top,literal)' + path for path in paths]
+
+        since_buckets = self._buckets()[0]
+        planned = collections.defaultdict(lambda: (list(), list()))
+        if paths is None or paths:
+            for ticket in guilt.iter_blame_jobs():
+                repo_path = ticket.versioned_file.repo_path
+                if paths is not None and repo_path not in paths:
+                    continue
+                is_until = not any(
+                    ticket.bucket is bucket for bucket in since_buckets
                 )
+                planned[repo_path][is_until].append(ticket)
+
+        tickets = list()
+        for repo_path in set(planned) | (set(paths or ()) & set(self.files)):
+            since_tickets, until_tickets = planned.get(
+                repo_path, (list(), list())
             )
+            old_tickets = self.files.pop(repo_path, None)
+            if old_tickets is not None:
+                old_since_tickets, old_until_tickets = old_tickets
+                GuiltWatch._discredit(old_until_tickets)
+                if [type(ticket) for ticket in old_since_tickets] == \
+                        [type(ticket) for ticket in since_tickets]:
+                    # The file is blamed the same way at the since revision,
+                    # which hasn't moved
+                    since_tickets = old_since_tickets
+                else:
+                    GuiltWatch._discredit(old_since_tickets)
+                    tickets.extend(since_tickets)
+            else:
+                tickets.extend(since_tickets)
+            tickets.extend(until_tickets)
+            if since_tickets or until_tickets:
+                self.files[repo_path] = (since_tickets, until_tickets)
 
-        if self.runner.git_supports_binary_diff():
-            for repo_path in sorted(binary_files):
-                self.blame_jobs.append(
-                    BinaryBlameTicket(
-                        self.runner,
-                        self.byte_ownership_since,
-                        VersionedFile(repo_path, self.args.since),
-                        self.args
-                    )
-                )
+        pool = BlameWorkerPool(guilt.args.jobs)
+        try:
+            # Costliest files first, as within a single run
+            for ticket in sorted(tickets, key=lambda ticket: -ticket.cost()):
+                pool.submit(ticket)
+        except BaseException:
+            pool.join(cancel=True)
+            raise
+        pool.join()
+
+        # Authors whose lines are all gone from a file no longer show up
+        for buckets in self._buckets():
+            for bucket in buckets:
+                for author in [a for a, count in bucket.items() if not count]:
+                    del bucket[author]
+        if guilt.binary_blames:
+            guilt.prune_textconv_cache()
+        return tickets
+
+    def report(self, tickets):
+        '''
+        Writes the current transfer of ownership as a line of JSON, along
+        with how many blames it took to update it
+        '''
+        guilt = self.guilt
+        guilt.reduce_blames()
+        fields = dict(
+            since=self.since,
+            until=self.until_ref,
+            commit=self.commit,
+            blames=len(tickets),
+        )
+        approximated = [
+            ticket.describe() for ticket in tickets if ticket.degraded
+        ]
+        if approximated:
+            fields['approximated'] = sorted(approximated)
+        Formatter.terminal_output(
+            Formatter.format_ndjson(
+                guilt.loc_deltas, guilt.byte_deltas, guilt.lfs_deltas,
+                **fields
+            ),
+            sys.stdout
+        )
+        # Whoever reads the records shouldn't wait for more to come
+        sys.stdout.flush()
 
-                self.blame_jobs.append(
-                    BinaryBlameTicket(
-                        self.runner,
-                        self.byte_ownership_until,
-                        VersionedFile(repo_path, self.args.until),
-                        self.args
+    def run(self, interval):
+        '''
+        Checks the ref every `interval` seconds, or as soon as `wakeup` is
+        set, until interrupted. Returns the exit status.
+        '''
+        updated = False
+        try:
+            while True:
+                try:
+                    tickets = self.update()
+                except (GitError, ValueError) as ex:
+                    if not updated:
+                        Formatter.terminal_output(str(ex), sys.stderr)
+                        return 1
+                    # eg. the ref is being updated - we'll try again later
+                    Formatter.terminal_output(
+                        u"Couldn't update: {0}".format(str(ex).strip()),
+                        sys.stderr
                     )
-                )
+                    tickets = None
+                if tickets is not None:
+                    updated = True
+                    self.report(tickets)
+                self.wakeup.wait(interval)
+                self.wakeup.clear()
+        except KeyboardInterrupt:
+            return 0
 
-        # Process all blame tickets in the self.blame_jobs queue
-        # TODO This should be made parallel
-        for blame in self.blame_jobs:
-            # FIXME This should be moved to the job enqueueing routine -
-            # there's no point having jobs we're not gonna process
-            if blame.versioned_file.repo_path in \
-                    self.trees[blame.versioned_file.git_revision]:
-                blame.process()
-
-    def _reduce_since_text_blame(self, deltas, since_blame):
-        author, loc_count = since_blame
-        until_loc_count = self.loc_ownership_until[author] or 0
-        deltas.append(Delta(author, loc_count, until_loc_count))
-        return deltas
 
-    def _reduce_since_byte_blame(self, deltas, since_blame):
-        author, byte_count = since_blame
-        until_byte_count = self.byte_ownership_until[author] or 0
-        deltas.append(BinaryDelta(author, byte_count, until_byte_count))
-        return deltas
+def query_server(socket_path, argv):
+    '''
+    Has the git-guilt server listening on socket_path answer the query given
+    by argv, as if git-guilt had been run here, and returns the exit status
+    '''
+    import json
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        request = {'cwd': os.getcwd(), 'argv': argv}
+        client.sendall((json.dumps(request) + '\n').encode('utf_8'))
+        client.shutdown(socket.SHUT_WR)
+        chunks = list()
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error as ex:
+        Formatter.terminal_output(
+            u"Couldn't query the git-guilt server at {0}: {1}".format(
+                socket_path, ex
+            ),
+            sys.stderr
+        )
+        return 1
+    finally:
+        client.close()
+
+    try:
+        response = json.loads(b''.join(chunks).decode('utf_8'))
+    except ValueError:
+        # eg. the server died before answering
+        Formatter.terminal_output(
+            u"The git-guilt server at {0} gave no valid answer".format(
+                socket_path
+            ),
+            sys.stderr
+        )
+        return 1
+    for stream, output in ((sys.stdout, response['stdout']),
+                           (sys.stderr, response['stderr'])):
+        if output:
+            Formatter.terminal_output(output.rstrip('\n'), stream)
+    return response['status']
 
-    def _reduce_until_text_blame(self, deltas, until_blame):
-        author, loc_count = until_blame
-        if author not in self.loc_ownership_since:
-            # We have a new author
-            deltas.append(Delta(author, 0, loc_count))
-        return deltas
 
-    def _reduce_until_byte_blame(self, deltas, until_blame):
-        author, byte_count = until_blame
-        if author not in self.byte_ownership_since:
-            # We have a new author
-            deltas.append(BinaryDelta(author, 0, byte_count))
-        return deltas
+def cache_dir():
+    '''
+    Returns the directory where git-guilt keeps files across runs
+    '''
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'git-guilt')
 
-    def reduce_blames(self):
-        self._reduce_text_blames()
-        self._reduce_byte_blames()
 
-    def _reduce_text_blames(self):
-        self.loc_deltas = functools.reduce(
-            self._reduce_since_text_blame,
-            self.loc_ownership_since.items(),
-            self.loc_deltas
-        )
+def cpu_count():
+    try:
+        return os.cpu_count() or 1
+    except AttributeError:
+        # Python 2
+        import multiprocessing
+        return multiprocessing.cpu_count()
 
-        self.loc_deltas = functools.reduce(
-            self._reduce_until_text_blame,
-            self.loc_ownership_until.items(),
-            self.loc_deltas
-        )
-        self.loc_deltas.sort()
 
-    def _reduce_byte_blames(self):
-        self.byte_deltas = functools.reduce(
-            self._reduce_since_byte_blame,
-            self.byte_ownership_since.items(),
-            self.byte_deltas
-        )
+def config_pair(value):
+    '''
+    Parses the value of the --git-config CLI arg into a (key, value) tuple
+    '''
+    import argparse
 
-        self.byte_deltas = functools.reduce(
-            self._reduce_until_byte_blame,
-            self.byte_ownership_until.items(),
-            self.byte_deltas
+    key, equals, config_value = value.partition('=')
+    if not (key and equals):
+        raise argparse.ArgumentTypeError(
+            "expected KEY=VALUE, got '{0}'".format(value)
         )
+    return (key, config_value)
 
-        self.byte_deltas.sort()
 
-    def run(self):
-        try:
-            self.process_args()
-        except GitError as ex:
-            Formatter.terminal_output(str(ex), sys.stderr)
-            return 1
-        else:
-            self.populate_trees()
-            self.map_blames()
-            self.reduce_blames()
+def line_count(value):
+    '''
+    Parses the value of the --split-lines CLI arg, a number of lines which
+    can't be negative
+    '''
+    import argparse
 
-            formatter = Formatter(self.loc_deltas, self.byte_deltas)
-            formatter.show_guilt_stats(self.loc_deltas)
-            if self.byte_deltas:
-                if self.loc_deltas:
-                    Formatter.terminal_output('---', sys.stdout)
-                formatter.show_guilt_stats(self.byte_deltas)
-            return 0
+    try:
+        lines = int(value)
+        if 0 <= lines:
+            return lines
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        "expected a number of lines, or 0, got '{0}'".format(value)
+    )
 
 
-def setup_argparser():
+def sample_size(value):
     '''
-    Returns an instance of argparse.ArgumentParser for git-guilt
+    Parses the value of the --sample CLI arg, which is either a fraction of
+    the changed files (a float) or a number of files (an int)
     '''
     import argparse
 
-    parser = argparse.ArgumentParser(
+    try:
+        if '.' in value:
+            size = float(value)
+            if 0.0 < size <= 1.0:
+                return size
+        else:
+            size = int(value)
+            if 0 < size:
+                return size
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        "expected a fraction between 0 and 1 or a number of files, "
+        "got '{0}'".format(value)
+    )
+
+
+def setup_argparser(stdout=None, stderr=None):
+    '''
+    Returns an instance of argparse.ArgumentParser for git-guilt, which
+    writes help and usage errors to stdout and stderr if given, rather than
+    sys.stdout and sys.stderr
+    '''
+    import argparse
+
+    class GuiltArgumentParser(argparse.ArgumentParser):
+        def print_usage(self, file=None):
+            super(GuiltArgumentParser, self).print_usage(file or stdout)
+
+        def print_help(self, file=None):
+            super(GuiltArgumentParser, self).print_help(file or stdout)
+
+        def error(self, message):
+            self.print_usage(stderr or sys.stderr)
+            self.exit(2, '{0}: error: {1}\n'.format(self.prog, message))
+
+        def exit(self, status=0, message=None):
+            if message:
+                (stderr or sys.stderr).write(message)
+            sys.exit(status)
+
+    parser = GuiltArgumentParser(
         prog='git guilt',
         description='''
 git-guilt is a custom tool written for git(1). It provides
@@ -814,6 +4481,9 @@ revisions of a repository.
         '''.strip(),
         epilog='''
 Please note that git-guilt needs git >= 1.7.2 in order to process binary files.
+serve, batch, prepare and watch are taken as subcommands when given first: to
+compare revisions with those names, put -- before them, eg. git guilt -- watch
+HEAD.
         '''.strip()
     )
     parser.add_argument(
@@ -823,6 +4493,177 @@ Please note that git-guilt needs git >= 1.7.2 in order to process binary files.
         'authors\' email addresses instead of their names',
     )
 
+    parser.add_argument(
+        '--mode',
+        choices=('blame', 'churn'),
+        default='blame',
+        help='How ownership is measured. blame compares git-blame of the '
+        'since and until revisions. churn is a much faster approximation '
+        'that credits every author with the lines they added minus those '
+        'they removed in between, from a single git-log '
+        '(default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--engine',
+        choices=('per-file', 'history-walk'),
+        default='per-file',
+        help='How text files are blamed. per-file runs git-blame for every '
+        'file. history-walk replays the history once for all of them, which '
+        'is much faster for many files, but only works on ranges without '
+        'merges: per-file is used otherwise (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--backend',
+        choices=('git', 'pygit2'),
+        default='git',
+        help='How objects are read. git runs a git process for every lookup. '
+        'pygit2 reads objects and diffs trees in-process, and needs pygit2 to '
+        'be installed. Blames are run by git either way '
+        '(default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=cpu_count(),
+        help='The number of git-blame processes to run concurrently '
+        '(default: the number of CPUs)',
+    )
+
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Report how long blaming took on the standard error stream',
+    )
+
+    parser.add_argument(
+        '--progress',
+        type=float,
+        metavar='SECONDS',
+        help='Report progress and the transfer of ownership so far every '
+        'SECONDS seconds while blaming. Interim results are redrawn in place '
+        'on a terminal',
+    )
+    parser.add_argument(
+        '--format',
+        choices=('table', 'ndjson'),
+        default='table',
+        help='Output the transfer of ownership as a table, or as '
+        'newline-delimited JSON records, one per progress report and a final '
+        'one with "complete" set (default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '--split-lines',
+        type=line_count,
+        default=20000,
+        metavar='LINES',
+        help='Blame files longer than LINES lines as several ranges of at '
+        'most LINES lines that are processed concurrently. Text files of '
+        'at most 16 bytes times LINES are left whole. 0 disables splitting '
+        '(default: %(default)s)',
+    )
+
+    parser.add_argument(
+        '-x', '--exclude',
+        action='append',
+        default=[],
+        metavar='GLOB',
+        help='Don\'t blame files whose path from the top of the repository '
+        'matches GLOB. May be given several times',
+    )
+    parser.add_argument(
+        '--skip-generated',
+        action='store_true',
+        help='Don\'t blame files marked as linguist-generated or -diff in '
+        'gitattributes',
+    )
+
+    parser.add_argument(
+        '--recurse-submodules',
+        action='store_true',
+        help='Also blame the files that changed in submodules between the '
+        'commits they were at in either revision',
+    )
+
+    parser.add_argument(
+        '--max-file-bytes',
+        type=int,
+        metavar='BYTES',
+        help='Don\'t blame files larger than BYTES bytes. Their content is '
+        'credited to the author of the last commit that modified them',
+    )
+    parser.add_argument(
+        '--max-blame-seconds',
+        type=float,
+        metavar='SECONDS',
+        help='Stop blaming a file after SECONDS seconds and credit its '
+        'content to the author of the last commit that modified it',
+    )
+
+    parser.add_argument(
+        '--textconv-cache',
+        metavar='DIR',
+        help='Where to cache the conversion of binary files to text for '
+        'blaming, rather than as notes in the repository (default: the '
+        'textconv directory of the git-guilt cache)',
+    )
+    parser.add_argument(
+        '--textconv-cache-bytes',
+        type=int,
+        default=1 << 30,
+        metavar='BYTES',
+        help='The size the textconv cache is pruned down to after each run, '
+        'or 0 not to cache conversions (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--git-profile',
+        choices=sorted(BlameTicket.config_profiles),
+        default='bulk',
+        help='The Git configuration blames are run with, on top of the '
+        'user\'s and the repository\'s: bulk is tuned for running many of '
+        'them and blames text files without textconv filters, none adds '
+        'nothing (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--git-config',
+        type=config_pair,
+        action='append',
+        default=[],
+        metavar='KEY=VALUE',
+        help='Git configuration to run blames with, on top of the profile\'s. '
+        'May be given more than once.',
+    )
+
+    parser.add_argument(
+        '--working-tree',
+        action='store_true',
+        help='Report the transfer of ownership from the since revision '
+        '(default: HEAD) to the working tree, ie. what committing every '
+        'change in it would do. Any argument after the since revision is a '
+        'path, as is the first one if it isn\'t a commit. Uncommitted lines '
+        'are credited to the author of the next commit, and blames of the '
+        'since revision are kept between runs, so that only changed files are '
+        'blamed again.',
+    )
+    parser.add_argument(
+        '--sample',
+        type=sample_size,
+        metavar='FRACTION|N',
+        help='Only blame a random sample of the changed files, either a '
+        'fraction (eg. 0.1) or a number of files, and estimate the transfer '
+        'of ownership from it. Estimates come with a 95%% confidence margin',
+    )
+    parser.add_argument(
+        '--sample-seed',
+        type=int,
+        metavar='SEED',
+        help='Seeds the random choice of files for --sample, so that the same '
+        'sample can be drawn again',
+    )
+
     # TODO Surely there can be sensible defaults for the since and until revs
     parser.add_argument(
         'since',
@@ -838,10 +4679,194 @@ Please note that git-guilt needs git >= 1.7.2 in order to process binary files.
         help='The revision until which the transfer of blame should be '
         'reported',
     )
+    parser.add_argument(
+        'paths',
+        metavar='path',
+        nargs='*',
+        help='Only report on files matching these paths or pathspecs',
+    )
     return parser
 
 
+def serve(argv):
+    '''
+    Runs the git-guilt server, as started by `git guilt serve`
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='git guilt serve',
+        description='''
+Answers git-guilt queries from a long-running process that keeps blames in
+memory, so that repeated queries are answered much faster. git-guilt sends its
+queries to the server when GIT_GUILT_SERVER is set to the server's socket.
+        '''.strip(),
+    )
+    parser.add_argument(
+        '--socket',
+        default=os.path.join(cache_dir(), 'server.sock'),
+        metavar='PATH',
+        help='The Unix domain socket to listen on (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--cache-entries',
+        type=int,
+        default=100000,
+        metavar='N',
+        help='The number of blames to keep in memory (default: %(default)s)',
+    )
+    args = parser.parse_args(argv)
+
+    GuiltServer(args.socket, args.cache_entries).serve_forever()
+    return 0
+
+
+def batch(argv):
+    '''
+    Runs git-guilt over many repositories, as started by `git guilt batch`
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='git guilt batch',
+        description='''
+Runs git-guilt in every repository listed, blaming files of all of them on a
+single pool of workers, and writes the transfer of ownership in each as a line
+of JSON. Every line of the list holds the path to a repository, optionally
+followed by the git-guilt arguments to use there, eg. the since and until
+revisions. Lines starting with # are ignored.
+        '''.strip(),
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=cpu_count(),
+        help='The number of git-blame processes to run concurrently, across '
+        'all repositories (default: the number of CPUs)',
+    )
+    parser.add_argument(
+        'repositories',
+        metavar='LIST',
+        help='The file listing repositories, or - for stdin',
+    )
+    parser.add_argument(
+        'common_args',
+        nargs=argparse.REMAINDER,
+        metavar='...',
+        help='git-guilt arguments used in every repository',
+    )
+    args = parser.parse_args(argv)
+
+    guilt_batch = GuiltBatch(args.jobs, args.common_args)
+    if '-' == args.repositories:
+        return guilt_batch.run(sys.stdin)
+    with open(args.repositories) as repositories:
+        return guilt_batch.run(repositories)
+
+
+def prepare(argv):
+    '''
+    Reports on and tunes the repository for blaming, as started by
+    `git guilt prepare`
+    '''
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='git guilt prepare',
+        description='''
+Reports on what makes blaming fast in the current repository: its commit-graph
+and changed-path Bloom filters, how its objects are packed and the relevant Git
+configuration, along with how long a sample blame takes.
+        '''.strip(),
+    )
+    parser.add_argument(
+        '--write',
+        action='store_true',
+        help='Write a commit-graph with changed-path Bloom filters if the '
+        'repository lacks one, and time the sample blame again',
+    )
+    parser.add_argument(
+        '--path',
+        help='The file to time the blame of (default: the file changed most '
+        'often in recent commits)',
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        runner = GitRunner()
+    except GitError:
+        Formatter.terminal_output(
+            "Could not initialise GitRunner - please run from a "
+            "Git repository.",
+            sys.stderr
+        )
+        return 1
+    path = args.path
+    if path is not None:
+        path = runner.pathspec_from_cwd(path)
+    try:
+        return GuiltPrepare(runner).run(args.write, path)
+    except GitError as ex:
+        Formatter.terminal_output(str(ex).strip(), sys.stderr)
+        return 1
+
+
+def watch(argv):
+    '''
+    Keeps the transfer of ownership up to date as commits land, as started
+    by `git guilt watch`
+    '''
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(
+        prog='git guilt watch',
+        usage='%(prog)s [--interval SECONDS] [git-guilt options] since ref '
+        '[path ...]',
+        description='''
+Writes the transfer of ownership between a since revision and a ref, eg. a
+branch, as a line of JSON, then again every time the ref moves. Only the files
+changed by the commits that landed in the meantime are blamed again. Sending
+SIGUSR1 makes git-guilt check the ref right away, eg. from a hook. Any other
+argument is passed on to git-guilt.
+        '''.strip(),
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=60.0,
+        metavar='SECONDS',
+        help='How often the ref is checked (default: %(default)s)',
+    )
+    args, guilt_argv = parser.parse_known_args(argv)
+
+    guilt = PyGuilt()
+    try:
+        guilt.process_args(guilt_argv)
+        guilt_watch = GuiltWatch(guilt)
+    except (GitError, ValueError) as ex:
+        Formatter.terminal_output(str(ex).strip(), sys.stderr)
+        return 1
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(
+            signal.SIGUSR1, lambda signum, frame: guilt_watch.wakeup.set()
+        )
+    return guilt_watch.run(args.interval)
+
+
 def main():
+    argv = sys.argv[1:]
+    if ['serve'] == argv[:1]:
+        sys.exit(serve(argv[1:]))
+    if ['batch'] == argv[:1]:
+        sys.exit(batch(argv[1:]))
+    if ['prepare'] == argv[:1]:
+        sys.exit(prepare(argv[1:]))
+    if ['watch'] == argv[:1]:
+        sys.exit(watch(argv[1:]))
+    if os.environ.get('GIT_GUILT_SERVER'):
+        sys.exit(query_server(os.environ['GIT_GUILT_SERVER'], argv))
     sys.exit(PyGuilt().run())
 
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2015, Matt Boyer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''
+Measures how long git-guilt takes to blame a range of history under each of
+the Git configuration profiles of --git-profile, so that the settings of the
+bulk profile can be checked against the user's own configuration.
+
+Run this from within a Git repository:
+
+    python test/benchmark_profile.py SINCE UNTIL [RUNS]
+'''
+from __future__ import print_function
+
+import os
+import sys
+
+from benchmark_startup import median_run_time
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.exit(__doc__.strip())
+    since, until = sys.argv[1:3]
+    runs = int(sys.argv[3]) if 3 < len(sys.argv) else 5
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)
+    ))
+
+    timings = dict()
+    for profile in ('none', 'bulk'):
+        timings[profile] = median_run_time(
+            [
+                sys.executable, '-c',
+                'from git_guilt.guilt import main; main()',
+                '--format', 'ndjson', '--git-profile', profile, since, until,
+            ],
+            runs,
+            env
+        )
+    print(
+        "Median of {runs} runs: none {none:.2f}s, bulk {bulk:.2f}s "
+        "({speedup:.2f}x as fast)".format(
+            runs=runs,
+            none=timings['none'],
+            bulk=timings['bulk'],
+            speedup=timings['none'] / timings['bulk'],
+        )
+    )
+
+
+if '__main__' == __name__:
+    main()
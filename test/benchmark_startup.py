@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Copyright (c) 2015, Matt Boyer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+'''
+Measures the fixed cost of starting git-guilt, ie. how long it takes to run
+when there's nothing to report, compared to starting Python itself.
+
+Run this from within a Git repository:
+
+    python test/benchmark_startup.py [RUNS]
+'''
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+
+def median_run_time(command, runs, env):
+    timings = list()
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, env=env)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if 1 < len(sys.argv) else 20
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)
+    ))
+
+    python = median_run_time([sys.executable, '-c', 'pass'], runs, env)
+    guilt = median_run_time(
+        [
+            sys.executable, '-c', 'from git_guilt.guilt import main; main()',
+            '--mode', 'churn', 'HEAD', 'HEAD',
+        ],
+        runs,
+        env
+    )
+    print(
+        "Median of {runs} runs: python {python:.1f}ms, git-guilt "
+        "{guilt:.1f}ms, overhead {overhead:.1f}ms".format(
+            runs=runs,
+            python=python * 1000,
+            guilt=guilt * 1000,
+            overhead=(guilt - python) * 1000,
+        )
+    )
+
+
+if '__main__' == __name__:
+    main()
@@ -29,17 +29,30 @@
 # -*- coding: UTF-8 -*-
 
 blame_author_names = '''
-f4d74b57 (Tim Pettersen 2013-12-29 09:42:51 -0800  1) # git-guilt
-f4d74b57 (Tim Pettersen 2013-12-29 09:42:51 -0800  2) 
-35f9416f (Tim Pettersen 2013-12-30 13:58:06 -0800  3) Calculates the change in blame between two revisions.
-35f9416f (Foo Bar 2013-12-30 13:58:06 -0800  4) 
-35f9416f (Foo Bar 2013-12-30 13:58:06 -0800  5) ## Usage
-'''.strip()
-
-binary_blame= '''
-f4d74b57 (Tim Pettersen 2013-12-29 09:42:51 -0800  1) 00
-f4d74b57 (Tim Pettersen 2013-12-29 09:42:51 -0800  2) 0D
-35f9416f (Tim Pettersen 2013-12-30 13:58:06 -0800  3) 4A
-35f9416f (Foo Bar 2013-12-30 13:58:06 -0800  4) B4
-35f9416f (Foo Bar 2013-12-30 13:58:06 -0800  5) D7
-'''.strip()
+f4d74b57b4c7d0c0a8de0bb3b3c3e98e64c8f2a1 1 1 2
+author Tim Pettersen
+author-mail <tim@example.com>
+author-time 1388338971
+author-tz -0800
+committer Tim Pettersen
+committer-mail <tim@example.com>
+committer-time 1388338971
+committer-tz -0800
+summary Initial commit
+boundary
+filename README.md
+35f9416fd3c2ab4e5ff7c0ba8f1e2b7c4a6d9e03 4 4 2
+author Foo Bar
+author-mail <foo@example.com>
+author-time 1388440686
+author-tz -0800
+committer Foo Bar
+committer-mail <foo@example.com>
+committer-time 1388440686
+committer-tz -0800
+summary Usage
+previous f4d74b57b4c7d0c0a8de0bb3b3c3e98e64c8f2a1 README.md
+filename README.md
+f4d74b57b4c7d0c0a8de0bb3b3c3e98e64c8f2a1 3 3 1
+filename README.md
+'''.lstrip()
@@ -28,8 +28,13 @@
 #     NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 #     SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import argparse
+import collections
 import io
+import json
+import os
 import sys
+import time
 from mock import patch, Mock, call
 from unittest import TestCase
 import test.constants
@@ -107,6 +112,22 @@ class DeltaTestCase(TestCase):
         self.assertEquals("<Delta \"Beta\": -6 (16->10)>", repr(b))
         self.assertEquals("<Delta \"Gamma\": 0 (8->8)>", repr(c))
 
+    def test_sort_key(self):
+        deltas = [
+            guilt_module.Delta('Carol', 4, 0),
+            guilt_module.Delta('Bob', 0, 4),
+            guilt_module.Delta('Alice', 0, 4),
+        ]
+        deltas.sort(key=guilt_module.Delta.sort_key)
+        self.assertEquals(['Alice', 'Bob', 'Carol'], [d.author for d in deltas])
+        self.assertEquals(sorted(deltas), deltas)
+
+    def test_slots(self):
+        a = guilt_module.Delta('Alpha', 0, 4)
+        self.assertFalse(hasattr(a, '__dict__'))
+        b = guilt_module.BinaryDelta('Alpha', 0, 4)
+        self.assertFalse(hasattr(b, '__dict__'))
+
 class BinaryDeltaTestCase(TestCase):
 
     def test_eq(self):
@@ -265,6 +286,35 @@ class GitRunnerTestCase(TestCase):
     def tearDown(self):
         pass
 
+    @patch('git_guilt.guilt.GitRunner._find_git_executable')
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_startup_processes(self, mock_run_git, mock_find_git):
+        import shutil
+        import tempfile
+
+        cache_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_home)
+        # Stands in for the git executable, whose size and mtime key the cache
+        mock_find_git.return_value = os.path.join(cache_home, 'git')
+        with open(mock_find_git.return_value, 'w') as executable:
+            executable.write('#!/bin/sh\n')
+        mock_run_git.side_effect = lambda args, **kwargs: (
+            ['git version 2.30.1'] if ['--version'] == args
+            else ['/my/arbitrary/path']
+        )
+
+        with patch.dict('os.environ', {'XDG_CACHE_HOME': cache_home}):
+            guilt = guilt_module.PyGuilt()
+            self.assertEquals((2, 30, 1), guilt.runner.version)
+            self.assertEquals(2, mock_run_git.call_count)
+
+            # Once the version is cached, starting up only runs git to find
+            # the repository
+            mock_run_git.reset_mock()
+            guilt = guilt_module.PyGuilt()
+            self.assertEquals((2, 30, 1), guilt.runner.version)
+            mock_run_git.assert_called_once_with(['rev-parse', '--show-toplevel'])
+
     @patch('git_guilt.guilt.subprocess.Popen')
     def test_version_retrieval(self, mock_process):
         mock_process.return_value.communicate = Mock(
@@ -439,6 +489,532 @@ class GitRunnerTestCase(TestCase):
 
         self.assertRaises(ValueError, self.runner.get_delta_files, 'HEAD~1', 'HEAD')
 
+    @patch('git_guilt.guilt.GitRunner.get_lfs_sizes')
+    @patch('git_guilt.guilt.GitRunner.get_blob_sizes')
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_iter_delta_files(self, mock_iter_git, mock_sizes, mock_lfs_sizes):
+        mock_iter_git.side_effect = [
+            iter([
+                ':000000 100644 0000 1111 A', 'added.c',
+                ':100644 000000 2222 0000 D', 'deleted.c',
+                ':160000 160000 5555 6666 M', 'submodule',
+                ':100644 100644 3333 4444 M', 'image.png',
+            ]),
+            iter([
+                '3\t0\tadded.c', '0\t7\tdeleted.c', '-\t-\timage.png',
+                '1\t1\tsubmodule', '',
+            ]),
+        ]
+        mock_sizes.return_value = {
+            '1111': 10, '2222': 20, '3333': 30, '4444': 4000
+        }
+        mock_lfs_sizes.return_value = {'1111': 123456}
+
+        changed_files = list(self.runner.iter_delta_files('HEAD~1', 'HEAD'))
+        # Only small blobs may be LFS pointers
+        self.assertEquals(['1111', '2222', '3333'], sorted(mock_lfs_sizes.call_args[0][0]))
+
+        # The raw records take no content diff, and the line counts are only
+        # read for the paths that changed
+        self.assertEquals(
+            [
+                call([
+                    'diff', '-z', '--raw', '--no-renames', '--no-abbrev',
+                    'HEAD~1', 'HEAD'
+                ]),
+                call([
+                    'diff', '-z', '--numstat', '--no-renames', 'HEAD~1',
+                    'HEAD', '--', ':(top,literal)added.c',
+                    ':(top,literal)deleted.c', ':(top,literal)image.png',
+                    ':(top,literal)submodule'
+                ]),
+            ],
+            mock_iter_git.call_args_list
+        )
+        # Sizes are only looked up for blobs
+        self.assertEquals(
+            ['1111', '2222', '3333', '4444'],
+            sorted(mock_sizes.call_args[0][0])
+        )
+        # The costliest file comes first, even though git listed it last
+        self.assertEquals(
+            [
+                ('image.png', True, True, True, 30, 4000, None, None, None),
+                ('deleted.c', False, True, False, 20, 0, None, None, 0),
+                ('added.c', False, False, True, 0, 10, None, 123456, 3),
+                ('submodule', False, False, False, 0, 0, None, None, 1),
+            ],
+            [(f.repo_path, f.is_binary, f.in_since, f.in_until, f.since_size, f.until_size, f.since_lfs_size, f.until_lfs_size, f.additions) for f in changed_files]
+        )
+
+        mock_iter_git.reset_mock()
+        mock_iter_git.side_effect = [iter([])]
+        self.assertEquals([], list(self.runner.iter_delta_files('HEAD~1', 'HEAD', ['src', ':(exclude)*.bin'])))
+        mock_iter_git.assert_called_once_with([
+            'diff', '-z', '--raw', '--no-renames', '--no-abbrev',
+            'HEAD~1', 'HEAD', '--', 'src', ':(exclude)*.bin'
+        ])
+
+    @patch('git_guilt.guilt.GitRunner._read_numstat')
+    @patch('git_guilt.guilt.GitRunner.get_lfs_sizes')
+    @patch('git_guilt.guilt.GitRunner.get_blob_sizes')
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_iter_delta_files_batches(self, mock_iter_git, mock_sizes, mock_lfs_sizes, mock_numstat):
+        raw = list()
+        for index in range(30):
+            raw.extend([':000000 100644 0000 {0:04} A'.format(index), 'f{0}.c'.format(index)])
+        mock_iter_git.return_value = iter(raw)
+        mock_sizes.return_value = dict(('{0:04}'.format(index), index) for index in range(30))
+        mock_lfs_sizes.return_value = {}
+        batches = list()
+
+        def read_numstat(since_rev, until_rev, changed_files):
+            batches.append([f.repo_path for f in changed_files])
+            for changed_file in changed_files:
+                changed_file.is_binary = False
+
+        mock_numstat.side_effect = read_numstat
+
+        delta_files = self.runner.iter_delta_files('HEAD~1', 'HEAD')
+        # Only the first batch is diffed before the first file is yielded
+        self.assertEquals('f29.c', next(delta_files).repo_path)
+        self.assertEquals([['f{0}.c'.format(index) for index in range(29, 21, -1)]], batches)
+
+        self.assertEquals(29, len(list(delta_files)))
+        self.assertEquals([8, 16, 6], [len(batch) for batch in batches])
+
+    @patch('git_guilt.guilt.GitRunner.working_tree_size')
+    @patch('git_guilt.guilt.GitRunner.get_lfs_sizes')
+    @patch('git_guilt.guilt.GitRunner.get_blob_sizes')
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_iter_delta_files_working_tree(self, mock_iter_git, mock_sizes, mock_lfs_sizes, mock_working_size):
+        mock_iter_git.side_effect = [
+            iter([
+                ':100644 100644 1111 0000 M', 'dirty.c',
+                ':100644 100644 2222 3333 M', 'staged.c',
+                ':100644 000000 4444 0000 D', 'deleted.c',
+                ':100644 100755 5555 5555 M', 'script.sh',
+            ]),
+            iter(['1\t0\tdirty.c', '2\t0\tstaged.c', '0\t5\tdeleted.c', '']),
+        ]
+        mock_sizes.return_value = {'1111': 10, '2222': 20, '3333': 30, '4444': 40, '5555': 1}
+        mock_lfs_sizes.return_value = {}
+        mock_working_size.return_value = 12
+
+        changed_files = list(self.runner.iter_delta_files('HEAD', None))
+        self.assertEquals(
+            [
+                call([
+                    'diff', '-z', '--raw', '--no-renames', '--no-abbrev',
+                    'HEAD'
+                ]),
+                call([
+                    'diff', '-z', '--numstat', '--no-renames', 'HEAD', '--',
+                    ':(top,literal)deleted.c', ':(top,literal)dirty.c',
+                    ':(top,literal)script.sh', ':(top,literal)staged.c'
+                ]),
+            ],
+            mock_iter_git.call_args_list
+        )
+        # Files that differ from the index haven't been hashed, so their size
+        # is read from the working tree
+        mock_working_size.assert_called_once_with('dirty.c')
+        self.assertEquals(
+            [
+                ('staged.c', '2222', '3333', 20, 30, 2),
+                ('deleted.c', '4444', None, 40, 0, 0),
+                ('dirty.c', '1111', '', 10, 12, 1),
+                # A mode change has no line diff
+                ('script.sh', '5555', '5555', 1, 1, 0),
+            ],
+            [(f.repo_path, f.since_blob, f.until_blob, f.since_size, f.until_size, f.additions) for f in changed_files]
+        )
+        self.assertEquals([True, False, True, True], [f.in_until for f in changed_files])
+        self.assertEquals([False] * 4, [f.is_binary for f in changed_files])
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_is_first_parent_ancestor(self, mock_run_git):
+        mock_run_git.side_effect = [
+            ['1111\n'],
+            ['3333 2222 9999\n', '2222 1111\n'],
+            ['1111\n'],
+            ['3333 2222 9999\n', '2222 8888 1111\n'],
+        ]
+        self.assertTrue(self.runner.is_first_parent_ancestor('HEAD~2', 'HEAD'))
+        mock_run_git.assert_called_with(
+            ['rev-list', '--first-parent', '--parents', 'HEAD~2..HEAD']
+        )
+        # Only reachable through the second parent of a merge
+        self.assertFalse(self.runner.is_first_parent_ancestor('side', 'HEAD'))
+
+        mock_run_git.side_effect = [['1111\n'], ValueError('No output'), ['1111\n']]
+        self.assertTrue(self.runner.is_first_parent_ancestor('HEAD', 'HEAD'))
+
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_iter_churn(self, mock_iter_git):
+        mock_iter_git.return_value = iter([
+            '\x01Alice', '\n:000000 100644 0000 1111 A', 'added.c',
+            ':100644 100644 2222 3333 M', 'image.png',
+            '3\t0\tadded.c', '-\t-\timage.png',
+            # A merge, which has no diff
+            '\x01Bob', '',
+            '\x01Carol', '\n:100644 100644 1111 4444 M', 'added.c',
+            ':160000 160000 5555 6666 M', 'submodule',
+            '2\t1\tadded.c', '1\t1\tsubmodule', '',
+        ])
+
+        churn = list(self.runner.iter_churn('HEAD~4', 'HEAD', ['src'], True))
+
+        mock_iter_git.assert_called_once_with([
+            'log', '-z', '--raw', '--numstat', '--no-renames', '--no-abbrev',
+            '--format=%x01<%aE>', 'HEAD~4..HEAD', '--', 'src'
+        ])
+        self.assertEquals(
+            [
+                ('Alice', 'added.c', False, 3, 0, None, None),
+                ('Alice', 'image.png', True, 0, 0, '2222', '3333'),
+                ('Carol', 'added.c', False, 2, 1, None, None),
+            ],
+            [(c.author, c.repo_path, c.is_binary, c.additions, c.deletions, c.old_blob, c.new_blob) for c in churn]
+        )
+
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_get_single_commit_authors(self, mock_iter_git):
+        mock_iter_git.return_value = iter([
+            # A merge that added a file itself, and touched another
+            '\x01Merger', '',
+            '::000000 000000 100644 0000 0000 1111 AA', 'merged.c',
+            '::100644 100644 100644 2222 3333 4444 MM', 'touched.c',
+            '\x01Alice', '',
+            '\n:000000 100644 0000 5555 A', 'vendor/a.c',
+            ':000000 100644 0000 6666 A', 'touched.c',
+            ':100644 100644 7777 7777 R100', 'old.c', 'renamed.c',
+            '\x01Bob', '',
+            ':000000 100644 0000 8888 A', 'vendor/b.c',
+            ':000000 100644 0000 9999 A', 'twice.c',
+            '\x01Carol', '',
+            '\n:100644 100644 9999 aaaa M', 'twice.c',
+        ])
+
+        self.assertEquals(
+            {'merged.c': 'Merger', 'vendor/a.c': 'Alice', 'vendor/b.c': 'Bob'},
+            self.runner.get_single_commit_authors('v1', 'v2', ['vendor', 'src'], email=True)
+        )
+        mock_iter_git.assert_called_once_with([
+            'log', '-z', '--raw', '-c', '-M', '--no-abbrev', '--format=%x01<%aE>',
+            'v1..v2', '--', 'vendor', 'src'
+        ])
+
+        mock_iter_git.side_effect = guilt_module.GitError('bad revision')
+        self.assertEquals({}, self.runner.get_single_commit_authors('4b825dc', 'v2'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_count_objects(self, mock_run_git):
+        mock_run_git.return_value = [
+            'count: 12', 'size: 48', 'in-pack: 3000', 'packs: 2',
+            'size-pack: 2048', 'prune-packable: 0', 'garbage: 0',
+            'size-garbage: 0', 'alternate: /elsewhere/objects',
+        ]
+        self.assertEquals(
+            {'count': 12, 'size': 48, 'in-pack': 3000, 'packs': 2, 'size-pack': 2048,
+             'prune-packable': 0, 'garbage': 0, 'size-garbage': 0},
+            self.runner.count_objects()
+        )
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_get_config(self, mock_run_git):
+        mock_run_git.return_value = ['256m\n']
+        self.assertEquals('256m', self.runner.get_config('core.deltaBaseCacheSize'))
+        mock_run_git.assert_called_once_with(['config', '--get', 'core.deltaBaseCacheSize'])
+
+        mock_run_git.side_effect = guilt_module.GitError('exit status 1')
+        self.assertEquals(None, self.runner.get_config('pack.threads'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_commit_graph_state(self, mock_run_git):
+        import shutil
+        import struct
+        import tempfile
+
+        def graph(*chunk_ids):
+            header = b'CGPH' + struct.pack('BBBB', 1, 1, len(chunk_ids), 0)
+            return header + b''.join(
+                chunk_id + struct.pack('>Q', 0) for chunk_id in chunk_ids + (b'\0\0\0\0',)
+            )
+
+        info_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, info_dir)
+        mock_run_git.return_value = [info_dir]
+        self.assertEquals((0, 0), self.runner.commit_graph_state())
+
+        with open(os.path.join(info_dir, 'commit-graph'), 'wb') as graph_file:
+            graph_file.write(graph(b'OIDF', b'OIDL', b'CDAT'))
+        self.assertEquals((1, 0), self.runner.commit_graph_state())
+
+        # A chain of graphs, only the newest of which has Bloom filters
+        os.mkdir(os.path.join(info_dir, 'commit-graphs'))
+        with open(os.path.join(info_dir, 'commit-graphs', 'commit-graph-chain'), 'w') as chain:
+            chain.write('1111\n2222\n')
+        with open(os.path.join(info_dir, 'commit-graphs', 'graph-1111.graph'), 'wb') as graph_file:
+            graph_file.write(graph(b'OIDF', b'OIDL', b'CDAT'))
+        with open(os.path.join(info_dir, 'commit-graphs', 'graph-2222.graph'), 'wb') as graph_file:
+            graph_file.write(graph(b'OIDF', b'OIDL', b'CDAT', b'BIDX', b'BDAT'))
+        os.remove(os.path.join(info_dir, 'commit-graph'))
+        self.assertEquals((2, 1), self.runner.commit_graph_state())
+
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_iter_submodule_changes(self, mock_iter_git):
+        mock_iter_git.return_value = iter([
+            ':100644 100644 1111 2222 M', 'README',
+            ':160000 160000 3333 4444 M', 'lib/bumped',
+            ':000000 160000 0000 5555 A', 'lib/added',
+            ':160000 000000 6666 0000 D', 'lib/removed',
+        ])
+
+        self.assertEquals(
+            [
+                ('lib/bumped', '3333', '4444'),
+                ('lib/added', None, '5555'),
+                ('lib/removed', '6666', None),
+            ],
+            list(self.runner.iter_submodule_changes('HEAD~4', 'HEAD', ['lib']))
+        )
+        mock_iter_git.assert_called_once_with([
+            'diff', '-z', '--raw', '--no-renames', '--no-abbrev',
+            '--ignore-submodules=none', 'HEAD~4', 'HEAD', '--', 'lib'
+        ])
+
+    @patch('git_guilt.guilt.GitRunner._iter_git_chunks')
+    def test_count_lines(self, mock_chunks):
+        mock_chunks.return_value = iter([b'a\nb', b'\n\xe9\n'])
+        self.assertEquals(3, self.runner.count_lines('1111'))
+        mock_chunks.assert_called_once_with(['cat-file', 'blob', '1111'])
+
+        # No trailing newline
+        mock_chunks.return_value = iter([b'a\nb'])
+        self.assertEquals(2, self.runner.count_lines('1111'))
+
+        # Empty blob
+        mock_chunks.return_value = iter([])
+        self.assertEquals(0, self.runner.count_lines('1111'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_last_author(self, mock_run_git):
+        mock_run_git.return_value = ['Foo Bar']
+        self.assertEquals('Foo Bar', self.runner.last_author('a.c', 'HEAD'))
+        mock_run_git.assert_called_once_with(
+            ['log', '-1', '--format=%aN', 'HEAD', '--', 'a.c']
+        )
+
+        mock_run_git.return_value = ['<foo@example.com>']
+        self.assertEquals('<foo@example.com>', self.runner.last_author('a.c', 'HEAD', True))
+        self.assertEquals(
+            ['log', '-1', '--format=<%aE>', 'HEAD', '--', 'a.c'],
+            mock_run_git.call_args[0][0]
+        )
+
+        mock_run_git.side_effect = ValueError('No output')
+        self.assertEquals(None, self.runner.last_author('a.c', 'HEAD'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_is_ancestor(self, mock_run_git):
+        mock_run_git.side_effect = ValueError('No output')
+        self.assertTrue(self.runner.is_ancestor('HEAD~1', 'HEAD'))
+        mock_run_git.assert_called_once_with(['merge-base', '--is-ancestor', 'HEAD~1', 'HEAD'])
+
+        mock_run_git.side_effect = guilt_module.GitError("'git merge-base' failed")
+        self.assertFalse(self.runner.is_ancestor('HEAD', 'HEAD~1'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_is_commit(self, mock_run_git):
+        mock_run_git.return_value = ['1111\n']
+        self.assertTrue(self.runner.is_commit('HEAD'))
+        mock_run_git.assert_called_once_with(
+            ['rev-parse', '--verify', '--quiet', 'HEAD^{commit}']
+        )
+
+        mock_run_git.side_effect = guilt_module.GitError("'git rev-parse' failed")
+        self.assertFalse(self.runner.is_commit('src/'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_has_merges(self, mock_run_git):
+        mock_run_git.return_value = ['3333\n']
+        self.assertTrue(self.runner.has_merges('v1', 'HEAD'))
+        # Merges before the since revision don't count
+        mock_run_git.assert_called_once_with(
+            ['rev-list', '--first-parent', '--merges', '-n', '1', 'v1..HEAD']
+        )
+
+        mock_run_git.side_effect = ValueError('No output')
+        self.assertFalse(self.runner.has_merges('v1', 'HEAD'))
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_renamed_paths(self, mock_run_git):
+        self.assertEquals(set(), self.runner.renamed_paths([]))
+        self.assertFalse(mock_run_git.called)
+
+        mock_run_git.return_value = b'R100\x00a.c\x00b.c\x00R090\x00c.c\x00d/e.c\x00'
+        self.assertEquals(set(['b.c', 'd/e.c']), self.runner.renamed_paths(['1111', '1111']))
+        mock_run_git.assert_called_once_with(
+            [
+                'diff-tree', '--stdin', '--no-commit-id', '-z', '-r', '-M',
+                '--diff-filter=R', '--name-status'
+            ],
+            stdin_data='1111\n',
+            decode=False
+        )
+
+        mock_run_git.side_effect = ValueError('No output')
+        self.assertEquals(set(), self.runner.renamed_paths(['2222']))
+
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_changed_paths(self, mock_iter_git):
+        mock_iter_git.return_value = iter(['a.c', 'dir/b c.h', ''])
+        self.assertEquals(
+            set(['a.c', 'dir/b c.h']),
+            self.runner.changed_paths('1111', '2222', [':/', ':(top,exclude)*.bin'])
+        )
+        mock_iter_git.assert_called_once_with([
+            'diff', '-z', '--name-only', '--no-renames', '1111', '2222',
+            '--', ':/', ':(top,exclude)*.bin'
+        ])
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_author_ident(self, mock_run_git):
+        mock_run_git.return_value = ['Foo Bar <foo@example.com> 1500000000 +0200\n']
+        self.assertEquals(('Foo Bar', '<foo@example.com>'), self.runner.author_ident())
+        mock_run_git.assert_called_once_with(['var', 'GIT_AUTHOR_IDENT'])
+
+        # Changes in the working tree are the next commit's author's
+        self.assertEquals('Foo Bar', self.runner.last_author('a.c', None))
+        self.assertEquals('<foo@example.com>', self.runner.last_author('a.c', None, True))
+
+        # No identity is configured
+        mock_run_git.side_effect = guilt_module.GitError('Author identity unknown')
+        self.assertEquals(None, self.runner.author_ident())
+        self.assertEquals(None, self.runner.last_author('a.c', None))
+
+    def test_count_working_tree_lines(self):
+        import shutil
+        import tempfile
+
+        toplevel = tempfile.mkdtemp()
+        try:
+            self.runner._git_toplevel = toplevel
+            with open(os.path.join(toplevel, 'a.c'), 'wb') as working_file:
+                working_file.write(b'a\nb\n\xe9')
+            self.assertEquals(3, self.runner.count_working_tree_lines('a.c'))
+            self.assertEquals(5, self.runner.working_tree_size('a.c'))
+
+            # Deleted since
+            self.assertEquals(0, self.runner.count_working_tree_lines('b.c'))
+            self.assertEquals(0, self.runner.working_tree_size('b.c'))
+        finally:
+            shutil.rmtree(toplevel)
+
+    @patch('git_guilt.guilt.subprocess.Popen')
+    def test_run_git_timeout(self, mock_process):
+        def slow_git(*args):
+            time.sleep(0.2)
+            return (b'foo', b'')
+
+        mock_process.return_value.returncode = 0
+        mock_process.return_value.communicate = Mock(side_effect=slow_git)
+        mock_process.return_value.poll.return_value = None
+
+        self.assertRaises(guilt_module.GitTimeout, self.runner.run_git, ['blame'], timeout=0.01)
+        mock_process.return_value.kill.assert_called_once_with()
+
+        mock_process.reset_mock()
+        self.assertEquals(['foo'], self.runner.run_git(['blame'], timeout=5))
+        self.assertFalse(mock_process.return_value.kill.called)
+
+        # git exited as the timer went off, so its output stands
+        mock_process.reset_mock()
+        mock_process.return_value.poll.return_value = 0
+        self.assertEquals(['foo'], self.runner.run_git(['blame'], timeout=0.01))
+        self.assertFalse(mock_process.return_value.kill.called)
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_get_blob_sizes(self, mock_run_git):
+        mock_run_git.return_value = [
+            '1111 blob 123',
+            '2222 missing',
+        ]
+
+        self.assertEquals({}, self.runner.get_blob_sizes([]))
+        self.assertFalse(mock_run_git.called)
+
+        self.assertEquals(
+            {'1111': 123},
+            self.runner.get_blob_sizes(['1111', '2222', '1111'])
+        )
+        self.assertEquals(['cat-file', '--batch-check'], mock_run_git.call_args[0][0])
+        self.assertEquals(
+            ['1111', '2222'],
+            sorted(mock_run_git.call_args[1]['stdin_data'].split())
+        )
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_get_lfs_sizes(self, mock_run_git):
+        pointer = b'version https://git-lfs.github.com/spec/v1\noid sha256:abcd\nsize 12345\n'
+        mock_run_git.return_value = (
+            b'1111 blob ' + str(len(pointer)).encode('ascii') + b'\n' + pointer + b'\n' +
+            b'2222 missing\n' +
+            b'3333 blob 5\nhello\n'
+        )
+
+        self.assertEquals({}, self.runner.get_lfs_sizes([]))
+        self.assertFalse(mock_run_git.called)
+
+        self.assertEquals({'1111': 12345}, self.runner.get_lfs_sizes(['1111', '2222', '3333']))
+        self.assertEquals(['cat-file', '--batch'], mock_run_git.call_args[0][0])
+        self.assertFalse(mock_run_git.call_args[1]['decode'])
+
+    def test_lfs_pointer_size(self):
+        self.assertEquals(
+            7,
+            guilt_module.GitRunner.lfs_pointer_size(b'version https://git-lfs.github.com/spec/v1\noid sha256:abcd\nsize 7\n')
+        )
+        self.assertEquals(None, guilt_module.GitRunner.lfs_pointer_size(b'size 7\n'))
+        self.assertEquals(
+            None,
+            guilt_module.GitRunner.lfs_pointer_size(b'version https://git-lfs.github.com/spec/v1\noid sha256:abcd\n')
+        )
+
+    @patch('git_guilt.guilt.os.read')
+    @patch('git_guilt.guilt.subprocess.Popen')
+    def test_iter_git(self, mock_process, mock_read):
+        mock_process.return_value.returncode = 0
+        mock_process.return_value.stderr.read = Mock(return_value=b'')
+        # Records may straddle the chunks read from the pipe
+        mock_read.side_effect = [b'foo\x00ba', b'r\x00baz', b'']
+
+        self.assertEquals(
+            ['foo', 'bar', 'baz'],
+            list(self.runner.iter_git(['diff']))
+        )
+
+        mock_process.return_value.returncode = 1
+        mock_process.return_value.stderr.read = Mock(return_value=b'fatal')
+        mock_read.side_effect = [b'']
+        self.assertRaises(
+            guilt_module.GitError, list, self.runner.iter_git(['diff'])
+        )
+
+    @patch('git_guilt.guilt.GitRunner._git_executable', sys.executable)
+    def test_iter_git_chunks_stderr(self):
+        self.runner._git_toplevel = None
+        # More than fits in the stderr pipe, before anything on stdout
+        chunks = list()
+        with self.assertRaises(guilt_module.GitError):
+            for chunk in self.runner._iter_git_chunks([
+                    '-c',
+                    "import sys; sys.stderr.write('e' * 1000000); "
+                    "sys.stdout.write('out')"]):
+                chunks.append(chunk)
+        self.assertEquals(b'out', b''.join(chunks))
+
     @patch('git_guilt.guilt.subprocess.Popen')
     def test_get_git_root_exception(self, mock_process):
         mock_process.return_value.communicate = Mock(side_effect=OSError)
@@ -483,6 +1059,113 @@ class GitRunnerTestCase(TestCase):
             self.runner.populate_tree('HEAD')
         )
 
+class Pygit2RunnerTests(TestCase):
+
+    def setUp(self):
+        initial_git_results = [
+                (b'git version 1.0.0\n', None),
+                (b'/my/arbitrary/path\n', None)
+            ]
+
+        def patched_popen(*args):
+            try:
+                output = initial_git_results.pop()
+            except IndexError:
+                output = (b'\n', None)
+            finally:
+                return output
+
+        self._popen_patch = patch('git_guilt.guilt.subprocess.Popen')
+        self.mocked_popen = self._popen_patch.start()
+        self.mocked_popen.return_value = Mock(
+            communicate=Mock(side_effect=patched_popen),
+            returncode=0,
+        )
+
+        self.pygit2 = Mock()
+        self.repo = self.pygit2.Repository.return_value
+        with patch.dict('sys.modules', {'pygit2': self.pygit2}):
+            self.runner = guilt_module.Pygit2Runner()
+        self._popen_patch.stop()
+
+    def test_missing_pygit2(self):
+        self.pygit2.Repository.assert_called_once_with('/my/arbitrary/path')
+
+        with patch('git_guilt.guilt.subprocess.Popen') as mock_popen:
+            mock_popen.return_value = Mock(
+                communicate=Mock(side_effect=[
+                    (b'/my/arbitrary/path\n', None),
+                    (b'git version 2.0.0\n', None),
+                ]),
+                returncode=0,
+            )
+            with patch.dict('sys.modules', {'pygit2': None}):
+                with self.assertRaises(guilt_module.GitError) as context:
+                    guilt_module.Pygit2Runner()
+        self.assertTrue('pygit2' in str(context.exception))
+
+    def test_iter_delta_files(self):
+        def diff_file(path, mode, oid, size):
+            return Mock(path=path, mode=mode, id=oid, size=size)
+
+        def patch_for(old_file, new_file, is_binary=False, additions=0):
+            return Mock(delta=Mock(old_file=old_file, new_file=new_file, is_binary=is_binary), line_stats=(0, additions, 0))
+
+        self.repo.diff.return_value = [
+            patch_for(diff_file('added.c', 0, '0000', 0), diff_file('added.c', 0o100644, '1111', 10), additions=3),
+            patch_for(diff_file('image.png', 0o100644, '2222', 20), diff_file('image.png', 0o100644, '3333', 30), True),
+            patch_for(diff_file('submodule', 0o160000, '4444', 0), diff_file('submodule', 0o160000, '5555', 0)),
+        ]
+        blobs = {
+            '1111': Mock(data=b'version https://git-lfs.github.com/spec/v1\noid sha256:abcd\nsize 4096\n'),
+            '2222': Mock(data=b'\x89PNG'),
+            '3333': Mock(data=b'\x89PNG'),
+        }
+        self.repo.__getitem__ = Mock(side_effect=lambda oid: blobs[oid])
+
+        changed_files = list(self.runner.iter_delta_files('HEAD~1', 'HEAD'))
+
+        self.assertEquals(
+            [
+                ('image.png', True, '2222', '3333', 20, 30, None, None, None),
+                ('added.c', False, None, '1111', 0, 10, None, 4096, 3),
+                ('submodule', False, None, None, 0, 0, None, None, 0),
+            ],
+            [(f.repo_path, f.is_binary, f.since_blob, f.until_blob, f.since_size, f.until_size, f.since_lfs_size, f.until_lfs_size, f.additions) for f in changed_files]
+        )
+        self.repo.revparse_single.assert_any_call('HEAD~1')
+        self.repo.revparse_single.assert_any_call('HEAD')
+
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_delta_files_pathspecs(self, mock_iter_delta_files):
+        mock_iter_delta_files.return_value = iter(['changed'])
+        self.assertEquals(
+            ['changed'],
+            list(self.runner.iter_delta_files('HEAD~1', 'HEAD', [':(exclude)*.bin']))
+        )
+        self.assertFalse(self.repo.diff.called)
+
+    def test_blobs(self):
+        class Blob(bytes):
+            # Like pygit2 blobs, supports the buffer protocol
+            @property
+            def size(self):
+                return len(self)
+
+        blobs = {
+            '1111': Blob(b'a\nb\nc'),
+            '2222': Blob(b''),
+            # Counted over several chunks
+            '3333': Blob(b'line\n' * 20000),
+        }
+        self.repo.__getitem__ = Mock(side_effect=lambda oid: blobs[oid])
+
+        self.assertEquals({'1111': 5, '2222': 0}, self.runner.get_blob_sizes(['1111', '2222', '9999']))
+        self.assertEquals(3, self.runner.count_lines('1111'))
+        self.assertEquals(0, self.runner.count_lines('2222'))
+        self.assertEquals(20000, self.runner.count_lines('3333'))
+
+
 class TextBlameTests(TestCase):
 
     def setUp(self):
@@ -513,6 +1196,7 @@ class TextBlameTests(TestCase):
         self._popen_patch.stop()
 
         self.bucket = {'Foo Bar': 0, 'Tim Pettersen': 0}
+        self.args = Mock(email=False, max_file_bytes=None, max_blame_seconds=None, git_profile='bulk', git_config=())
         self.ver_file = guilt_module.VersionedFile('src/foo.c', 'HEAD')
 
     def tearDown(self):
@@ -520,7 +1204,7 @@ class TextBlameTests(TestCase):
 
     def test_text_blame_repr(self):
         bucket = {'Foo Bar': 0, 'Tim Pettersen': 0}
-        blame = guilt_module.TextBlameTicket(self.runner, bucket, self.ver_file, Mock())
+        blame = guilt_module.TextBlameTicket(self.runner, bucket, self.ver_file, self.args)
         self.assertEquals(
             '<TextBlame HEAD:"src/foo.c">',
             repr(blame)
@@ -528,9 +1212,9 @@ class TextBlameTests(TestCase):
 
     @patch('git_guilt.guilt.GitRunner.run_git')
     def test_blame_locs(self, mock_run_git):
-        mock_run_git.return_value = test.constants.blame_author_names.splitlines()
+        mock_run_git.return_value = test.constants.blame_author_names.encode('utf_8')
 
-        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
 
         blame.process()
         self.assertEquals(
@@ -542,7 +1226,7 @@ class TextBlameTests(TestCase):
     def test_blame_locs_file_missing(self, mock_run_git):
         mock_run_git.side_effect = guilt_module.GitError("'git blame arbitrary path failed with:\nfatal: no such path 'src/foo.c' in HEAD")
 
-        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
 
         self.assertEquals(None, blame.process())
         # The bucket is unchanged
@@ -551,27 +1235,130 @@ class TextBlameTests(TestCase):
             blame.bucket
         )
 
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_blame_git_profile(self, mock_run_git):
+        mock_run_git.return_value = test.constants.blame_author_names.encode('utf_8')
+        self.args.git_config = (('core.deltaBaseCacheSize', '256m'),)
+
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
+        blame.process()
+        args, kwargs = mock_run_git.call_args
+        # Text files are blamed as they're stored under the bulk profile
+        self.assertEquals(
+            ['blame', '--no-textconv', '--incremental', '--encoding=utf-8', '--', 'src/foo.c', 'HEAD'],
+            args[0]
+        )
+        self.assertIn(
+            "'core.deltaBaseCacheSize=256m'",
+            kwargs['git_env']['GIT_CONFIG_PARAMETERS']
+        )
+
+        self.args.git_profile = 'none'
+        self.assertEquals(
+            ['blame', '--incremental', '--encoding=utf-8', '--', 'src/foo.c', 'HEAD'],
+            blame.blame_args()
+        )
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_blame_working_tree(self, mock_run_git):
+        mock_run_git.return_value = (
+            '0000000000000000000000000000000000000000 1 1 2\n'
+            'author Not Committed Yet\n'
+            'author-mail <not.committed.yet>\n'
+            'filename src/foo.c\n'
+            '9d5b3ad1e7a5e1b7d1e2b0f4a4f1b0a5c3e2d1f0 3 3 1\n'
+            'author Foo Bar\n'
+            'author-mail <foo@example.com>\n'
+            'filename src/foo.c\n'
+        ).encode('utf_8')
+        self.runner.commit_authors[b'0' * 40] = (u'Tim Pettersen', u'<tim@example.com>')
+
+        blame = guilt_module.TextBlameTicket(
+            self.runner, self.bucket, guilt_module.VersionedFile('src/foo.c', None), self.args
+        )
+        self.assertEquals('working tree:"src/foo.c"', blame.describe())
+        blame.process()
+        self.assertEquals(
+            ['blame', '--no-textconv', '--contents', 'src/foo.c', '--incremental', '--encoding=utf-8', '--', 'src/foo.c'],
+            mock_run_git.call_args[0][0]
+        )
+        # Uncommitted lines are credited to whoever will commit them
+        self.assertEquals({'Foo Bar': 1, 'Tim Pettersen': 2}, blame.bucket)
+
     @patch('git_guilt.guilt.GitRunner.run_git')
     def test_blame_locs_exception(self, mock_run_git):
         mock_run_git.side_effect = guilt_module.GitError
 
-        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
 
         self.assertRaises(guilt_module.GitError, blame.process)
 
     @patch('git_guilt.guilt.GitRunner.run_git')
-    def test_blame_locs_bad_encoding(self, mock_run_git):
-        mock_run_git.side_effect = UnicodeError
+    def test_blame_locs_commit_authors(self, mock_run_git):
+        mock_run_git.return_value = test.constants.blame_author_names.encode('utf_8')
+        self.args.email = True
+        blame = guilt_module.TextBlameTicket(self.runner, collections.defaultdict(int), self.ver_file, self.args)
+
+        blame.process()
+        self.assertEquals({'<foo@example.com>': 2, '<tim@example.com>': 3}, blame.bucket)
+        self.assertFalse(mock_run_git.call_args[1]['decode'])
+        self.assertFalse('--show-email' in blame.blame_args())
+
+        # Authors of commits seen in earlier blames aren't repeated in the
+        # output, but are known all the same
+        mock_run_git.return_value = (
+            b'35f9416fd3c2ab4e5ff7c0ba8f1e2b7c4a6d9e03 1 1 7\nfilename src/bar.c\n'
+            b'0123456789abcdef0123456789abcdef01234567 8 8 1\n'
+            b'author J\xc3\xa9r\xc3\xb4me\nauthor-mail <jerome@example.com>\nfilename src/bar.c\n'
+        )
+        self.args.email = False
+        blame = guilt_module.TextBlameTicket(self.runner, collections.defaultdict(int), self.ver_file, self.args)
+        blame.process()
+        self.assertEquals({'Foo Bar': 7, u'J\xe9r\xf4me': 1}, blame.bucket)
+        self.assertEquals(
+            (u'J\xe9r\xf4me', u'<jerome@example.com>'),
+            self.runner.commit_authors[b'0123456789abcdef0123456789abcdef01234567']
+        )
+
+    @patch('git_guilt.guilt.GitRunner.last_author')
+    @patch('git_guilt.guilt.GitRunner.count_lines')
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_blame_locs_over_size_budget(self, mock_run_git, mock_count_lines, mock_last_author):
+        mock_count_lines.return_value = 7
+        mock_last_author.return_value = 'Foo Bar'
+        self.args.max_file_bytes = 100
+        ver_file = guilt_module.VersionedFile('src/foo.c', 'HEAD', '1111', 101)
 
-        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, ver_file, self.args)
+        blame.process()
 
-        self.assertRaises(guilt_module.GitError, blame.process)
+        self.assertFalse(mock_run_git.called)
+        mock_count_lines.assert_called_once_with('1111')
+        mock_last_author.assert_called_once_with('src/foo.c', 'HEAD', False)
+        self.assertEquals('over 100 bytes', blame.degraded)
+        self.assertEquals({'Foo Bar': 7, 'Tim Pettersen': 0}, blame.bucket)
+
+    @patch('git_guilt.guilt.GitRunner.last_author')
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_blame_locs_timeout(self, mock_run_git, mock_last_author):
+        mock_run_git.side_effect = guilt_module.GitTimeout
+        mock_last_author.return_value = None
+        self.args.max_blame_seconds = 2.5
+        self.bucket = collections.defaultdict(int)
+
+        # Only part of the file gets credited
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, self.args, (11, 20))
+        blame.process()
+
+        self.assertEquals(2.5, mock_run_git.call_args[1]['timeout'])
+        self.assertEquals('blame took over 2.5s', blame.degraded)
+        self.assertEquals({guilt_module.BlameTicket.unattributed: 10}, blame.bucket)
 
     @patch('git_guilt.guilt.GitRunner.run_git')
     def test_blame_locs_empty_file(self, mock_run_git):
         mock_run_git.side_effect = ValueError('No output')
 
-        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.TextBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
         self.assertEquals(None, blame.process())
 
         # The bucket is unchanged
@@ -609,15 +1396,21 @@ class BinaryBlameTests(TestCase):
 
         self.runner = guilt_module.GitRunner()
         self.bucket = {'Foo Bar': 0, 'Tim Pettersen': 0}
+        self.args = Mock(email=False, max_file_bytes=None, max_blame_seconds=None, textconv_cache=None, git_profile='bulk', git_config=())
         self.ver_file = guilt_module.VersionedFile('bin/a.out', 'HEAD')
         self._popen_patch.stop()
 
+        guilt_module.BinaryBlameTicket._prepared_envs.clear()
+        self._attributes_patch = patch('git_guilt.guilt.BinaryBlameTicket._attributes_file')
+        self.mocked_attributes_file = self._attributes_patch.start()
+        self.mocked_attributes_file.return_value = '/tmp/attrs'
+
     def tearDown(self):
-        pass
+        self._attributes_patch.stop()
 
     def test_bin_blame_repr(self):
         bucket = {'Foo Bar': 0, 'Tim Pettersen': 0}
-        blame = guilt_module.BinaryBlameTicket(self.runner, bucket, self.ver_file, Mock())
+        blame = guilt_module.BinaryBlameTicket(self.runner, bucket, self.ver_file, self.args)
         self.assertEquals(
             '<BinaryBlame HEAD:"bin/a.out">',
             repr(blame)
@@ -625,9 +1418,9 @@ class BinaryBlameTests(TestCase):
 
     @patch('git_guilt.guilt.GitRunner.run_git')
     def test_blame_bytes(self, mock_run_git):
-        mock_run_git.return_value = test.constants.blame_author_names.splitlines()
+        mock_run_git.return_value = test.constants.blame_author_names.encode('utf_8')
 
-        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
 
         blame.process()
         self.assertEquals(
@@ -635,11 +1428,79 @@ class BinaryBlameTests(TestCase):
             blame.bucket
         )
 
+    def test_blame_env(self):
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
+        self.assertFalse(hasattr(blame, '__dict__'))
+        self.assertEquals(
+            {
+                'GIT_CONFIG_NOSYSTEM': 'true',
+                'GIT_CONFIG_PARAMETERS': "'core.attributesfile=/tmp/attrs' "
+                "'diff.binary_blame.textconv=xxd -p -c1' "
+                "'user.email=bar@example.com' 'user.name=foo'",
+            },
+            blame.blame_env({'core.attributesfile': '/tmp/attrs'})
+        )
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_blame_bytes_textconv_cache(self, mock_run_git):
+        mock_run_git.return_value = test.constants.blame_author_names.encode('utf_8')
+        self.args.textconv_cache = "/home/o'brien/.cache/git-guilt/textconv"
+
+        # Small files are converted again rather than looked up in the cache
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
+        blame.process()
+        config = mock_run_git.call_args[1]['git_env']['GIT_CONFIG_PARAMETERS']
+        self.assertTrue("'diff.binary_blame.textconv=xxd -p -c1'" in config)
+
+        big_file = guilt_module.VersionedFile('bin/a.out', 'HEAD', size=1 << 20)
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, big_file, self.args)
+        blame.process()
+
+        config = mock_run_git.call_args[1]['git_env']['GIT_CONFIG_PARAMETERS']
+        # The quote in the path is quoted for the shell, then for git
+        self.assertTrue(
+            "'diff.binary_blame.textconv=f() { e=; id=$(git hash-object --no-filters -- \"$1\") && "
+            "e='\\''/home/o'\\''\"'\\''\"'\\''brien/.cache/git-guilt/textconv'\\''/$id && "
+            in config
+        )
+        self.assertFalse('cachetextconv' in config)
+
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_prepared_env(self, mock_run_git):
+        mock_run_git.return_value = test.constants.blame_author_names.encode('utf_8')
+
+        for path in ('bin/a.out', 'bin/b.out'):
+            blame = guilt_module.BinaryBlameTicket(self.runner, collections.defaultdict(int), guilt_module.VersionedFile(path, 'HEAD'), self.args)
+            blame.process()
+
+        # Every binary file is blamed in the same environment
+        self.assertEquals(1, self.mocked_attributes_file.call_count)
+        first_env, second_env = [c[1]['git_env'] for c in mock_run_git.call_args_list]
+        self.assertTrue(first_env is second_env)
+        self.assertEquals(
+            blame.blame_env({'core.attributesfile': '/tmp/attrs'}),
+            first_env
+        )
+
+    @patch('git_guilt.guilt.os.rename')
+    @patch('git_guilt.guilt.open', create=True)
+    @patch('git_guilt.guilt.cache_dir')
+    def test_attributes_file(self, mock_cache_dir, mock_open, mock_rename):
+        self._attributes_patch.stop()
+        mock_cache_dir.return_value = '/tmp'
+        mock_open.return_value.__enter__ = Mock(return_value=Mock(read=Mock(return_value='* diff=binary_blame\n')))
+        mock_open.return_value.__exit__ = Mock(return_value=False)
+
+        self.assertEquals('/tmp/binary.gitattributes', guilt_module.BinaryBlameTicket._attributes_file())
+        # It's only written when it isn't there already
+        self.assertFalse(mock_rename.called)
+        self._attributes_patch.start()
+
     @patch('git_guilt.guilt.GitRunner.run_git')
     def test_blame_bytes_file_missing(self, mock_run_git):
         mock_run_git.side_effect = guilt_module.GitError("'git blame arbitrary path failed with:\nfatal: no such path 'src/foo.c' in HEAD")
 
-        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
 
         self.assertEquals(None, blame.process())
         # The bucket is unchanged
@@ -652,15 +1513,50 @@ class BinaryBlameTests(TestCase):
     def test_blame_bytes_locs_exception(self, mock_run_git):
         mock_run_git.side_effect = guilt_module.GitError
 
-        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
 
         self.assertRaises(guilt_module.GitError, blame.process)
 
+    @patch('git_guilt.guilt.GitRunner.last_author')
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_blame_bytes_degraded(self, mock_run_git, mock_last_author):
+        mock_last_author.return_value = 'Tim Pettersen'
+        self.args.max_file_bytes = 100
+        ver_file = guilt_module.VersionedFile('bin/a.out', 'HEAD', '1111', 4096)
+
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, ver_file, self.args)
+        blame.process()
+
+        self.assertFalse(mock_run_git.called)
+        self.assertEquals({'Foo Bar': 0, 'Tim Pettersen': 4096}, blame.bucket)
+
+        # Binary blames can time out, too
+        self.args.max_file_bytes = None
+        self.args.max_blame_seconds = 1
+        mock_run_git.side_effect = guilt_module.GitTimeout
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, ver_file, self.args)
+        blame.process()
+
+        self.assertEquals('blame took over 1s', blame.degraded)
+        self.assertEquals({'Foo Bar': 0, 'Tim Pettersen': 8192}, blame.bucket)
+
+    @patch('git_guilt.guilt.GitRunner.last_author')
+    def test_lfs_blame(self, mock_last_author):
+        mock_last_author.return_value = 'Foo Bar'
+        ver_file = guilt_module.VersionedFile('video.mp4', 'HEAD', size=4096)
+        blame = guilt_module.LfsBlameTicket(self.runner, self.bucket, ver_file, self.args)
+        self.assertEquals('<LfsBlame HEAD:"video.mp4">', repr(blame))
+        self.assertEquals(0, blame.cost())
+
+        blame.process()
+        self.assertEquals({'Foo Bar': 4096, 'Tim Pettersen': 0}, self.bucket)
+        mock_last_author.assert_called_once_with('video.mp4', 'HEAD', False)
+
     @patch('git_guilt.guilt.GitRunner.run_git')
     def test_blame_bytes_empty_file(self, mock_run_git):
         mock_run_git.side_effect = ValueError('No output')
 
-        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, Mock())
+        blame = guilt_module.BinaryBlameTicket(self.runner, self.bucket, self.ver_file, self.args)
         self.assertEquals(None, blame.process())
 
         # The bucket is unchanged
@@ -670,11 +1566,11 @@ class BinaryBlameTests(TestCase):
         )
 
 
-class GuiltTestCase(TestCase):
+class HistoryWalkTests(TestCase):
 
     def setUp(self):
         initial_git_results = [
-                (b'git version 1.8.7\n', None),
+                (b'git version 1.0.0\n', None),
                 (b'/my/arbitrary/path\n', None)
             ]
 
@@ -686,9 +1582,201 @@ class GuiltTestCase(TestCase):
             finally:
                 return output
 
-        # We need to mock up subprocess.Popen so that the 'git' invocation
-        # performed when the GitRunner object is instantiated doesn't result in
-        # an actual process being forked
+        self._popen_patch = patch('git_guilt.guilt.subprocess.Popen')
+        self.mocked_popen = self._popen_patch.start()
+        self.mocked_popen.return_value = Mock(
+            communicate=Mock(side_effect=patched_popen),
+            returncode=0,
+        )
+
+        self.runner = guilt_module.GitRunner()
+        self._popen_patch.stop()
+
+        self.args = Mock(since='HEAD~2', until='HEAD', email=False, max_file_bytes=None, max_blame_seconds=None, git_profile='bulk', git_config=())
+        self.since_bucket = collections.defaultdict(int)
+        self.until_bucket = collections.defaultdict(int)
+        self.walk = guilt_module.HistoryWalk(self.runner, self.args)
+        self.walk.add(
+            guilt_module.ChangedFile('a.c', False, '1111', '2222', 10, 20),
+            self.since_bucket, self.until_bucket
+        )
+
+    def test_apply_hunks(self):
+        lines = ['A', 'A', 'A', 'A']
+        self.assertEquals(
+            ['B', 'A', 'B', 'B', 'A', 'A'],
+            # Prepend a line, replace the second one with two lines
+            guilt_module.HistoryWalk.apply_hunks(lines, [(0, 0, 1), (2, 1, 2)], 'B')
+        )
+        self.assertEquals(
+            ['A', 'A'],
+            guilt_module.HistoryWalk.apply_hunks(lines, [(2, 2, 0)], 'B')
+        )
+        self.assertRaises(
+            ValueError,
+            guilt_module.HistoryWalk.apply_hunks, lines, [(4, 2, 0)], 'B'
+        )
+
+    def test_diff_path(self):
+        self.assertEquals(
+            'dir/sp ace.c',
+            guilt_module.HistoryWalk._diff_path('diff --git a/dir/sp ace.c b/dir/sp ace.c')
+        )
+        self.assertEquals(
+            u'caf\u00e9 "1".txt',
+            guilt_module.HistoryWalk._diff_path(
+                'diff --git "a/caf\\303\\251 \\"1\\".txt" "b/caf\\303\\251 \\"1\\".txt"'
+            )
+        )
+
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_process(self, mock_iter_git):
+        mock_iter_git.side_effect = [
+            iter([
+                b'\x01Alice', b'', b'diff --git a/a.c b/a.c', b'new file mode 100644',
+                b'--- /dev/null', b'+++ b/a.c', b'@@ -0,0 +1,3 @@', b'+1', b'+2', b'+3',
+                b'diff --git a/other.c b/other.c', b'@@ -1 +1 @@', b'-x', b'+y',
+                b'\x01Bob', b'', b'diff --git a/a.c b/a.c', b'@@ -2 +2,2 @@', b'-2',
+                b'+two', b'+\xff', b'\\ No newline at end of file',
+            ]),
+            iter([
+                b'\x01Carol', b'', b'diff --git a/a.c b/a.c', b'@@ -0,0 +1 @@', b'+0',
+                b'@@ -3 +3,0 @@', b'-\xff',
+            ]),
+        ]
+
+        self.walk.process()
+
+        self.assertEquals({'Alice': 2, 'Bob': 2}, self.since_bucket)
+        self.assertEquals({'Alice': 2, 'Bob': 1, 'Carol': 1}, self.until_bucket)
+        self.assertEquals(
+            [
+                'log', '--reverse', '--first-parent', '-m', '-p', '-U0',
+                '--no-renames', '--no-color', '--no-ext-diff', '--encoding=utf-8',
+                '--src-prefix=a/', '--dst-prefix=b/', '--format=%x01%aN%x02%H %P',
+                'HEAD~2..HEAD', '--', ':(top,literal)a.c',
+            ],
+            mock_iter_git.call_args[0][0]
+        )
+
+    @patch('git_guilt.guilt.TextBlameTicket.process')
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_process_binary_history(self, mock_iter_git, mock_process):
+        mock_iter_git.side_effect = [
+            iter([
+                b'\x01Alice', b'', b'diff --git a/a.c b/a.c', b'new file mode 100644',
+                b'Binary files /dev/null and b/a.c differ',
+            ]),
+            iter([
+                b'\x01Bob', b'', b'diff --git a/a.c b/a.c', b'@@ -1 +1 @@', b'-1', b'+2',
+            ]),
+        ]
+
+        self.walk.process()
+
+        # We lost track of the file's lines, so it's blamed the usual way
+        self.assertEquals(2, mock_process.call_count)
+        self.assertEquals({}, self.since_bucket)
+
+    @patch('git_guilt.guilt.GitRunner.renamed_paths')
+    @patch('git_guilt.guilt.TextBlameTicket.process')
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_process_merge_history(self, mock_iter_git, mock_process, mock_renamed):
+        mock_renamed.return_value = set()
+        mock_iter_git.side_effect = [
+            iter([
+                b'\x01Alice\x021111', b'', b'diff --git a/a.c b/a.c',
+                b'new file mode 100644', b'@@ -0,0 +1 @@', b'+1',
+                b'\x01Merger\x022222 1111 3333', b'', b'diff --git a/a.c b/a.c',
+                b'@@ -1 +1,2 @@', b'-1', b'+1', b'+2',
+            ]),
+            iter([
+                b'\x01Bob\x024444 2222', b'', b'diff --git a/a.c b/a.c', b'@@ -2,0 +3 @@', b'+3',
+            ]),
+        ]
+
+        self.walk.process()
+
+        # A merge before the since revision brought in lines whose authors
+        # we can't tell, so the file is blamed the usual way on both sides
+        self.assertEquals(2, mock_process.call_count)
+        self.assertEquals({}, self.since_bucket)
+        self.assertEquals({}, self.until_bucket)
+
+    @patch('git_guilt.guilt.GitRunner.renamed_paths')
+    @patch('git_guilt.guilt.TextBlameTicket.process')
+    @patch('git_guilt.guilt.GitRunner.iter_git')
+    def test_process_renames(self, mock_iter_git, mock_process, mock_renamed):
+        mock_iter_git.side_effect = [
+            iter([
+                b'\x01Alice\x021111', b'', b'diff --git a/a.c b/a.c',
+                b'new file mode 100644', b'@@ -0,0 +1 @@', b'+1',
+            ]),
+            iter([
+                b'\x01Bob\x022222 1111', b'', b'diff --git a/a.c b/a.c',
+                b'@@ -1,0 +2 @@', b'+2',
+            ]),
+        ]
+        looked_up = list()
+
+        def renamed_paths(commit_ids):
+            looked_up.append(sorted(commit_ids))
+            return set()
+
+        mock_renamed.side_effect = renamed_paths
+
+        self.walk.process()
+
+        # Only the commits that created a tracked file are looked up
+        self.assertEquals([['1111'], []], looked_up)
+        self.assertEquals({'Alice': 1}, self.since_bucket)
+        self.assertEquals({'Alice': 1, 'Bob': 1}, self.until_bucket)
+
+        # The walk would credit every line of a renamed file to whoever renamed
+        # it, so it's blamed the usual way
+        mock_iter_git.side_effect = [
+            iter([]),
+            iter([
+                b'\x01Bob\x022222 1111', b'', b'diff --git a/a.c b/a.c',
+                b'new file mode 100644', b'@@ -0,0 +1,2 @@', b'+1', b'+2',
+            ]),
+        ]
+        mock_renamed.side_effect = [set(), set(['a.c', 'other.c'])]
+        self.walk.process()
+        self.assertEquals(1, mock_process.call_count)
+
+        # Files are blamed the usual way if we can't tell which were renamed
+        mock_iter_git.side_effect = [
+            iter([]),
+            iter([
+                b'\x01Bob\x022222 1111', b'', b'diff --git a/a.c b/a.c',
+                b'new file mode 100644', b'@@ -0,0 +1,2 @@', b'+1', b'+2',
+            ]),
+        ]
+        mock_renamed.side_effect = [set(), guilt_module.GitError('too many files')]
+        self.walk.process()
+        self.assertEquals(2, mock_process.call_count)
+
+
+class GuiltTestCase(TestCase):
+
+    def setUp(self):
+        initial_git_results = [
+                (b'git version 1.8.7\n', None),
+                (b'/my/arbitrary/path\n', None)
+            ]
+
+        def patched_popen(*args):
+            try:
+                output = initial_git_results.pop()
+            except IndexError:
+                output = (b'\n', None)
+            finally:
+                return output
+
+        # We need to mock up subprocess.Popen so that the 'git' invocation
+        # performed when the GitRunner object is instantiated doesn't result in
+        # an actual process being forked
         self._popen_patch = patch('git_guilt.guilt.subprocess.Popen')
         self.mocked_popen = self._popen_patch.start()
         self.mocked_popen.return_value = Mock(
@@ -713,20 +1801,6 @@ class GuiltTestCase(TestCase):
         self._stdout_patch.stop()
         self._isatty_patch.stop()
 
-    @patch('git_guilt.guilt.GitRunner.run_git')
-    def test_populate_trees(self, mock_run_git):
-        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1')
-        mock_run_git.return_value = []
-
-        self.guilt.populate_trees()
-        self.assertEquals(
-            [
-                call(['ls-tree', '-r', '--', 'HEAD~4']),
-                call(['ls-tree', '-r', '--', 'HEAD~1']),
-            ],
-            mock_run_git.mock_calls
-        )
-
     def test_reduce_locs(self):
         self.guilt.loc_ownership_since = {'Alice': 5, 'Bob': 3, 'Carol': 4}
         self.guilt.loc_ownership_until = {'Alice': 6, 'Bob': 6, 'Carol': 2, 'Dave': 1, 'Ellen': 2}
@@ -746,34 +1820,37 @@ class GuiltTestCase(TestCase):
             self.guilt.loc_deltas
         )
 
-    @patch('git_guilt.guilt.GitRunner.get_delta_files')
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
     def test_file_not_in_since_rev(self, mock_get_files, ):
-        mock_get_files.return_value = (set(['in_since_and_until', 'not_in_since']), set([]))
+        mock_get_files.return_value = [
+            guilt_module.ChangedFile('in_since_and_until', False, '1111', '2222'),
+            guilt_module.ChangedFile('not_in_since', False, None, '2222'),
+        ]
 
         # Mock up arg namespace
         self.guilt.args = Mock()
         self.guilt.args.since = 'since'
         self.guilt.args.until = 'until'
-
-        self.guilt.trees['since'] = ['in_since_and_until']
-        self.guilt.trees['until'] = ['in_since_and_until', 'not_in_since']
+        self.guilt.args.jobs = 2
+        self.guilt.args.stats = False
+        self.guilt.args.split_lines = 0
+        self.guilt.args.paths = []
+        self.guilt.args.exclude = []
+        self.guilt.args.skip_generated = False
+        self.guilt.args.recurse_submodules = False
+        self.guilt.args.sample = None
 
         def mock_blame_logic(blame):
             if 'not_in_since' == blame.versioned_file.repo_path:
-                if 'since' == blame.versioned_file.git_revision:
-                    blame.exists = False
-                elif 'until' == blame.versioned_file.git_revision:
-                    blame.exists = True
+                if 'until' == blame.versioned_file.git_revision:
                     blame.bucket['Alice'] += 20
                     blame.bucket['Bob'] += 5
             elif 'in_since_and_until' == blame.versioned_file.repo_path:
-                blame.exists = True
                 if 'since' == blame.versioned_file.git_revision:
                     blame.bucket['Alice'] += 12
                     blame.bucket['Bob'] += 8
                     blame.bucket['Dave'] += 4
                 elif 'until' == blame.versioned_file.git_revision:
-                    blame.exists = True
                     blame.bucket['Alice'] += 18
                     blame.bucket['Bob'] += 2
                     blame.bucket['Carol'] += 2
@@ -807,26 +1884,489 @@ class GuiltTestCase(TestCase):
         finally:
             guilt_module.TextBlameTicket.process = old_process
 
-    @patch('git_guilt.guilt.GitRunner.get_delta_files')
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
     def test_file_not_in_until_rev(self, mock_get_files):
-        mock_get_files.return_value = (set(['in_since_and_until', 'not_in_until']), set([]))
+        mock_get_files.return_value = [
+            guilt_module.ChangedFile('in_since_and_until', False, '1111', '2222'),
+            guilt_module.ChangedFile('not_in_until', False, '1111', None),
+        ]
 
         # Mock up arg namespace
         self.guilt.args = Mock()
         self.guilt.args.since = 'since'
         self.guilt.args.until = 'until'
+        self.guilt.args.jobs = 2
+        self.guilt.args.stats = False
+        self.guilt.args.split_lines = 0
+        self.guilt.args.paths = []
+        self.guilt.args.exclude = []
+        self.guilt.args.skip_generated = False
+        self.guilt.args.sample = None
+
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_skips_missing(self, mock_get_delta):
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('gone.c', False, '1111', None),
+            guilt_module.ChangedFile('new.c', False, None, '2222'),
+        ]
+
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, progress=None, format='table')
+
+        blame_jobs = self.guilt.iter_blame_jobs()
+        # Nothing happens until the generator is consumed
+        self.assertFalse(mock_get_delta.called)
+        self.assertEquals(
+            [
+                guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_since, guilt_module.VersionedFile('gone.c', 'HEAD~4'), Mock()),
+                guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_until, guilt_module.VersionedFile('new.c', 'HEAD~1'), Mock()),
+            ],
+            list(blame_jobs)
+        )
+
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_lfs(self, mock_get_delta):
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('video.mp4', False, '1111', '2222', 130, 131, 4096, 8192),
+            guilt_module.ChangedFile('model.bin', True, '3333', '4444', 1000, 132, None, 65536),
+        ]
+
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, engine='per-file', progress=None, format='table')
+
+        blame_jobs = list(self.guilt.iter_blame_jobs())
+        self.assertTrue(all(isinstance(job, guilt_module.LfsBlameTicket) for job in blame_jobs))
+        self.assertEquals(
+            [
+                (self.guilt.lfs_ownership_since, 'video.mp4', 'HEAD~4', 4096),
+                (self.guilt.lfs_ownership_until, 'video.mp4', 'HEAD~1', 8192),
+                (self.guilt.lfs_ownership_since, 'model.bin', 'HEAD~4', 1000),
+                (self.guilt.lfs_ownership_until, 'model.bin', 'HEAD~1', 65536),
+            ],
+            [(job.bucket, job.versioned_file.repo_path, job.versioned_file.git_revision, job.versioned_file.size) for job in blame_jobs]
+        )
+
+    @patch('git_guilt.guilt.GitRunner.get_single_commit_authors')
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_single_commit(self, mock_get_delta, mock_authors):
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('vendor/big.c', False, None, '1111', 0, 9000, additions=300),
+            guilt_module.ChangedFile('edited.c', False, None, '2222', 0, 20, additions=2),
+            guilt_module.ChangedFile('changed.c', False, '3333', '4444', 10, 20, additions=1),
+        ]
+        mock_authors.return_value = {'vendor/big.c': 'Vendor', 'other.c': 'Someone'}
+
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, engine='per-file', email=False, progress=None, format='table')
+
+        blame_jobs = list(self.guilt.iter_blame_jobs())
+        mock_authors.assert_called_once_with('HEAD~4', 'HEAD~1', [], False)
+        self.assertEquals(
+            [
+                guilt_module.SingleAuthorTicket(self.guilt.runner, self.guilt.loc_ownership_until, guilt_module.VersionedFile('vendor/big.c', 'HEAD~1'), Mock(), 'Vendor'),
+                guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_until, guilt_module.VersionedFile('edited.c', 'HEAD~1'), Mock()),
+                guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_since, guilt_module.VersionedFile('changed.c', 'HEAD~4'), Mock()),
+                guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_until, guilt_module.VersionedFile('changed.c', 'HEAD~1'), Mock()),
+            ],
+            blame_jobs
+        )
+        self.assertEquals(0, blame_jobs[0].cost())
+
+        blame_jobs[0].process()
+        self.assertEquals({'Vendor': 300}, dict(self.guilt.loc_ownership_until))
+
+    @patch('git_guilt.guilt.GitRunner._get_cached_git_version')
+    @patch('git_guilt.guilt.GitRunner.rev_parse')
+    @patch('git_guilt.guilt.GitRunner._get_git_root', autospec=True)
+    @patch('git_guilt.guilt.GitRunner.iter_submodule_changes')
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_submodules(self, mock_get_delta, mock_submodules, mock_git_root, mock_rev_parse, mock_version):
+        mock_version.return_value = (2, 30, 0)
+        self.guilt.runner._git_toplevel = '/super'
+
+        def find_git_root(runner):
+            # The last submodule isn't checked out
+            if runner._cwd.endswith('missing'):
+                runner._git_toplevel = '/super'
+        mock_git_root.side_effect = find_git_root
+        mock_get_delta.side_effect = [
+            [guilt_module.ChangedFile('a.c', False, None, '1111')],
+            [guilt_module.ChangedFile('b.c', False, '2222', '3333')],
+        ]
+        mock_submodules.side_effect = [
+            [('lib', 'aaaa', 'bbbb'), ('missing', 'cccc', 'dddd')],
+            # lib has no submodules of its own
+            [],
+        ]
+        self.guilt.args = self.guilt.parser.parse_args(
+            ['--recurse-submodules', 'HEAD~4', 'HEAD~1', 'src']
+        )
+        self._stderr_patch = patch('git_guilt.guilt.sys.stderr')
+        mocked_stderr = self._stderr_patch.start()
+
+        blame_jobs = list(self.guilt.iter_blame_jobs())
+        self._stderr_patch.stop()
+
+        self.assertEquals(
+            [
+                ('/super', 'HEAD~1', 'a.c'),
+                ('/super/lib', 'aaaa', 'b.c'),
+                ('/super/lib', 'bbbb', 'b.c'),
+            ],
+            [
+                (ticket.runner._git_toplevel, ticket.versioned_file.git_revision, ticket.versioned_file.repo_path)
+                for ticket in blame_jobs
+            ]
+        )
+        # Submodules are blamed into our buckets, whatever the paths given
+        self.assertTrue(blame_jobs[1].bucket is self.guilt.loc_ownership_since)
+        self.assertEquals(call('aaaa', 'bbbb', []), mock_get_delta.call_args)
+        self.assertEquals(1, len(self.guilt.submodules))
+        self.assertTrue('Skipping submodule missing' in mocked_stderr.write.call_args_list[0][0][0])
+
+    @patch('sys.argv', ['arg0', '--backend', 'pygit2', 'HEAD~1', 'HEAD', 'payments'])
+    @patch('git_guilt.guilt.GitRunner.run_git')
+    def test_pygit2_backend_cwd(self, mock_run_git):
+        # As when the server answers a client running from a subdirectory
+        self.guilt.runner._cwd = '/my/arbitrary/path/services'
+        mock_run_git.side_effect = lambda args, **kwargs: (
+            ['git version 2.30.0'] if ['--version'] == args
+            else ['/my/arbitrary/path']
+        )
+        with patch.dict('sys.modules', {'pygit2': Mock()}):
+            self.guilt.process_args()
+
+        self.assertTrue(isinstance(self.guilt.runner, guilt_module.Pygit2Runner))
+        self.assertEquals('/my/arbitrary/path', self.guilt.runner._git_toplevel)
+        # Paths are still relative to the directory the client ran from
+        self.assertEquals(['services/payments'], self.guilt.pathspecs())
+
+    @patch('git_guilt.guilt.os.getcwd')
+    def test_pathspecs(self, mock_getcwd):
+        mock_getcwd.return_value = '/my/arbitrary/path'
+        self.guilt.runner._git_toplevel = '/my/arbitrary/path'
+        self.guilt.args = Mock(paths=[], exclude=[], skip_generated=False, sample=None)
+        self.assertEquals([], self.guilt.pathspecs())
+
+        self.guilt.args = Mock(paths=['src', ':(glob)**/*.c'], exclude=[], skip_generated=False)
+        self.assertEquals(['src', ':(glob)**/*.c'], self.guilt.pathspecs())
+
+        # Exclusions on their own apply to the whole tree
+        self.guilt.args = Mock(paths=[], exclude=['*.min.js'], skip_generated=True)
+        self.assertEquals(
+            [
+                ':/',
+                ':(top,exclude)*.min.js',
+                ':(exclude,attr:linguist-generated)',
+                ':(exclude,attr:linguist-generated=true)',
+                ':(exclude,attr:-diff)',
+            ],
+            self.guilt.pathspecs()
+        )
+
+        # Paths are relative to the current directory
+        mock_getcwd.return_value = '/my/arbitrary/path/services'
+        self.guilt.args = Mock(paths=['payments', '../README'], exclude=[], skip_generated=False)
+        self.assertEquals(['services/payments', 'README'], self.guilt.pathspecs())
+
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_pathspecs(self, mock_get_delta):
+        mock_get_delta.return_value = []
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=['*.bin'], skip_generated=False, recurse_submodules=False, sample=None, progress=None, format='table')
+
+        self.assertEquals([], list(self.guilt.iter_blame_jobs()))
+        mock_get_delta.assert_called_once_with(
+            'HEAD~4', 'HEAD~1', [':/', ':(top,exclude)*.bin']
+        )
+
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_history_walk(self, mock_get_delta):
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('foo.c', False, '1111', '2222'),
+            guilt_module.ChangedFile('foo.png', True, '3333', '4444'),
+            guilt_module.ChangedFile('foo.h', False, None, '5555'),
+        ]
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, engine='history-walk')
+
+        jobs = list(self.guilt.iter_blame_jobs())
 
-        self.guilt.trees['since'] = ['in_since_and_until', 'not_in_until']
-        self.guilt.trees['until'] = ['in_since_and_until']
+        self.assertEquals(
+            ['BinaryBlameTicket', 'BinaryBlameTicket', 'HistoryWalk'],
+            [type(job).__name__ for job in jobs]
+        )
+        self.assertEquals(['foo.c', 'foo.h'], sorted(jobs[-1].targets))
+
+    @patch('sys.argv', ['arg0', '--engine', 'history-walk', 'HEAD~1', 'HEAD'])
+    @patch('git_guilt.guilt.GitRunner.is_first_parent_ancestor')
+    def test_history_walk_off_main_line(self, mock_ancestor):
+        mock_ancestor.return_value = False
+        with patch('git_guilt.guilt.Formatter.terminal_output') as mock_output:
+            self.guilt.process_args()
+        self.assertEquals('per-file', self.guilt.args.engine)
+        self.assertEquals(1, mock_output.call_count)
+
+    @patch('sys.argv', ['arg0', '--engine', 'history-walk', 'HEAD~1', 'HEAD'])
+    @patch('git_guilt.guilt.GitRunner.has_merges')
+    @patch('git_guilt.guilt.GitRunner.is_first_parent_ancestor')
+    def test_history_walk_merges(self, mock_ancestor, mock_merges):
+        mock_ancestor.return_value = True
+        mock_merges.return_value = False
+        self.guilt.process_args()
+        self.assertEquals('history-walk', self.guilt.args.engine)
+
+        # Lines brought in by a merge would be credited to whoever merged
+        mock_merges.return_value = True
+        with patch('git_guilt.guilt.Formatter.terminal_output') as mock_output:
+            self.guilt.process_args()
+        self.assertEquals('per-file', self.guilt.args.engine)
+        mock_merges.assert_called_with('HEAD~1', 'HEAD')
+        self.assertEquals(1, mock_output.call_count)
+
+    @patch('sys.argv', ['arg0', '--skip-generated', 'HEAD~1', 'HEAD'])
+    def test_skip_generated_git_version(self):
+        self.guilt.runner.version = (2, 12, 0)
+        self.assertRaises(guilt_module.GitError, self.guilt.process_args)
+
+        self.guilt.runner.version = (2, 13, 0)
+        self.guilt.process_args()
+        self.assertTrue(self.guilt.args.skip_generated)
+
+    @patch('sys.argv', [
+        'arg0', '--git-config', 'core.deltaBaseCacheSize=1g',
+        '--git-config', 'pack.threads=4', 'HEAD~1', 'HEAD'
+    ])
+    def test_git_config_args(self):
+        self.guilt.process_args()
+        self.assertEquals('bulk', self.guilt.args.git_profile)
+        # Overrides come after the profile's configuration, so that they win
+        self.assertEquals(
+            (
+                ('core.commitGraph', 'true'),
+                ('core.deltaBaseCacheSize', '256m'),
+                ('core.deltaBaseCacheSize', '1g'),
+                ('pack.threads', '4'),
+            ),
+            self.guilt.args.git_config
+        )
+        self.assertEquals(
+            {'core.commitGraph': 'true', 'core.deltaBaseCacheSize': '1g',
+             'pack.threads': '4'},
+            dict(self.guilt.args.git_config)
+        )
+
+    @patch('sys.argv', ['arg0', '--git-profile', 'none', 'HEAD~1', 'HEAD'])
+    def test_git_profile_none(self):
+        self.guilt.process_args()
+        self.assertEquals((), self.guilt.args.git_config)
+
+    @patch('git_guilt.guilt.GitRunner.is_commit')
+    @patch('git_guilt.guilt.GitRunner.author_ident')
+    def test_working_tree_args(self, mock_ident, mock_is_commit):
+        mock_ident.return_value = (u'Foo Bar', u'<foo@example.com>')
+        mock_is_commit.side_effect = lambda rev: rev.startswith('HEAD')
+        self.guilt.process_args(['--working-tree', '--engine', 'history-walk'])
+        self.assertEquals(('HEAD', None), (self.guilt.args.since, self.guilt.args.until))
+        self.assertEquals('per-file', self.guilt.args.engine)
+        self.assertEquals(
+            (u'Foo Bar', u'<foo@example.com>'),
+            self.guilt.runner.commit_authors[b'0' * 40]
+        )
 
-    @patch('git_guilt.guilt.GitRunner.get_delta_files')
+        # There's no until revision to give, so the second positional argument
+        # is a path
+        self.guilt.process_args(['--working-tree', 'HEAD~2', 'src', 'lib'])
+        self.assertEquals(('HEAD~2', None), (self.guilt.args.since, self.guilt.args.until))
+        self.assertEquals(['src', 'lib'], self.guilt.args.paths)
+
+        # Nor is the first one if it isn't a commit
+        self.guilt.process_args(['--working-tree', 'src/', 'lib'])
+        self.assertEquals(('HEAD', None), (self.guilt.args.since, self.guilt.args.until))
+        self.assertEquals(['src/', 'lib'], self.guilt.args.paths)
+        mock_is_commit.assert_called_with('src/')
+
+        for option in (['--mode', 'churn'], ['--recurse-submodules']):
+            self.assertRaises(
+                guilt_module.GitError,
+                self.guilt.process_args,
+                ['--working-tree'] + option
+            )
+
+    def test_config_pair(self):
+        self.assertEquals(
+            ('core.commitGraph', 'true'),
+            guilt_module.config_pair('core.commitGraph=true')
+        )
+        self.assertEquals(
+            ('diff.foo.textconv', 'cat -A'),
+            guilt_module.config_pair('diff.foo.textconv=cat -A')
+        )
+        self.assertEquals(('a.b', ''), guilt_module.config_pair('a.b='))
+        for bad_value in ('core.commitGraph', '=true', ''):
+            self.assertRaises(
+                argparse.ArgumentTypeError,
+                guilt_module.config_pair,
+                bad_value
+            )
+
+    @patch('git_guilt.guilt.GitRunner.count_lines')
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
+    def test_iter_blame_jobs_split(self, mock_get_delta, mock_count_lines):
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('small.c', False, '1111', '2222', 30, 40),
+            # Too small to be worth counting the lines of
+            guilt_module.ChangedFile('short.c', False, None, '5555', 0, 1600),
+            guilt_module.ChangedFile('huge.c', False, None, '3333', 0, 5000),
+            guilt_module.ChangedFile('huge.bin', True, None, '4444', 0, 250),
+        ]
+        mock_count_lines.return_value = 250
+
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=100, email=False, git_profile='bulk', paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, progress=None, format='table')
+
+        blame_jobs = list(self.guilt.iter_blame_jobs())
+        # We only count lines in text files likely to have more than 100
+        mock_count_lines.assert_called_once_with('3333')
+        self.assertEquals(
+            [
+                '<TextBlame HEAD~4:"small.c">',
+                '<TextBlame HEAD~1:"small.c">',
+                '<TextBlame HEAD~1:"short.c">',
+                '<TextBlame HEAD~1:"huge.c" L1,100>',
+                '<TextBlame HEAD~1:"huge.c" L101,200>',
+                '<TextBlame HEAD~1:"huge.c" L201,250>',
+                '<BinaryBlame HEAD~1:"huge.bin" L1,100>',
+                '<BinaryBlame HEAD~1:"huge.bin" L101,200>',
+                '<BinaryBlame HEAD~1:"huge.bin" L201,250>',
+            ],
+            [repr(blame) for blame in blame_jobs]
+        )
+        self.assertEquals(
+            ['blame', '--no-textconv', '-L101,200', '--incremental', '--encoding=utf-8', '--', 'huge.c', 'HEAD~1'],
+            blame_jobs[4].blame_args()
+        )
+        # All three ranges together cost as much as the whole file would
+        self.assertEquals(
+            [2000, 2000, 1000],
+            [blame.cost() for blame in blame_jobs[3:6]]
+        )
+
+        # No splitting happens when we only have the one worker
+        mock_count_lines.reset_mock()
+        self.guilt.args.jobs = 1
+        self.assertEquals(5, len(list(self.guilt.iter_blame_jobs())))
+        self.assertFalse(mock_count_lines.called)
+
+    def test_line_count(self):
+        self.assertEquals(0, guilt_module.line_count('0'))
+        self.assertEquals(500, guilt_module.line_count('500'))
+        for bad_value in ('-1', '1.5', 'lots'):
+            self.assertRaises(
+                argparse.ArgumentTypeError,
+                guilt_module.line_count,
+                bad_value
+            )
+
+    def test_sample_size(self):
+        self.assertEquals(0.25, guilt_module.sample_size('0.25'))
+        self.assertEquals(1.0, guilt_module.sample_size('1.0'))
+        self.assertEquals(300, guilt_module.sample_size('300'))
+        for bad_value in ('0', '0.0', '1.5', '-4', 'lots'):
+            self.assertRaises(
+                argparse.ArgumentTypeError,
+                guilt_module.sample_size,
+                bad_value
+            )
+
+    def test_sample_changed_files(self):
+        changed_files = [
+            guilt_module.ChangedFile('text%02d' % i, False, '1111', '2222', i, i)
+            for i in range(40)
+        ] + [
+            guilt_module.ChangedFile('binary', True, '1111', '2222', 5, 5)
+        ]
+        self.guilt.args = Mock(sample=0.3, sample_seed=42)
+
+        samples = self.guilt.sample_changed_files(changed_files)
+
+        # 4 strata of 10 text files, of which 30% are sampled, and the one
+        # binary file
+        self.assertEquals(13, len(samples))
+        text_strata = collections.Counter(
+            sample.stratum for sample in samples if not sample.changed_file.is_binary
+        )
+        self.assertEquals(
+            {(False, 0): 3, (False, 1): 3, (False, 2): 3, (False, 3): 3},
+            text_strata
+        )
+        # Strata group files of similar sizes
+        for sample in samples:
+            if not sample.changed_file.is_binary:
+                self.assertEquals(
+                    sample.stratum[1],
+                    sample.changed_file.since_size // 10
+                )
+                self.assertEquals(10, sample.population)
+
+        # The same seed draws the same sample
+        self.assertEquals(
+            [sample.changed_file.repo_path for sample in samples],
+            [sample.changed_file.repo_path for sample in self.guilt.sample_changed_files(changed_files)]
+        )
+
+        # Sample sizes can be given as a number of files
+        self.guilt.args = Mock(sample=20, sample_seed=None)
+        self.assertEquals(
+            4 * 5 + 1,
+            len(self.guilt.sample_changed_files(changed_files))
+        )
+
+    def test_extrapolate_samples(self):
+        def sample(stratum, population, since, until):
+            file_sample = guilt_module.FileSample(
+                guilt_module.ChangedFile('foo', False, '1111', '2222'),
+                stratum,
+                population
+            )
+            file_sample.since_bucket.update(since)
+            file_sample.until_bucket.update(until)
+            return file_sample
+
+        self.guilt.samples = [
+            # Two out of ten files in this stratum
+            sample(0, 10, {'Alice': 10}, {'Alice': 4, 'Bob': 6}),
+            sample(0, 10, {'Alice': 10}, {'Alice': 8, 'Bob': 2}),
+            # All of the files in this one
+            sample(1, 2, {'Bob': 50}, {'Bob': 40}),
+            sample(1, 2, {'Bob': 20}, {'Bob': 20}),
+        ]
+
+        self.guilt.extrapolate_samples()
+
+        self.assertEquals({'Alice': 100, 'Bob': 70}, self.guilt.loc_ownership_since)
+        self.assertEquals({'Alice': 60, 'Bob': 100}, self.guilt.loc_ownership_until)
+        # Alice's deltas in the first stratum are -6 and -2, for a sample
+        # variance of 8 and a variance of the total of 10*10*0.8*8/2 = 320.
+        # There is no uncertainty about the second stratum
+        self.assertEquals(
+            {'Alice': 36, 'Bob': 36},
+            self.guilt.loc_margins
+        )
+
+        self.guilt.reduce_blames()
+        self.assertEquals(
+            [
+                guilt_module.Delta('Bob', 70, 100, 36),
+                guilt_module.Delta('Alice', 100, 60, 36),
+            ],
+            self.guilt.loc_deltas
+        )
+        self.assertEquals(36, self.guilt.loc_deltas[0].margin)
+
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
     def test_map_text_blames(self, mock_get_delta):
 
-        mock_get_delta.return_value = set(['foo.c', 'foo.h']), set([])
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('foo.c', False, '1111', '2222'),
+            guilt_module.ChangedFile('foo.h', False, '1111', '2222'),
+        ]
 
-        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1')
-        self.guilt.trees['HEAD~4'] = ['foo.c', 'foo.h']
-        self.guilt.trees['HEAD~1'] = ['foo.c', 'foo.h']
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, progress=None, format='table')
 
 
         def mock_blame_logic(blame):
@@ -848,10 +2388,9 @@ class GuiltTestCase(TestCase):
         try:
             guilt_module.TextBlameTicket.process = mock_blame_logic
 
-            self.guilt.map_blames()
-
-            # Assert the set of blame "jobs" generated by PyGuilt.map_blames()
-            self.assertEquals(4, len(self.guilt.blame_jobs))
+            # Assert the set of blame "jobs" generated by PyGuilt
+            blame_jobs = list(self.guilt.iter_blame_jobs())
+            self.assertEquals(4, len(blame_jobs))
             self.assertEquals(
                 [
                     guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_since, guilt_module.VersionedFile('foo.c', 'HEAD~4'), Mock()),
@@ -859,9 +2398,11 @@ class GuiltTestCase(TestCase):
                     guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_since, guilt_module.VersionedFile('foo.h', 'HEAD~4'), Mock()),
                     guilt_module.TextBlameTicket(self.guilt.runner, self.guilt.loc_ownership_until, guilt_module.VersionedFile('foo.h', 'HEAD~1'), Mock()),
                 ],
-                self.guilt.blame_jobs
+                blame_jobs
             )
 
+            self.guilt.map_blames()
+
             # Assert the ownership buckets
             self.assertEquals({'Alice': 32, 'Bob': 5}, self.guilt.loc_ownership_since)
             self.assertEquals({'Alice': 18, 'Carol': 2}, self.guilt.loc_ownership_until)
@@ -886,14 +2427,15 @@ class GuiltTestCase(TestCase):
         finally:
             guilt_module.TextBlameTicket.process = old_process
 
-    @patch('git_guilt.guilt.GitRunner.get_delta_files')
+    @patch('git_guilt.guilt.GitRunner.iter_delta_files')
     def test_map_binary_blames(self, mock_get_delta):
 
-        mock_get_delta.return_value = set([]), set(['foo.bin', 'libbar.so.1.8.7'])
+        mock_get_delta.return_value = [
+            guilt_module.ChangedFile('foo.bin', True, '1111', '2222'),
+            guilt_module.ChangedFile('libbar.so.1.8.7', True, '1111', '2222'),
+        ]
 
-        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1')
-        self.guilt.trees['HEAD~4'] = ['foo.bin', 'libbar.so.1.8.7']
-        self.guilt.trees['HEAD~1'] = ['foo.bin', 'libbar.so.1.8.7']
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD~1', jobs=2, stats=False, split_lines=0, paths=[], exclude=[], skip_generated=False, recurse_submodules=False, sample=None, progress=None, format='table', textconv_cache=None)
 
 
         def mock_blame_logic(blame):
@@ -915,10 +2457,9 @@ class GuiltTestCase(TestCase):
         try:
             guilt_module.BinaryBlameTicket.process = mock_blame_logic
 
-            self.guilt.map_blames()
-
-            # Assert the set of blame "jobs" generated by PyGuilt.map_blames()
-            self.assertEquals(4, len(self.guilt.blame_jobs))
+            # Assert the set of blame "jobs" generated by PyGuilt
+            blame_jobs = list(self.guilt.iter_blame_jobs())
+            self.assertEquals(4, len(blame_jobs))
             self.assertEquals(
                 [
                     guilt_module.BinaryBlameTicket(self.guilt.runner, self.guilt.byte_ownership_since, guilt_module.VersionedFile('foo.bin', 'HEAD~4'), Mock()),
@@ -926,9 +2467,11 @@ class GuiltTestCase(TestCase):
                     guilt_module.BinaryBlameTicket(self.guilt.runner, self.guilt.byte_ownership_since, guilt_module.VersionedFile('libbar.so.1.8.7', 'HEAD~4'), Mock()),
                     guilt_module.BinaryBlameTicket(self.guilt.runner, self.guilt.byte_ownership_until, guilt_module.VersionedFile('libbar.so.1.8.7', 'HEAD~1'), Mock()),
                 ],
-                self.guilt.blame_jobs
+                blame_jobs
             )
 
+            self.guilt.map_blames()
+
             # Assert the ownership buckets
             self.assertEquals({}, self.guilt.loc_ownership_since)
             self.assertEquals({}, self.guilt.loc_ownership_until)
@@ -954,13 +2497,202 @@ class GuiltTestCase(TestCase):
             guilt_module.BinaryBlameTicket.process = old_process
 
 
+    @patch('git_guilt.guilt.PyGuilt.iter_blame_jobs')
+    def test_map_blames_interrupted(self, mock_jobs):
+        ticket = Mock(cost=Mock(return_value=9), degraded=None)
+
+        def iter_jobs():
+            yield ticket
+            raise KeyboardInterrupt()
+        mock_jobs.side_effect = iter_jobs
+        self.guilt.args = Mock(jobs=1, stats=False, sample=None, progress=None, format='table')
+
+        self.guilt.map_blames()
+
+        self.assertTrue(self.guilt.interrupted)
+        self.assertTrue(0.0 <= self.guilt.completed <= 1.0)
+
+    @patch('git_guilt.guilt.TextBlameTicket.process', autospec=True)
+    @patch('git_guilt.guilt.GitRunner.rev_parse')
+    @patch('git_guilt.guilt.PyGuilt.iter_blame_jobs')
+    def test_map_blames_cached(self, mock_jobs, mock_rev_parse, mock_process):
+        mock_rev_parse.side_effect = lambda rev: {'HEAD~1': 'a' * 40, 'HEAD': 'b' * 40}[rev]
+        mock_process.side_effect = lambda ticket: ticket.credit({'Alice': 3})
+        self.guilt.args = Mock(since='HEAD~1', until='HEAD', email=False, git_profile='none', git_config=(), jobs=1, stats=False, sample=None, progress=None, format='table')
+        self.guilt.blame_cache = guilt_module.BlameCache(10)
+
+        def iter_jobs():
+            yield guilt_module.TextBlameTicket(
+                self.guilt.runner, self.guilt.loc_ownership_since,
+                guilt_module.VersionedFile('a.c', 'HEAD~1'), self.guilt.args
+            )
+            yield guilt_module.TextBlameTicket(
+                self.guilt.runner, self.guilt.loc_ownership_until,
+                guilt_module.VersionedFile('a.c', 'HEAD'), self.guilt.args
+            )
+        mock_jobs.side_effect = iter_jobs
+
+        self.guilt.map_blames()
+        self.assertEquals(2, mock_process.call_count)
+        self.assertEquals(0, self.guilt.blame_cache.hits)
+
+        # The second run is answered from the cache
+        self.guilt.map_blames()
+        self.assertEquals(2, mock_process.call_count)
+        self.assertEquals(2, self.guilt.blame_cache.hits)
+        self.assertEquals({'Alice': 6}, dict(self.guilt.loc_ownership_since))
+        self.assertEquals({'Alice': 6}, dict(self.guilt.loc_ownership_until))
+
+    @patch('git_guilt.guilt.TextBlameTicket.process', autospec=True)
+    @patch('git_guilt.guilt.GitRunner.rev_parse')
+    @patch('git_guilt.guilt.PyGuilt.iter_blame_jobs')
+    def test_map_blames_cached_working_tree(self, mock_jobs, mock_rev_parse, mock_process):
+        mock_rev_parse.return_value = 'a' * 40
+        mock_process.side_effect = lambda ticket: ticket.credit({'Alice': 3})
+        self.guilt.args = Mock(since='HEAD', until=None, email=False, git_profile='none', git_config=(), jobs=1, stats=False, sample=None, progress=None, format='table')
+        self.guilt.blame_cache = guilt_module.BlameCache(10)
+
+        def iter_jobs():
+            yield guilt_module.TextBlameTicket(
+                self.guilt.runner, self.guilt.loc_ownership_since,
+                guilt_module.VersionedFile('a.c', 'HEAD'), self.guilt.args
+            )
+            yield guilt_module.TextBlameTicket(
+                self.guilt.runner, self.guilt.loc_ownership_until,
+                guilt_module.VersionedFile('a.c', None), self.guilt.args
+            )
+        mock_jobs.side_effect = iter_jobs
+
+        self.guilt.map_blames()
+        self.guilt.map_blames()
+        # The working tree may have changed in between, so it's blamed again
+        self.assertEquals(3, mock_process.call_count)
+        self.assertEquals(1, self.guilt.blame_cache.hits)
+        mock_rev_parse.assert_called_with('HEAD')
+
+    @patch('git_guilt.guilt.GitRunner.get_blob_sizes')
+    @patch('git_guilt.guilt.GitRunner.iter_churn')
+    def test_map_churn(self, mock_churn, mock_sizes):
+        mock_churn.return_value = iter([
+            guilt_module.FileChurn('Alice', 'a.c', False, 10, 0),
+            guilt_module.FileChurn('Bob', 'a.c', False, 3, 4),
+            guilt_module.FileChurn('Bob', 'a.png', True, old_blob=None, new_blob='1111'),
+            guilt_module.FileChurn('Alice', 'a.png', True, old_blob='1111', new_blob='2222'),
+        ])
+        mock_sizes.return_value = {'1111': 100, '2222': 80}
+        self.guilt.args = Mock(since='HEAD~4', until='HEAD', email=False, paths=[], exclude=[], skip_generated=False)
+
+        self.guilt.map_churn()
+
+        mock_churn.assert_called_once_with('HEAD~4', 'HEAD', [], False)
+        self.assertEquals(['1111', '2222'], sorted(mock_sizes.call_args[0][0]))
+        self.guilt.reduce_blames()
+        self.assertEquals(
+            [guilt_module.Delta('Alice', 0, 10), guilt_module.Delta('Bob', 4, 3)],
+            self.guilt.loc_deltas
+        )
+        self.assertEquals(
+            [guilt_module.BinaryDelta('Bob', 0, 100), guilt_module.BinaryDelta('Alice', 100, 80)],
+            self.guilt.byte_deltas
+        )
+
+    @patch('git_guilt.guilt.os.unlink')
+    @patch('git_guilt.guilt.os.stat')
+    @patch('git_guilt.guilt.os.listdir')
+    def test_prune_textconv_cache(self, mock_listdir, mock_stat, mock_unlink):
+        mock_listdir.return_value = ['1111', '2222', '3333', '4444.123']
+        stats = {
+            '/cache/1111': Mock(st_atime=300, st_mtime=100, st_size=40),
+            '/cache/2222': Mock(st_atime=100, st_mtime=200, st_size=40),
+            '/cache/3333': Mock(st_atime=100, st_mtime=100, st_size=40),
+        }
+
+        def stat(path):
+            if path not in stats:
+                raise OSError('Pruned by a concurrent run')
+            return stats[path]
+        mock_stat.side_effect = stat
+        self.guilt.args = Mock(textconv_cache='/cache', textconv_cache_bytes=50)
+
+        self.guilt.prune_textconv_cache()
+
+        self.assertEquals(
+            [call('/cache/3333'), call('/cache/2222')],
+            mock_unlink.call_args_list
+        )
+
+    def test_partial_deltas(self):
+        self.guilt.args = Mock(sample=None)
+        self.guilt.loc_ownership_since['Alice'] += 5
+        self.guilt.loc_ownership_until['Bob'] += 3
+        self.guilt.byte_ownership_until['Carol'] += 100
+
+        loc_deltas, byte_deltas, lfs_deltas = self.guilt.partial_deltas()
+
+        self.assertEquals(
+            [guilt_module.Delta('Bob', 0, 3), guilt_module.Delta('Alice', 5, 0)],
+            loc_deltas
+        )
+        self.assertEquals([guilt_module.BinaryDelta('Carol', 0, 100)], byte_deltas)
+        self.assertEquals([], lfs_deltas)
+        # The buckets are still being filled, and must not be touched
+        self.assertEquals({'Alice': 5}, self.guilt.loc_ownership_since)
+        self.assertEquals([], self.guilt.loc_deltas)
+
+    @patch('git_guilt.guilt.Formatter.terminal_output')
+    @patch('git_guilt.guilt.PyGuilt.map_blames')
+    @patch('git_guilt.guilt.PyGuilt.process_args')
+    def test_ndjson_run_interrupted(self, mock_process_args, mock_map, mock_output):
+        def interrupted_map():
+            self.guilt.loc_ownership_since['Alice'] += 5
+            self.guilt.interrupted = True
+            self.guilt.completed = 0.5
+        mock_map.side_effect = interrupted_map
+        self.guilt.args = Mock(format='ndjson')
+
+        self.assertEquals(130, self.guilt.run())
+
+        self.assertEquals(
+            call(u'Interrupted - showing partial results (50% of blames done)',
+                 sys.stderr),
+            mock_output.mock_calls[0]
+        )
+        record = json.loads(mock_output.mock_calls[1][1][0])
+        self.assertEquals(
+            {
+                'complete': False,
+                'progress': 0.5,
+                'lines': [{'author': 'Alice', 'since': 5, 'until': 0, 'count': -5}],
+                'bytes': [],
+                'lfs': [],
+            },
+            record
+        )
+
+    @patch('git_guilt.guilt.BlameCache.load')
+    @patch('git_guilt.guilt.cache_dir')
+    @patch('git_guilt.guilt.Formatter.terminal_output')
+    @patch('git_guilt.guilt.PyGuilt.map_blames')
+    @patch('git_guilt.guilt.PyGuilt.process_args')
+    def test_working_tree_run(self, mock_process_args, mock_map, mock_output, mock_cache_dir, mock_load):
+        def set_args(argv=None):
+            self.guilt.args = Mock(mode='blame', until=None, format='ndjson')
+        mock_process_args.side_effect = set_args
+        mock_cache_dir.return_value = '/cache'
+
+        self.assertEquals(0, self.guilt.run())
+        # Blames of the since revision are kept for the next run
+        mock_load.assert_called_once_with('/cache/blames.json', 10000)
+        self.assertTrue(self.guilt.blame_cache is mock_load.return_value)
+        mock_map.assert_called_once_with()
+        mock_load.return_value.save.assert_called_once_with('/cache/blames.json')
+
     # Many more testcases are required!!
-    @patch('git_guilt.guilt.PyGuilt.populate_trees')
-    @patch('git_guilt.guilt.Formatter.show_guilt_stats')
+    @patch('git_guilt.guilt.Formatter.guilt_table')
     @patch('git_guilt.guilt.PyGuilt.reduce_blames')
     @patch('git_guilt.guilt.PyGuilt.map_blames')
     @patch('git_guilt.guilt.PyGuilt.process_args')
-    def test_show_run(self, mock_process_args, mock_map, mock_reduce, mock_show, mock_pop_trees):
+    def test_show_run(self, mock_process_args, mock_map, mock_reduce, mock_table):
 
         if 2 == sys.version_info[0]:
             stdout_patch = patch('sys.stdout', new_callable=io.BytesIO)
@@ -974,6 +2706,10 @@ class GuiltTestCase(TestCase):
 
         mock_reduce.side_effect = set_byte_deltas
 
+        def set_args(argv=None):
+            self.guilt.args = Mock(format='table')
+        mock_process_args.side_effect = set_args
+
         # Mock stdout.fileno()
         self._stdout_patch = patch('git_guilt.guilt.sys.stdout')
         self.mocked_stdout = self._stdout_patch.start()
@@ -992,11 +2728,282 @@ class GuiltTestCase(TestCase):
         stdout_patch.stop()
 
         # Assert calls
-        mock_process_args.assert_called_once_with()
-        mock_pop_trees.assert_called_once_with()
+        mock_process_args.assert_called_once_with(None)
         mock_map.assert_called_once_with()
         mock_reduce.assert_called_once_with()
-        self.assertEquals(2, len(mock_show.mock_calls))
+        mock_table.assert_called_once_with(
+            self.guilt.loc_deltas, self.guilt.byte_deltas, self.guilt.lfs_deltas
+        )
+
+
+class BlameWorkerPoolTestCase(TestCase):
+
+    def test_process(self):
+        tickets = [Mock(cost=Mock(return_value=i)) for i in range(10)]
+        pool = guilt_module.BlameWorkerPool(3)
+        for ticket in tickets:
+            pool.submit(ticket)
+        pool.join()
+
+        for ticket in tickets:
+            ticket.process.assert_called_once_with()
+        self.assertEquals(10, pool.ticket_count)
+        self.assertTrue(pool.lower_bound <= pool.makespan)
+
+    def test_largest_first(self):
+        processed = []
+        started = guilt_module.threading.Event()
+        blocker = guilt_module.threading.Event()
+
+        def make_ticket(name, cost):
+            def process():
+                started.set()
+                blocker.wait()
+                processed.append(name)
+            return Mock(cost=Mock(return_value=cost), process=process)
+
+        pool = guilt_module.BlameWorkerPool(1)
+        # The worker picks up the first ticket straight away and waits there
+        # while the others are queued up
+        pool.submit(make_ticket('first', 1))
+        started.wait()
+        pool.submit(make_ticket('small', 10))
+        pool.submit(make_ticket('huge', 1000))
+        pool.submit(make_ticket('medium', 100))
+        blocker.set()
+        pool.join()
+
+        self.assertEquals(['huge', 'medium', 'small'], processed[-3:])
+
+    def test_fair_share(self):
+        processed = []
+        started = guilt_module.threading.Event()
+        blocker = guilt_module.threading.Event()
+
+        def make_ticket(name, cost):
+            def process():
+                started.set()
+                blocker.wait()
+                processed.append(name)
+            return Mock(cost=Mock(return_value=cost), process=process)
+
+        pool = guilt_module.BlameWorkerPool(1)
+        pool.submit(make_ticket('first', 1))
+        started.wait()
+        # The first repository's tickets don't hold up the second's
+        pool.submit(make_ticket('a1', 99), share='a')
+        pool.submit(make_ticket('a2', 99), share='a')
+        pool.submit(make_ticket('a3', 99), share='a')
+        pool.submit(make_ticket('b1', 49), share='b')
+        pool.submit(make_ticket('b2', 49), share='b')
+        blocker.set()
+        pool.join()
+
+        self.assertEquals(['a1', 'b1', 'b2', 'a2', 'a3'], processed[-5:])
+
+    def test_error(self):
+        failing_ticket = Mock(cost=Mock(return_value=0))
+        failing_ticket.process.side_effect = guilt_module.GitError('Oops')
+
+        pool = guilt_module.BlameWorkerPool(2)
+        pool.submit(Mock(cost=Mock(return_value=0)))
+        pool.submit(failing_ticket)
+        self.assertRaises(guilt_module.GitError, pool.join)
+
+    def test_fair_order(self):
+        def make_ticket(name, cost):
+            return Mock(cost=Mock(return_value=cost), name=name)
+
+        a1, a2, a3 = [make_ticket(name, 99) for name in ('a1', 'a2', 'a3')]
+        b1, b2 = [make_ticket(name, 49) for name in ('b1', 'b2')]
+        self.assertEquals(
+            [(0, a1), (1, b1), (1, b2), (0, a2), (0, a3)],
+            list(guilt_module.BlameWorkerPool.fair_order([[a1, a2, a3], [b1, b2], []]))
+        )
+
+        # Tickets are only taken from a share when it's the share's turn
+        pulled = list()
+
+        def iter_tickets(name):
+            for index in range(2):
+                pulled.append(name + str(index))
+                yield make_ticket(name + str(index), 9)
+
+        order = guilt_module.BlameWorkerPool.fair_order([iter_tickets('a'), iter_tickets('b')])
+        self.assertEquals(0, next(order)[0])
+        self.assertEquals(['a0'], pulled)
+        self.assertEquals(1, next(order)[0])
+        self.assertEquals(['a0', 'b0'], pulled)
+
+    def test_bounded_queue(self):
+        started = guilt_module.threading.Event()
+        blocker = guilt_module.threading.Event()
+
+        def process():
+            started.set()
+            blocker.wait()
+
+        pool = guilt_module.BlameWorkerPool(1)
+        pool.submit(Mock(cost=Mock(return_value=0), process=process))
+        started.wait()
+        for _ in range(guilt_module.BlameWorkerPool._queued_per_worker):
+            pool.submit(Mock(cost=Mock(return_value=0)))
+
+        # The queue is full until the worker moves on
+        submitted = guilt_module.threading.Event()
+
+        def submit():
+            pool.submit(Mock(cost=Mock(return_value=0)))
+            submitted.set()
+        guilt_module.threading.Thread(target=submit).start()
+        self.assertFalse(submitted.wait(0.1))
+        blocker.set()
+        self.assertTrue(submitted.wait(5))
+        pool.join()
+        self.assertEquals(guilt_module.BlameWorkerPool._queued_per_worker + 2, pool.ticket_count)
+
+    def test_share_error(self):
+        failing_ticket = Mock(cost=Mock(return_value=10))
+        failing_ticket.process.side_effect = guilt_module.GitError('Oops')
+        skipped_ticket = Mock(cost=Mock(return_value=0))
+        other_ticket = Mock(cost=Mock(return_value=0))
+
+        pool = guilt_module.BlameWorkerPool(1)
+        pool.submit(failing_ticket, share='a')
+        pool.submit(skipped_ticket, share='a')
+        pool.submit(other_ticket, share='b')
+        pool.join()
+
+        self.assertEquals(['a'], list(pool.share_errors))
+        self.assertFalse(skipped_ticket.process.called)
+        other_ticket.process.assert_called_once_with()
+
+    def test_progress(self):
+        pool = guilt_module.BlameWorkerPool(2)
+        self.assertEquals(0.0, pool.progress)
+        for cost in (0, 9, 90):
+            pool.submit(Mock(cost=Mock(return_value=cost)))
+        self.assertEquals(3, pool.submitted_count)
+        self.assertEquals(102, pool.submitted_cost)
+        pool.join()
+
+        self.assertEquals(1.0, pool.progress)
+        self.assertEquals(0.0, pool.eta)
+
+    def test_cancel(self):
+        started = guilt_module.threading.Event()
+        blocker = guilt_module.threading.Event()
+
+        def process():
+            started.set()
+            blocker.wait()
+
+        pool = guilt_module.BlameWorkerPool(1)
+        pool.submit(Mock(cost=Mock(return_value=0), process=process))
+        started.wait()
+        queued = Mock(cost=Mock(return_value=0))
+        pool.submit(queued)
+        # The running blame only finishes once the pool has been cancelled
+        guilt_module.threading.Timer(0.1, blocker.set).start()
+        pool.join(cancel=True)
+
+        self.assertFalse(queued.process.called)
+        self.assertEquals(0.5, pool.progress)
+
+    def test_ticket_cost(self):
+        text_blame = guilt_module.TextBlameTicket(
+            None, {}, guilt_module.VersionedFile('a.c', 'HEAD', '1111', 100), Mock()
+        )
+        binary_blame = guilt_module.BinaryBlameTicket(
+            None, {}, guilt_module.VersionedFile('a.bin', 'HEAD', '2222', 100), Mock()
+        )
+        self.assertTrue(text_blame.cost() < binary_blame.cost())
+
+
+class ProgressReporterTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = Mock(ticket_count=1, submitted_count=4, progress=0.25,
+                         eta=30.0)
+        self.snapshot = Mock(return_value=(
+            [guilt_module.Delta(u'foo', 10, 20)],
+            [guilt_module.BinaryDelta(u'bar', 5, 2)],
+            [guilt_module.LfsDelta(u'baz', 0, 4096)],
+        ))
+
+        self._isatty_patch = patch('git_guilt.guilt.os.isatty')
+        self.mocked_isatty = self._isatty_patch.start()
+        self.mocked_isatty.return_value = False
+
+        self._stdout_patch = patch('git_guilt.guilt.sys.stdout')
+        self.mocked_stdout = self._stdout_patch.start()
+        self._stderr_patch = patch('git_guilt.guilt.sys.stderr')
+        self.mocked_stderr = self._stderr_patch.start()
+
+    def tearDown(self):
+        self._isatty_patch.stop()
+        self._stdout_patch.stop()
+        self._stderr_patch.stop()
+
+    @patch('git_guilt.guilt.Formatter.terminal_output')
+    def test_report_ndjson(self, mock_output):
+        reporter = guilt_module.ProgressReporter(
+            self.pool, 1, self.snapshot, ndjson=True
+        )
+        reporter.report()
+
+        record = json.loads(mock_output.call_args[0][0])
+        self.assertEquals(False, record['complete'])
+        self.assertEquals(0.25, record['progress'])
+        self.assertEquals(30.0, record['eta'])
+        self.assertEquals(
+            [{'author': 'foo', 'since': 10, 'until': 20, 'count': 10}],
+            record['lines']
+        )
+        self.assertEquals(
+            [{'author': 'bar', 'since': 5, 'until': 2, 'count': -3}],
+            record['bytes']
+        )
+        self.assertEquals(
+            [{'author': 'baz', 'since': 0, 'until': 4096, 'count': 4096}],
+            record['lfs']
+        )
+
+    @patch('git_guilt.guilt.Formatter.terminal_output')
+    def test_report_not_tty(self, mock_output):
+        reporter = guilt_module.ProgressReporter(self.pool, 1, self.snapshot)
+        reporter.report()
+
+        mock_output.assert_called_once_with(
+            u'1 of 4 blames done (25%), ETA 30s', self.mocked_stderr
+        )
+
+    @patch('git_guilt.guilt.Formatter.terminal_output')
+    def test_report_tty(self, mock_output):
+        self.mocked_isatty.return_value = True
+        self.pool.eta = None
+        reporter = guilt_module.ProgressReporter(self.pool, 60, self.snapshot)
+        reporter.start()
+        with patch('git_guilt.guilt.Formatter._get_tty_width',
+                   return_value=80):
+            reporter.report()
+            reporter.report()
+
+        self.assertEquals(12, len(mock_output.mock_calls))
+        self.assertEquals(
+            call(u' baz | LFS \033[31m0\033[0m -> \033[32m4096\033[0m bytes', self.mocked_stdout),
+            mock_output.mock_calls[4]
+        )
+        self.assertEquals(
+            call(u'1 of 4 blames done (25%), still planning',
+                 self.mocked_stdout),
+            mock_output.mock_calls[-1]
+        )
+        # The first table is erased before the second one is drawn
+        self.mocked_stdout.write.assert_called_once_with(u'\033[6A\033[J')
+
+        reporter.stop()
+        self.assertEquals(2, len(self.mocked_stdout.write.mock_calls))
 
 
 class FormatterTestCase(TestCase):
@@ -1044,7 +3051,7 @@ class FormatterTestCase(TestCase):
         self.formatter._is_tty = False
         self.assertEquals('GREEN', self.formatter.green('GREEN'))
 
-    @patch('git_guilt.guilt.fcntl.ioctl')
+    @patch('fcntl.ioctl')
     def test_get_width_tty(self, mocked_ioctl):
         self._isatty_patch.stop()
 
@@ -1085,6 +3092,31 @@ class FormatterTestCase(TestCase):
         )
         stdout_patch.stop()
 
+    def test_show_estimated_guilt(self):
+        text_deltas = [
+            guilt_module.Delta(u'short', 30, 45, 120),
+            guilt_module.Delta(u'Very Long Name', 10, 7, 2),
+        ]
+        binary_deltas = [guilt_module.BinaryDelta(u'short', 30, 45, 8)]
+        formatter = guilt_module.Formatter(text_deltas, binary_deltas)
+
+        if 2 == sys.version_info[0]:
+            stdout_patch = patch('sys.stdout', new_callable=io.BytesIO)
+        elif 3 == sys.version_info[0]:
+            stdout_patch = patch('sys.stdout', new_callable=io.StringIO)
+
+        mock_stdout = stdout_patch.start()
+
+        formatter.show_guilt_stats(text_deltas)
+        formatter.show_guilt_stats(binary_deltas)
+        self.assertEquals(u''' short          | 15 \u00b1120 +++++++++++++++
+ Very Long Name |   -3 \u00b12 ---
+ short          | Bin 30 -> 45 bytes (\u00b18)
+''',
+            mock_stdout.getvalue()
+        )
+        stdout_patch.stop()
+
     def test_show_binary_guilt(self):
         if 2 == sys.version_info[0]:
             stdout_patch = patch('sys.stdout', new_callable=io.BytesIO)
@@ -1094,9 +3126,516 @@ class FormatterTestCase(TestCase):
         mock_stdout = stdout_patch.start()
 
         self.formatter.show_guilt_stats(self.bin_delta_list)
+        self.formatter.show_guilt_stats([guilt_module.LfsDelta(u'short', 0, 4096)])
         self.assertEquals(''' short          | Bin 30 -> 45 bytes
  Very Long Name | Bin 10 -> 7 bytes
+ short          | LFS 0 -> 4096 bytes
 ''',
             mock_stdout.getvalue()
         )
         stdout_patch.stop()
+
+
+class BlameCacheTestCase(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = guilt_module.BlameCache(2)
+        cache.put('a', {'Alice': 1})
+        cache.put('b', {'Bob': 2})
+        self.assertEquals({'Alice': 1}, cache.get('a'))
+        cache.put('c', {'Carol': 3})
+
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals({'Alice': 1}, cache.get('a'))
+        self.assertEquals({'Carol': 3}, cache.get('c'))
+        self.assertEquals((3, 1), (cache.hits, cache.misses))
+
+    def test_save_load(self):
+        import shutil
+        import tempfile
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(cache_dir, 'git-guilt', 'blames.json')
+            self.assertEquals(0, len(guilt_module.BlameCache.load(path, 2)._entries))
+
+            cache = guilt_module.BlameCache(3)
+            cache.put(('TextBlameTicket', 'a' * 40, 'a.c', None, False, 'none', ()), {u'Alice': 1})
+            cache.put(('TextBlameTicket', 'a' * 40, 'b.c', (1, 100), False, 'none', ()), {u'Bob': 2})
+            cache.put(('BinaryBlameTicket', 'b' * 40, 'c.png', None, True, 'bulk', (('core.commitGraph', 'true'),)), {u'<carol@example.com>': 3})
+            cache.save(path)
+            self.assertEquals(['blames.json'], os.listdir(os.path.dirname(path)))
+
+            # Only the most recently used entries fit
+            loaded = guilt_module.BlameCache.load(path, 2)
+            self.assertEquals(
+                [
+                    ('TextBlameTicket', 'a' * 40, 'b.c', (1, 100), False, 'none', ()),
+                    ('BinaryBlameTicket', 'b' * 40, 'c.png', None, True, 'bulk', (('core.commitGraph', 'true'),)),
+                ],
+                list(loaded._entries)
+            )
+            self.assertEquals({u'Bob': 2}, loaded.get(('TextBlameTicket', 'a' * 40, 'b.c', (1, 100), False, 'none', ())))
+
+            with open(path, 'w') as cache_file:
+                cache_file.write('[[["garbage"], {}]]')
+            self.assertEquals(0, len(guilt_module.BlameCache.load(path, 2)._entries))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_key(self):
+        ticket = guilt_module.TextBlameTicket(
+            Mock(), {}, guilt_module.VersionedFile('src/foo.c', 'HEAD'),
+            Mock(
+                email=True, git_profile='none',
+                git_config=(('diff.algorithm', 'histogram'),)
+            ),
+            line_range=(1, 100)
+        )
+        self.assertEquals(
+            (
+                'TextBlameTicket', 'a' * 40, 'src/foo.c', (1, 100), True,
+                'none', (('diff.algorithm', 'histogram'),)
+            ),
+            guilt_module.BlameCache.key(ticket, 'a' * 40)
+        )
+
+    def test_key_separates_profiles(self):
+        def key(git_profile, git_config):
+            ticket = guilt_module.TextBlameTicket(
+                Mock(), {}, guilt_module.VersionedFile('src/foo.c', 'HEAD'),
+                Mock(
+                    email=False, git_profile=git_profile,
+                    git_config=git_config
+                )
+            )
+            return guilt_module.BlameCache.key(ticket, 'a' * 40)
+
+        self.assertNotEqual(key('none', ()), key('bulk', ()))
+        self.assertNotEqual(
+            key('none', ()), key('none', (('diff.algorithm', 'patience'),))
+        )
+
+
+class GuiltServerTestCase(TestCase):
+
+    def setUp(self):
+        self.server = guilt_module.GuiltServer('/tmp/guilt.sock', 10)
+
+    @patch('git_guilt.guilt.os.chdir')
+    @patch('git_guilt.guilt.GitRunner')
+    @patch('git_guilt.guilt.PyGuilt')
+    def test_answer(self, mock_guilt, mock_runner, mock_chdir):
+        def make_guilt(runner, stdout, stderr):
+            def run(argv):
+                stdout.write(u'output\n')
+                stderr.write(u'warning\n')
+                return 130
+            mock_guilt.return_value.run.side_effect = run
+            return mock_guilt.return_value
+        mock_guilt.side_effect = make_guilt
+        old_stdout = sys.stdout
+
+        response = self.server.answer({'cwd': '/some/repo', 'argv': ['HEAD~1']})
+
+        self.assertEquals(
+            {'status': 130, 'stdout': u'output\n', 'stderr': u'warning\n'},
+            response
+        )
+        self.assertTrue(sys.stdout is old_stdout)
+        mock_guilt.return_value.run.assert_called_once_with(['HEAD~1'])
+        self.assertTrue(self.server.blame_cache is mock_guilt.return_value.blame_cache)
+        # Nothing global is changed, so that queries can run concurrently
+        mock_runner.assert_called_once_with('/some/repo')
+        self.assertFalse(mock_chdir.called)
+
+        # The runner is reused by later queries from the same directory
+        self.server.answer({'cwd': '/some/repo', 'argv': []})
+        mock_runner.assert_called_once_with('/some/repo')
+        self.assertTrue(mock_guilt.call_args[0][0] is mock_runner.return_value)
+
+    @patch('git_guilt.guilt.GitRunner')
+    def test_answer_bad_args(self, mock_runner):
+        response = self.server.answer({'cwd': '/some/repo', 'argv': ['--bogus']})
+
+        self.assertEquals(2, response['status'])
+        self.assertEquals(u'', response['stdout'])
+        self.assertTrue(response['stderr'].startswith(u'usage: git guilt'))
+        self.assertTrue(
+            response['stderr'].endswith(u'error: unrecognized arguments: --bogus\n')
+        )
+
+    @patch('git_guilt.guilt.GitRunner')
+    def test_answer_bad_repository(self, mock_runner):
+        mock_runner.side_effect = guilt_module.GitError('Not a git repository')
+
+        response = self.server.answer({'cwd': '/tmp', 'argv': []})
+
+        self.assertEquals(
+            {'status': 1, 'stdout': u'', 'stderr': u'Not a git repository\n'},
+            response
+        )
+
+
+    @patch('git_guilt.guilt.GitRunner')
+    @patch('git_guilt.guilt.PyGuilt')
+    def test_answer_crash(self, mock_guilt, mock_runner):
+        mock_guilt.return_value.run.side_effect = KeyError('since')
+
+        response = self.server.answer({'cwd': '/some/repo', 'argv': []})
+
+        self.assertEquals(
+            {'status': 1, 'stdout': u'', 'stderr': u"KeyError: 'since'\n"},
+            response
+        )
+        # Malformed requests are answered too
+        self.assertEquals(1, self.server.answer({'argv': []})['status'])
+
+    @patch('socket.socket')
+    def test_query_server_no_answer(self, mock_socket):
+        mock_socket.return_value.recv.return_value = b''
+
+        with patch('git_guilt.guilt.sys.stderr') as mock_stderr:
+            status = guilt_module.query_server('/tmp/guilt.sock', ['HEAD~1'])
+
+        self.assertEquals(1, status)
+        self.assertTrue('gave no valid answer' in mock_stderr.write.call_args_list[0][0][0])
+        mock_socket.return_value.close.assert_called_once_with()
+
+
+class GuiltBatchTestCase(TestCase):
+
+    @patch('git_guilt.guilt.GitRunner')
+    @patch('git_guilt.guilt.PyGuilt')
+    def test_run(self, mock_guilt_class, mock_runner_class):
+        guilts = dict()
+
+        def make_guilt(runner):
+            repository = mock_runner_class.call_args[0][0]
+            if '/missing' == repository:
+                raise guilt_module.GitError('Not a git repository\n')
+            guilt = guilts[repository] = Mock(
+                loc_deltas=[guilt_module.Delta('Alice', 1, 3)],
+                byte_deltas=[],
+                lfs_deltas=[],
+            )
+            ticket = Mock(degraded=None, cost=Mock(return_value=5))
+            if '/repos/bad-rev' == repository:
+                guilt.iter_blame_jobs.side_effect = guilt_module.GitError(
+                    "fatal: bad revision 'nope'\n"
+                )
+            elif '/repos/bad-blame' == repository:
+                ticket.process.side_effect = guilt_module.GitError(
+                    'fatal: no such path a.c\n'
+                )
+            guilt.iter_blame_jobs.return_value = iter([ticket])
+            if '/repos/bad-diff' == repository:
+                def iter_blame_jobs():
+                    yield ticket
+                    raise guilt_module.GitError('fatal: unable to read tree\n')
+                guilt.iter_blame_jobs.return_value = iter_blame_jobs()
+
+            def process_args(argv):
+                guilt.args = Mock(
+                    mode='blame', since=argv[0], until=argv[1], sample=None
+                )
+            guilt.process_args.side_effect = process_args
+            return guilt
+        mock_guilt_class.side_effect = make_guilt
+
+        if 2 == sys.version_info[0]:
+            stdout_patch = patch('sys.stdout', new_callable=io.BytesIO)
+        elif 3 == sys.version_info[0]:
+            stdout_patch = patch('sys.stdout', new_callable=io.StringIO)
+        mock_stdout = stdout_patch.start()
+
+        guilt_batch = guilt_module.GuiltBatch(2, ['-e'])
+        status = guilt_batch.run([
+            '# Comments and blank lines are ignored\n',
+            '\n',
+            '/repos/a HEAD~1 HEAD\n',
+            '"/repos/with space" v1.0 v2.0\n',
+            '/missing HEAD~1 HEAD\n',
+            '/repos/bad-rev nope HEAD\n',
+            '/repos/bad-blame HEAD~1 HEAD\n',
+            '/repos/bad-diff HEAD~1 HEAD\n',
+        ])
+        stdout_patch.stop()
+
+        self.assertEquals(1, status)
+        guilts['/repos/a'].process_args.assert_called_once_with(['HEAD~1', 'HEAD', '-e'])
+        records = [json.loads(line) for line in mock_stdout.getvalue().splitlines()]
+        self.assertEquals(
+            [
+                '/repos/a', '/repos/with space', '/missing', '/repos/bad-rev',
+                '/repos/bad-blame', '/repos/bad-diff'
+            ],
+            [record['repository'] for record in records]
+        )
+        self.assertEquals(
+            [{'author': 'Alice', 'since': 1, 'until': 3, 'count': 2}],
+            records[1]['lines']
+        )
+        self.assertEquals('v1.0', records[1]['since'])
+        self.assertEquals('Not a git repository', records[2]['error'])
+        # Failures in one repository don't hold up the others
+        self.assertEquals("fatal: bad revision 'nope'", records[3]['error'])
+        self.assertEquals('fatal: no such path a.c', records[4]['error'])
+        # Planning may fail after some of the tickets were submitted
+        self.assertEquals('fatal: unable to read tree', records[5]['error'])
+        # The last repository's ticket is dropped unless a worker picked it
+        # up before planning failed
+        self.assertTrue(guilt_batch.pool.ticket_count in (3, 4))
+
+
+class GuiltWatchTestCase(TestCase):
+    # The author and number of lines of every file, by commit
+    trees = {
+        'since': {'a.c': ('Alice', 3), 'b.c': ('Alice', 2)},
+        'c0': {'a.c': ('Bob', 4), 'b.c': ('Alice', 2)},
+        'c1': {'a.c': ('Bob', 4), 'b.c': ('Carol', 1), 'c.c': ('Dan', 5)},
+        'c2': {'a.c': ('Eve', 6), 'b.c': ('Alice', 2), 'c.c': ('Dan', 5)},
+    }
+
+    def setUp(self):
+        self.until = 'c0'
+        runner = Mock()
+        runner.rev_parse.side_effect = lambda rev: {'v1': 'since', 'main': self.until}[rev]
+        runner.is_ancestor.return_value = True
+        runner.pathspec_from_cwd.side_effect = lambda path: path
+        runner.changed_paths.side_effect = lambda since, until, pathspecs: set(
+            path for path in set(self.trees[since]) | set(self.trees[until])
+            if self.trees[since].get(path) != self.trees[until].get(path)
+        )
+
+        self.guilt = guilt_module.PyGuilt(runner)
+        self.guilt.args = Mock(
+            mode='blame', recurse_submodules=False, sample=None, working_tree=False,
+            engine='history-walk', since='v1', until='main', paths=[], exclude=[],
+            skip_generated=False, jobs=2,
+        )
+        self.guilt.iter_blame_jobs = self.iter_blame_jobs
+
+    def iter_blame_jobs(self):
+        args = self.guilt.args
+        since, until = self.trees[args.since], self.trees[args.until]
+        paths = [path.replace(':(top,literal)', '') for path in args.paths]
+        for path in sorted(paths or set(since) | set(until)):
+            if since.get(path) == until.get(path):
+                continue
+            for tree, revision, bucket in (
+                    (since, args.since, self.guilt.loc_ownership_since),
+                    (until, args.until, self.guilt.loc_ownership_until)):
+                if path in tree:
+                    author, lines = tree[path]
+                    yield guilt_module.SingleAuthorTicket(
+                        self.guilt.runner,
+                        bucket,
+                        guilt_module.VersionedFile(path, revision, lines=lines),
+                        args,
+                        author
+                    )
+
+    def buckets(self):
+        return (dict(self.guilt.loc_ownership_since), dict(self.guilt.loc_ownership_until))
+
+    def test_bad_args(self):
+        for option in ('recurse_submodules', 'sample', 'working_tree'):
+            setattr(self.guilt.args, option, True)
+            self.assertRaises(guilt_module.GitError, guilt_module.GuiltWatch, self.guilt)
+            setattr(self.guilt.args, option, False)
+
+    def test_update(self):
+        watch = guilt_module.GuiltWatch(self.guilt)
+        self.assertEquals('per-file', self.guilt.args.engine)
+
+        self.assertEquals(2, len(watch.update()))
+        self.assertEquals(({'Alice': 3}, {'Bob': 4}), self.buckets())
+        # The ref hasn't moved
+        self.assertEquals(None, watch.update())
+
+        # Only the files changed by new commits are blamed
+        self.until = 'c1'
+        self.assertEquals(3, len(watch.update()))
+        self.guilt.runner.changed_paths.assert_called_with('c0', 'c1', [])
+        self.assertEquals(
+            ({'Alice': 5}, {'Bob': 4, 'Carol': 1, 'Dan': 5}),
+            self.buckets()
+        )
+
+        # a.c is unchanged since v1, so it's only blamed at c2, whereas b.c is
+        # back to its old self
+        self.until = 'c2'
+        tickets = watch.update()
+        self.assertEquals(['c2:"a.c"'], [ticket.describe() for ticket in tickets])
+        self.assertEquals(({'Alice': 3}, {'Eve': 6, 'Dan': 5}), self.buckets())
+        self.assertEquals(['a.c', 'c.c'], sorted(watch.files))
+
+    def test_update_rewritten(self):
+        watch = guilt_module.GuiltWatch(self.guilt)
+        self.until = 'c1'
+        watch.update()
+
+        # The ref was reset, so everything is blamed again
+        self.until = 'c0'
+        self.guilt.runner.is_ancestor.return_value = False
+        self.assertEquals(2, len(watch.update()))
+        self.assertEquals(({'Alice': 3}, {'Bob': 4}), self.buckets())
+        self.assertFalse(self.guilt.runner.changed_paths.called)
+
+    def test_update_failed(self):
+        watch = guilt_module.GuiltWatch(self.guilt)
+        watch.update()
+
+        # One of the blames fails after the others were tallied
+        self.until = 'c1'
+        iter_blame_jobs = self.iter_blame_jobs
+
+        def failing_blame_jobs():
+            for ticket in iter_blame_jobs():
+                if 'c.c' == ticket.versioned_file.repo_path:
+                    ticket = Mock(
+                        versioned_file=ticket.versioned_file, bucket=ticket.bucket,
+                        cost=Mock(return_value=0), degraded=None,
+                        process=Mock(side_effect=guilt_module.GitError('Oops'))
+                    )
+                yield ticket
+        self.guilt.iter_blame_jobs = failing_blame_jobs
+        self.assertRaises(guilt_module.GitError, watch.update)
+        self.assertEquals(None, watch.commit)
+        self.assertEquals(({}, {}), self.buckets())
+
+        # The retry blames everything again
+        self.guilt.iter_blame_jobs = iter_blame_jobs
+        self.guilt.runner.changed_paths.reset_mock()
+        self.assertEquals(5, len(watch.update()))
+        self.assertFalse(self.guilt.runner.changed_paths.called)
+        self.assertEquals(
+            ({'Alice': 5}, {'Bob': 4, 'Carol': 1, 'Dan': 5}),
+            self.buckets()
+        )
+
+    def test_report(self):
+        if 2 == sys.version_info[0]:
+            stdout_patch = patch('sys.stdout', new_callable=io.BytesIO)
+        elif 3 == sys.version_info[0]:
+            stdout_patch = patch('sys.stdout', new_callable=io.StringIO)
+        mock_stdout = stdout_patch.start()
+        self.addCleanup(stdout_patch.stop)
+
+        watch = guilt_module.GuiltWatch(self.guilt)
+        watch.report(watch.update())
+        record = json.loads(mock_stdout.getvalue())
+        self.assertEquals(
+            ('v1', 'main', 'c0', 2),
+            (record['since'], record['until'], record['commit'], record['blames'])
+        )
+        self.assertEquals(
+            [
+                {'author': 'Bob', 'since': 0, 'until': 4, 'count': 4},
+                {'author': 'Alice', 'since': 3, 'until': 0, 'count': -3},
+            ],
+            record['lines']
+        )
+
+    @patch('git_guilt.guilt.Formatter.terminal_output')
+    def test_run_bad_ref(self, mock_output):
+        watch = guilt_module.GuiltWatch(self.guilt)
+        self.guilt.runner.rev_parse.side_effect = guilt_module.GitError("'git rev-parse' failed")
+        self.assertEquals(1, watch.run(60))
+        self.assertEquals(1, mock_output.call_count)
+
+    @patch('git_guilt.guilt.GuiltWatch.report')
+    def test_run(self, mock_report):
+        watch = guilt_module.GuiltWatch(self.guilt)
+        watch.wakeup = Mock()
+        # The ref can't be read for a while, then it's interrupted
+        watch.wakeup.wait.side_effect = [None, None, KeyboardInterrupt()]
+
+        def rev_parse(rev):
+            if 2 == watch.wakeup.wait.call_count:
+                raise guilt_module.GitError('cannot lock ref')
+            return {'v1': 'since', 'main': 'c0'}[rev]
+        self.guilt.runner.rev_parse.side_effect = rev_parse
+
+        with patch('git_guilt.guilt.Formatter.terminal_output') as mock_output:
+            self.assertEquals(0, watch.run(60))
+        self.assertEquals(1, mock_output.call_count)
+        # The first update is the only one that changed anything
+        self.assertEquals(1, mock_report.call_count)
+        watch.wakeup.wait.assert_called_with(60)
+
+
+class GuiltPrepareTestCase(TestCase):
+
+    def setUp(self):
+        self.runner = Mock(version=(2, 30, 0))
+        self.runner.is_shallow.return_value = False
+        self.runner.commit_graph_state.return_value = (0, 0)
+        self.runner.count_objects.return_value = {'count': 9000, 'size': 2048, 'packs': 1, 'size-pack': 10240}
+        self.runner.get_config.side_effect = lambda key: {'pack.threads': '4'}.get(key)
+        self.runner.iter_git.return_value = iter(['a.c', 'b.c', '', '\nb.c', 'gone.c', 'gone.c', 'gone.c', ''])
+
+        if 2 == sys.version_info[0]:
+            self.stdout_patch = patch('sys.stdout', new_callable=io.BytesIO)
+        elif 3 == sys.version_info[0]:
+            self.stdout_patch = patch('sys.stdout', new_callable=io.StringIO)
+        self.mock_stdout = self.stdout_patch.start()
+        self.addCleanup(self.stdout_patch.stop)
+
+    def test_sample_path(self):
+        self.runner.run_git.side_effect = [guilt_module.GitError('gone'), ['12']]
+        prepare = guilt_module.GuiltPrepare(self.runner)
+        # The most often changed file that's still there
+        self.assertEquals('b.c', prepare.sample_path())
+        self.assertEquals(
+            [call(['cat-file', '-s', 'HEAD:gone.c']), call(['cat-file', '-s', 'HEAD:b.c'])],
+            self.runner.run_git.call_args_list
+        )
+
+    @patch('git_guilt.guilt.GuiltPrepare.time_blame')
+    def test_run(self, mock_time_blame):
+        mock_time_blame.side_effect = [0.5, 0.5, 0.1]
+        prepare = guilt_module.GuiltPrepare(self.runner)
+
+        self.assertEquals(0, prepare.run(path='src/a.c'))
+        self.assertFalse(self.runner.write_commit_graph.called)
+        report = self.mock_stdout.getvalue()
+        self.assertTrue('Commit-graph: none\n' in report)
+        self.assertTrue('Loose objects: 9000 (2.0 MiB)\n' in report)
+        self.assertTrue('Packs: 1 (10.0 MiB)\n' in report)
+        self.assertTrue('pack.threads: 4\n' in report)
+        self.assertTrue('core.deltaBaseCacheSize: 96m (default)\n' in report)
+        self.assertTrue('Blaming src/a.c: 0.50s\n' in report)
+        self.assertTrue('Hint: Objects are scattered: pack them with git gc\n' in report)
+        self.assertTrue('git guilt prepare --write' in report)
+
+        self.mock_stdout.truncate(0)
+        self.mock_stdout.seek(0)
+        self.runner.git_supports_changed_paths.return_value = True
+        self.assertEquals(0, prepare.run(write=True, path='src/a.c'))
+        self.runner.write_commit_graph.assert_called_once_with()
+        self.assertTrue('Blaming src/a.c: 0.10s (5.0x as fast)\n' in self.mock_stdout.getvalue())
+
+    @patch('git_guilt.guilt.GuiltPrepare.time_blame')
+    def test_run_up_to_date(self, mock_time_blame):
+        mock_time_blame.return_value = 0.2
+        self.runner.commit_graph_state.return_value = (2, 2)
+        self.runner.run_git.side_effect = [guilt_module.GitError('gone'), ['12']]
+        prepare = guilt_module.GuiltPrepare(self.runner)
+
+        self.assertEquals(0, prepare.run(write=True, path=None))
+        self.assertFalse(self.runner.write_commit_graph.called)
+        self.assertTrue('Changed-path Bloom filters: in 2 of 2 file(s)\n' in self.mock_stdout.getvalue())
+        # The sample file is picked from recent history
+        self.assertTrue('Blaming b.c: 0.20s\n' in self.mock_stdout.getvalue())
+
+    @patch('git_guilt.guilt.GuiltPrepare.time_blame')
+    def test_run_shallow(self, mock_time_blame):
+        mock_time_blame.return_value = 0.5
+        self.runner.is_shallow.return_value = True
+        prepare = guilt_module.GuiltPrepare(self.runner)
+
+        self.assertEquals(0, prepare.run(write=True, path='a.c'))
+        self.assertFalse(self.runner.write_commit_graph.called)
+        self.assertTrue('git fetch --unshallow' in self.mock_stdout.getvalue())
@@ -72,24 +72,114 @@ class IntegrationTests(TestCase):
         o, e = self.run_cli('-h')
         self.assertEquals(b'', e)
 
-        expected_stdout = u'''usage: git guilt [-h] [-e] [since] [until]
+        expected_stdout = u'''usage: git guilt [-h] [-e] [--mode {blame,churn}]
+                 [--engine {per-file,history-walk}] [--backend {git,pygit2}]
+                 [-j JOBS] [--stats] [--progress SECONDS]
+                 [--format {table,ndjson}] [--split-lines LINES] [-x GLOB]
+                 [--skip-generated] [--recurse-submodules]
+                 [--max-file-bytes BYTES] [--max-blame-seconds SECONDS]
+                 [--textconv-cache DIR] [--textconv-cache-bytes BYTES]
+                 [--git-profile {bulk,none}] [--git-config KEY=VALUE]
+                 [--working-tree] [--sample FRACTION|N] [--sample-seed SEED]
+                 [since] [until] [path [path ...]]
 
 git-guilt is a custom tool written for git(1). It provides information
 regarding the transfer of ownership between two revisions of a repository.
 
 positional arguments:
-  since        The revision starting from which the transfer of blame should
-               be reported
-  until        The revision until which the transfer of blame should be
-               reported
+  since                 The revision starting from which the transfer of blame
+                        should be reported
+  until                 The revision until which the transfer of blame should
+                        be reported
+  path                  Only report on files matching these paths or pathspecs
 
 optional arguments:
-  -h, --help   show this help message and exit
-  -e, --email  Causes git-guilt to report transfers of ownership using
-               authors' email addresses instead of their names
+  -h, --help            show this help message and exit
+  -e, --email           Causes git-guilt to report transfers of ownership
+                        using authors' email addresses instead of their names
+  --mode {blame,churn}  How ownership is measured. blame compares git-blame of
+                        the since and until revisions. churn is a much faster
+                        approximation that credits every author with the lines
+                        they added minus those they removed in between, from a
+                        single git-log (default: blame)
+  --engine {per-file,history-walk}
+                        How text files are blamed. per-file runs git-blame for
+                        every file. history-walk replays the history once for
+                        all of them, which is much faster for many files, but
+                        only works on ranges without merges: per-file is used
+                        otherwise (default: per-file)
+  --backend {git,pygit2}
+                        How objects are read. git runs a git process for every
+                        lookup. pygit2 reads objects and diffs trees in-
+                        process, and needs pygit2 to be installed. Blames are
+                        run by git either way (default: git)
+  -j JOBS, --jobs JOBS  The number of git-blame processes to run concurrently
+                        (default: the number of CPUs)
+  --stats               Report how long blaming took on the standard error
+                        stream
+  --progress SECONDS    Report progress and the transfer of ownership so far
+                        every SECONDS seconds while blaming. Interim results
+                        are redrawn in place on a terminal
+  --format {table,ndjson}
+                        Output the transfer of ownership as a table, or as
+                        newline-delimited JSON records, one per progress
+                        report and a final one with "complete" set (default:
+                        table)
+  --split-lines LINES   Blame files longer than LINES lines as several ranges
+                        of at most LINES lines that are processed
+                        concurrently. Text files of at most 16 bytes times
+                        LINES are left whole. 0 disables splitting (default:
+                        20000)
+  -x GLOB, --exclude GLOB
+                        Don't blame files whose path from the top of the
+                        repository matches GLOB. May be given several times
+  --skip-generated      Don't blame files marked as linguist-generated or
+                        -diff in gitattributes
+  --recurse-submodules  Also blame the files that changed in submodules
+                        between the commits they were at in either revision
+  --max-file-bytes BYTES
+                        Don't blame files larger than BYTES bytes. Their
+                        content is credited to the author of the last commit
+                        that modified them
+  --max-blame-seconds SECONDS
+                        Stop blaming a file after SECONDS seconds and credit
+                        its content to the author of the last commit that
+                        modified it
+  --textconv-cache DIR  Where to cache the conversion of binary files to text
+                        for blaming, rather than as notes in the repository
+                        (default: the textconv directory of the git-guilt
+                        cache)
+  --textconv-cache-bytes BYTES
+                        The size the textconv cache is pruned down to after
+                        each run, or 0 not to cache conversions (default:
+                        1073741824)
+  --git-profile {bulk,none}
+                        The Git configuration blames are run with, on top of
+                        the user's and the repository's: bulk is tuned for
+                        running many of them and blames text files without
+                        textconv filters, none adds nothing (default: bulk)
+  --git-config KEY=VALUE
+                        Git configuration to run blames with, on top of the
+                        profile's. May be given more than once.
+  --working-tree        Report the transfer of ownership from the since
+                        revision (default: HEAD) to the working tree, ie. what
+                        committing every change in it would do. Any argument
+                        after the since revision is a path, as is the first
+                        one if it isn't a commit. Uncommitted lines are
+                        credited to the author of the next commit, and blames
+                        of the since revision are kept between runs, so that
+                        only changed files are blamed again.
+  --sample FRACTION|N   Only blame a random sample of the changed files,
+                        either a fraction (eg. 0.1) or a number of files, and
+                        estimate the transfer of ownership from it. Estimates
+                        come with a 95% confidence margin
+  --sample-seed SEED    Seeds the random choice of files for --sample, so that
+                        the same sample can be drawn again
 
 Please note that git-guilt needs git >= 1.7.2 in order to process binary
-files.
+files. serve, batch, prepare and watch are taken as subcommands when given
+first: to compare revisions with those names, put -- before them, eg. git
+guilt -- watch HEAD.
 '''
 
         self.assertEquals(self.prepare_expected_string(expected_stdout), o)